@@ -1,16 +1,124 @@
-from fastapi import APIRouter
-from graph_factory import build_ocr_graph
+import asyncio
+import logging
+from typing import Optional
+from fastapi import APIRouter, Depends, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel
+from depts import get_db
+from ocr_worker import get_ocr_job, job_to_dict
+from ocr_cache import hash_bytes
+from ocr_clients import FetchRejected, FileTooLarge, afetch_file, check_file_url, client_stats, ocr_user_var, remember_file
+from ocr_batch import OCR_BATCH_MAX_ITEMS, stream_batch
+from startup import ocr_graph
+from ocr_checkpoint import ainvoke_ocr_graph, astream_ocr_graph
+from nodes.fanout import FANOUT_MODES
+from user_session import current_user
+
+logger = logging.getLogger('kabala')
 
 router = APIRouter()
-ocr_graph = build_ocr_graph()
+
+
+async def _content_hash(file_url: str):
+    """Download file_url once and return (sha256, None), or (None, error response).
+
+    The bytes are kept for the OCR nodes of this request, so they don't
+    download the file a second time.
+    """
+    try:
+        data = await afetch_file(check_file_url(file_url))
+    except FileTooLarge as e:
+        return None, JSONResponse({"error": str(e)}, status_code=413)
+    except FetchRejected as e:
+        return None, JSONResponse({"error": str(e)}, status_code=422)
+    except Exception as e:
+        logger.warning(f"Could not fetch {file_url} for OCR: {e}")
+        return None, JSONResponse({"error": "Could not fetch file_url"}, status_code=502)
+    remember_file(file_url, data)
+    return await asyncio.to_thread(hash_bytes, data), None
+
 
 @router.post("/ocr")
-def ocr_endpoint(file_url: str, file_type: str):
+async def ocr_endpoint(request: Request, file_url: str, file_type: str,
+                       mode: Optional[str] = None, stream: bool = False):
+    """mode: "route" (by file type), "first" (race both engines) or "best" (highest confidence).
+
+    stream=true answers with NDJSON: a line per PDF page as soon as its
+    page range is done (Document AI processes long PDFs in concurrent
+    chunks), then a final {"type": "result"} line with the merged state.
+
+    Retrying the same file returns the stored result, or resumes the run
+    that was interrupted, instead of calling the OCR engines again. The
+    graph runs on the event loop with the async Google clients, so a
+    request in flight holds no thread; OCR_MAX_IN_FLIGHT and
+    OCR_MAX_IN_FLIGHT_PER_USER bound the outstanding Google calls.
+
+    file_url must be one of our Cloudinary delivery URLs (OCR_FETCH_ORIGINS).
+    The file is downloaded once here, capped at MAX_UPLOAD_BYTES, and
+    hashed to key the OCR cache and the checkpoints; a hash from the
+    client is never trusted.
+    """
+    user = current_user(request)
+    if not user:
+        return JSONResponse({"error": "Not logged in"}, status_code=401)
+    if mode not in (None, "route", *FANOUT_MODES):
+        return JSONResponse({"error": f"unknown mode {mode!r}"}, status_code=422)
+    content_hash, error = await _content_hash(file_url)
+    if error:
+        return error
     initial_state = {
         "file_url": file_url,
         "file_type": file_type,
+        "content_hash": content_hash,
         "raw_text": None,
         "structured_data": None,
-        "metadata": {}
+        "metadata": {},
+        "ocr_mode": mode,
     }
-    return ocr_graph.invoke(initial_state)
+    ocr_user_var.set(user.user_id)
+    # the first build imports langgraph and the google clients; keep that off the loop
+    graph = ocr_graph.get() if ocr_graph.done else await asyncio.to_thread(ocr_graph.get)
+    if stream:
+        return StreamingResponse(astream_ocr_graph(graph, initial_state), media_type="application/x-ndjson")
+    return await ainvoke_ocr_graph(graph, initial_state)
+
+
+class BatchItem(BaseModel):
+    file_url: str
+    file_type: str
+
+
+class BatchRequest(BaseModel):
+    items: list[BatchItem]
+
+
+@router.post("/batch")
+async def ocr_batch_endpoint(request: Request, batch: BatchRequest):
+    """OCR many files at once; results stream back as NDJSON as each group finishes.
+
+    At most OCR_BATCH_MAX_ITEMS files, each checked, fetched and hashed
+    like /ocr's, so they share its cache and per-user limits.
+    """
+    user = current_user(request)
+    if not user:
+        return JSONResponse({"error": "Not logged in"}, status_code=401)
+    if len(batch.items) > OCR_BATCH_MAX_ITEMS:
+        return JSONResponse({"error": f"at most {OCR_BATCH_MAX_ITEMS} items per batch"}, status_code=413)
+    ocr_user_var.set(user.user_id)
+    items = [item.model_dump() for item in batch.items]
+    return StreamingResponse(stream_batch(items), media_type="application/x-ndjson")
+
+
+@router.get("/jobs/{job_id}")
+def ocr_job_status(request: Request, job_id: str, db=Depends(get_db)):
+    user = current_user(request)
+    # another user's job is reported exactly like a missing one
+    job = get_ocr_job(db, job_id, user.user_id if user else None)
+    if not job:
+        return JSONResponse({"error": "job not found"}, status_code=404)
+    return job_to_dict(job)
+
+
+@router.get("/clients")
+def ocr_client_stats():
+    return client_stats()
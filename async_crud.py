@@ -0,0 +1,48 @@
+"""AsyncSession versions of the data-access helpers in main.py that its async handlers use.
+
+Only the read and profile paths are here; receipts are written by the sync
+handlers (see the comment above main.async_router).
+"""
+from sqlalchemy import func, select
+
+from models import User, Receipt, ReceiptCount
+from receipt_counts import cached_receipt_count, stage_receipt_count
+from user_session import invalidate_user
+
+
+async def get_user_db(db, username):
+    return (await db.execute(select(User).where(User.username == username))).scalars().first()
+
+
+async def update_user_db(db, username: str, fields: dict):
+    user = await get_user_db(db, username)
+
+    if not user:
+        return None
+
+    for k, v in fields.items():
+        setattr(user, k, v)
+
+    invalidate_user(db, user.user_id)
+    await db.commit()
+    return user
+
+
+async def _count_receipts(db, user_id: int) -> int:
+    return (await db.execute(
+        select(func.count(Receipt.public_id)).where(Receipt.user_id == user_id)
+    )).scalar() or 0
+
+
+async def get_receipt_count(db, user_id: int) -> int:
+    cached = cached_receipt_count(user_id)
+    if cached is not None:
+        return cached
+
+    row = await db.get(ReceiptCount, user_id)
+    if row is None:
+        n = await _count_receipts(db, user_id)
+    else:
+        n = row.count
+    stage_receipt_count(db, user_id, n)
+    return n
@@ -0,0 +1,31 @@
+import os
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from dotenv import load_dotenv
+from database import ENV, POOL_SIZE, MAX_OVERFLOW, POOL_TIMEOUT, POOL_RECYCLE
+from db_timing import instrument_queries
+
+load_dotenv()
+
+# SQLite dev mode keeps the sync handlers; the async layer is Postgres/asyncpg only
+ASYNC_DB_ENABLED = ENV != "local" and os.getenv("ASYNC_DB", "1") != "0"
+
+async_engine = None
+AsyncSessionLocal = None
+
+if ASYNC_DB_ENABLED:
+    url = make_url(os.environ["DATABASE_URL"])
+    # asyncpg takes ssl as a connect arg, not a libpq sslmode query param
+    url = url.set(drivername="postgresql+asyncpg").difference_update_query(["sslmode"])
+    async_engine = create_async_engine(
+        url,
+        pool_pre_ping=True,
+        pool_size=POOL_SIZE,
+        max_overflow=MAX_OVERFLOW,
+        pool_timeout=POOL_TIMEOUT,
+        pool_recycle=POOL_RECYCLE,
+        connect_args={"ssl": "require"},
+    )
+    instrument_queries(async_engine.sync_engine)
+    # objects are read after commit by the templates; never lazy-load from an async session
+    AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
@@ -0,0 +1,337 @@
+"""Local HTTP stand-ins for Cloudinary and the Google OCR APIs.
+
+Each fake is a threaded HTTP server on 127.0.0.1 with configurable latency,
+jitter and error rate. The app talks to them through its normal SDK calls:
+Cloudinary via its upload_prefix setting, Vision and Document AI via their
+REST transports pointed at the fake's URL (see point_app_at_fakes). The
+async Google clients only speak gRPC, so FakeGoogleOcr also serves the
+same two calls on a local gRPC port.
+"""
+import base64
+import email.parser
+import io
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+# each in-flight gRPC call holds a server thread while its latency sleeps
+GRPC_WORKERS = 512
+
+FAKE_OCR_TEXT = "Dr. Cohen Clinic\nקבלה מס' 1042\nתאריך: 02/01/2024\nסה\"כ לתשלום: 350.00 ₪"
+
+
+class Faults:
+    """Latency and error injection shared by every request a fake serves."""
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, error_rate: float = 0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+
+    def delay(self):
+        ms = self.latency_ms + (random.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0.0)
+        if ms > 0:
+            time.sleep(ms / 1000)
+
+    def should_fail(self) -> bool:
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    fake = None  # set on the per-server subclass
+
+    def log_message(self, *args):
+        pass
+
+    def _body(self) -> bytes:
+        n = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(n) if n else b""
+
+    def _reply(self, status: int, payload):
+        content_type = "application/json"
+        if isinstance(payload, bytes):
+            data, content_type = payload, "image/jpeg"
+        else:
+            data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self):
+        body = self._body()
+        fake = self.fake
+        fake.count(self.command, self.path)
+        fake.faults.delay()
+        if fake.faults.should_fail():
+            fake.count_error()
+            self._reply(503, {"error": {"code": 503, "message": "injected failure", "status": "UNAVAILABLE"}})
+            return
+        status, payload = fake.respond(self.command, urlparse(self.path).path, self.headers, body)
+        self._reply(status, payload)
+
+    do_GET = do_POST = do_DELETE = _handle
+
+
+class FakeServer:
+    def __init__(self, faults: Faults = None):
+        self.faults = faults or Faults()
+        self.calls = {}
+        self.errors = 0
+        self._lock = threading.Lock()
+        handler = type(f"{type(self).__name__}Handler", (_Handler,), {"fake": self})
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def count(self, method: str, path: str):
+        key = f"{method} {self.route_name(urlparse(path).path)}"
+        with self._lock:
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+    def count_error(self):
+        with self._lock:
+            self.errors += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"calls": dict(self.calls), "injected_errors": self.errors}
+
+    def route_name(self, path: str) -> str:
+        return path
+
+    def respond(self, method: str, path: str, headers, body: bytes):
+        raise NotImplementedError
+
+
+def _sample_jpeg() -> bytes:
+    from PIL import Image
+    buf = io.BytesIO()
+    Image.new("RGB", (64, 64), "white").save(buf, "JPEG")
+    return buf.getvalue()
+
+
+def _form_fields(headers, body: bytes) -> dict:
+    """The plain (non-file) fields of a multipart/form-data body."""
+    content_type = headers.get("Content-Type", "")
+    if not content_type.startswith("multipart/"):
+        return {}
+    message = email.parser.BytesParser().parsebytes(
+        b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body
+    )
+    fields = {}
+    for part in message.get_payload():
+        name = part.get_param("name", header="content-disposition")
+        if name and part.get_filename() is None:
+            fields[name] = part.get_payload(decode=True).decode("utf-8", "replace")
+    return fields
+
+
+class FakeCloudinary(FakeServer):
+    """Answers the upload, context, destroy and delete_resources calls the app makes,
+    and serves every uploaded asset URL as a small JPEG (tagged with its path, so
+    each asset hashes differently)."""
+
+    def __init__(self, faults: Faults = None):
+        super().__init__(faults)
+        self.asset = _sample_jpeg()
+
+    def route_name(self, path: str) -> str:
+        if path.startswith("/assets/"):
+            return "assets"
+        # /v1_1/<cloud>/image/upload -> image/upload
+        return "/".join(path.split("/")[3:]) or path
+
+    def respond(self, method, path, headers, body):
+        route = self.route_name(path)
+        if method == "POST" and route.endswith("/upload"):
+            fields = _form_fields(headers, body)
+            public_id = fields.get("public_id", "bench")
+            if fields.get("folder"):
+                public_id = f"{fields['folder']}/{public_id}"
+            return 200, {
+                "public_id": public_id,
+                "secure_url": f"{self.url}/assets/{public_id}.jpg",
+                "created_at": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "bytes": int(headers.get("Content-Length") or 0),
+                "resource_type": "image",
+            }
+        if method == "GET" and route == "assets":
+            return 200, self.asset + path.encode()
+        if method == "POST" and route.endswith("/destroy"):
+            return 200, {"result": "ok"}
+        if method == "POST" and route.endswith("/context"):
+            fields = _form_fields(headers, body)
+            return 200, {"public_ids": [v for k, v in fields.items() if k.startswith("public_ids")]}
+        if method == "DELETE" and route.startswith("resources/"):
+            ids = json.loads(body or b"{}").get("public_ids", [])
+            return 200, {"deleted": {pid: "deleted" for pid in ids}, "partial": False}
+        return 404, {"error": {"message": f"fake Cloudinary has no route for {method} {route}"}}
+
+
+class FakeGoogleOcr(FakeServer):
+    """Vision images:annotate and Document AI processors/*:process over REST and gRPC."""
+
+    def __init__(self, faults: Faults = None, text: str = FAKE_OCR_TEXT):
+        import grpc
+        from google.cloud import documentai, vision
+
+        super().__init__(faults)
+        self.text = text
+        self._grpc = grpc.server(ThreadPoolExecutor(max_workers=GRPC_WORKERS))
+        self._grpc.add_generic_rpc_handlers((
+            grpc.method_handlers_generic_handler("google.cloud.vision.v1.ImageAnnotator", {
+                "BatchAnnotateImages": grpc.unary_unary_rpc_method_handler(
+                    self._grpc_annotate,
+                    request_deserializer=vision.BatchAnnotateImagesRequest.deserialize,
+                    response_serializer=vision.BatchAnnotateImagesResponse.serialize,
+                ),
+            }),
+            grpc.method_handlers_generic_handler("google.cloud.documentai.v1.DocumentProcessorService", {
+                "ProcessDocument": grpc.unary_unary_rpc_method_handler(
+                    self._grpc_process,
+                    request_deserializer=documentai.ProcessRequest.deserialize,
+                    response_serializer=documentai.ProcessResponse.serialize,
+                ),
+            }),
+        ))
+        self._grpc_port = self._grpc.add_insecure_port("127.0.0.1:0")
+
+    @property
+    def grpc_target(self) -> str:
+        return f"127.0.0.1:{self._grpc_port}"
+
+    def start(self):
+        self._grpc.start()
+        return super().start()
+
+    def stop(self):
+        self._grpc.stop(0)
+        super().stop()
+
+    def route_name(self, path: str) -> str:
+        if path.endswith("images:annotate"):
+            return "vision:annotate"
+        if path.endswith(":process"):
+            return "documentai:process"
+        return path
+
+    def respond(self, method, path, headers, body):
+        route = self.route_name(path)
+        if route == "vision:annotate":
+            n = len(json.loads(body or b"{}").get("requests", [])) or 1
+            annotation = {"responses": [{"textAnnotations": [{"description": self.text}]}] * n}
+            return 200, annotation
+        if route == "documentai:process":
+            from google.cloud import documentai
+            content = base64.b64decode(json.loads(body or b"{}").get("rawDocument", {}).get("content", ""))
+            return 200, documentai.ProcessResponse.to_dict(self._process(content))
+        return 404, {"error": {"code": 404, "message": f"fake OCR has no route for {path}"}}
+
+    def _grpc_call(self, path: str, context):
+        import grpc
+
+        self.count("GRPC", path)
+        self.faults.delay()
+        if self.faults.should_fail():
+            self.count_error()
+            context.abort(grpc.StatusCode.UNAVAILABLE, "injected failure")
+
+    def _grpc_annotate(self, request, context):
+        from google.cloud import vision
+
+        self._grpc_call("/v1/images:annotate", context)
+        response = vision.AnnotateImageResponse(text_annotations=[vision.EntityAnnotation(description=self.text)])
+        return vision.BatchAnnotateImagesResponse(responses=[response] * (len(request.requests) or 1))
+
+    def _grpc_process(self, request, context):
+        self._grpc_call("/v1/processor:process", context)
+        return self._process(request.raw_document.content)
+
+    def _process(self, content: bytes):
+        """A Document with one page per PDF page, carrying the page's own text when it has any."""
+        from google.cloud import documentai
+
+        page_texts = [self.text]
+        if content.startswith(b"%PDF"):
+            from pypdf import PdfReader
+            page_texts = [(p.extract_text() or self.text) for p in PdfReader(io.BytesIO(content)).pages]
+        text, pages = "", []
+        for n, page_text in enumerate(page_texts, start=1):
+            start = len(text)
+            text += page_text + "\n"
+            segment = documentai.Document.TextAnchor.TextSegment(start_index=start, end_index=len(text))
+            pages.append(documentai.Document.Page(page_number=n, layout=documentai.Document.Page.Layout(
+                text_anchor=documentai.Document.TextAnchor(text_segments=[segment]), confidence=0.95,
+            )))
+        return documentai.ProcessResponse(document=documentai.Document(
+            text=text,
+            pages=pages,
+            entities=[documentai.Document.Entity(type_="total_amount", mention_text="350.00")],
+        ))
+
+
+def point_app_at_fakes(cloudinary_url: str, ocr_url: str, ocr_grpc_target: str = None):
+    """Reconfigure the app's Cloudinary SDK and OCR clients to use the fakes."""
+    import cloudinary
+    import grpc
+    from google.auth.credentials import AnonymousCredentials
+    import ocr_clients
+
+    cloudinary.config(
+        cloud_name="bench", api_key="bench", api_secret="bench",
+        upload_prefix=cloudinary_url, secure=False,
+    )
+    # the fake's asset URLs stand in for res.cloudinary.com
+    ocr_clients.allow_fetch_origin(cloudinary_url)
+
+    def vision_client():
+        from google.cloud import vision
+        return vision.ImageAnnotatorClient(
+            transport="rest", credentials=AnonymousCredentials(), client_options={"api_endpoint": ocr_url},
+        )
+
+    def documentai_client():
+        from google.cloud import documentai
+        return documentai.DocumentProcessorServiceClient(
+            transport="rest", credentials=AnonymousCredentials(), client_options={"api_endpoint": ocr_url},
+        )
+
+    def vision_async_client():
+        from google.cloud import vision
+        from google.cloud.vision_v1.services.image_annotator.transports import ImageAnnotatorGrpcAsyncIOTransport
+        channel = grpc.aio.insecure_channel(ocr_grpc_target)
+        return vision.ImageAnnotatorAsyncClient(transport=ImageAnnotatorGrpcAsyncIOTransport(channel=channel))
+
+    def documentai_async_client():
+        from google.cloud import documentai
+        from google.cloud.documentai_v1.services.document_processor_service.transports import (
+            DocumentProcessorServiceGrpcAsyncIOTransport,
+        )
+        channel = grpc.aio.insecure_channel(ocr_grpc_target)
+        return documentai.DocumentProcessorServiceAsyncClient(
+            transport=DocumentProcessorServiceGrpcAsyncIOTransport(channel=channel),
+        )
+
+    ocr_clients.set_builder("vision", vision_client, vision_async_client if ocr_grpc_target else None)
+    ocr_clients.set_builder("document_ai", documentai_client, documentai_async_client if ocr_grpc_target else None)
@@ -0,0 +1,65 @@
+"""Measure what image_prep.normalize_image saves per upload.
+
+Usage (from the repo root):
+    python -m benchmarks.image_prep_bench [image ...] [--repeat N] [--uplink-mbps M]
+
+Reports bytes before/after, preprocessing time, and the transfer time
+saved on an uplink of the given speed (upload to Cloudinary, then
+Cloudinary -> Vision fetch, so the saving is counted once per hop).
+"""
+import argparse
+import io
+import json
+import mimetypes
+import os
+import statistics
+import time
+
+from image_prep import normalize_image
+
+DEFAULT_IMAGE = os.path.join(os.path.dirname(__file__), os.pardir, "overflow", "test_image.jpeg")
+
+
+def bench_file(path: str, repeat: int, uplink_mbps: float) -> dict:
+    with open(path, "rb") as f:
+        data = f.read()
+    content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+    times = []
+    prepared = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        prepared = normalize_image(io.BytesIO(data), content_type, len(data))
+        times.append((time.perf_counter() - started) * 1000)
+
+    saved = prepared.original_bytes - prepared.prepared_bytes
+    bytes_per_ms = uplink_mbps * 1_000_000 / 8 / 1000
+    transfer_saved_ms = 2 * saved / bytes_per_ms
+    prep_ms = statistics.median(times)
+    return {
+        "file": os.path.basename(path),
+        "original_bytes": prepared.original_bytes,
+        "prepared_bytes": prepared.prepared_bytes,
+        "reduction_pct": round(100 * saved / prepared.original_bytes, 1) if prepared.original_bytes else 0.0,
+        "original_size": prepared.stats.get("original_size"),
+        "prepared_size": prepared.stats.get("prepared_size"),
+        "prep_ms_p50": round(prep_ms, 1),
+        "prep_ms_max": round(max(times), 1),
+        "transfer_saved_ms": round(transfer_saved_ms, 1),
+        "net_saved_ms": round(transfer_saved_ms - prep_ms, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("images", nargs="*", default=[DEFAULT_IMAGE])
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--uplink-mbps", type=float, default=10.0)
+    args = parser.parse_args()
+
+    for path in args.images:
+        print(json.dumps(bench_file(path, args.repeat, args.uplink_mbps)))
+
+
+if __name__ == "__main__":
+    main()
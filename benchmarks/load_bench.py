@@ -0,0 +1,318 @@
+"""Offline load test: the app against local fakes of Cloudinary and Google OCR.
+
+Usage (from the repo root):
+    python -m benchmarks.load_bench [--concurrency N] [--duration S | --requests N]
+        [--mix upload=1,search=4,count=4,update=1,ocr=1] [--users N]
+        [--cloudinary-latency-ms MS] [--cloudinary-error-rate P]
+        [--ocr-latency-ms MS] [--ocr-error-rate P] [--ocr-mode route|first|best] [--jitter-ms MS]
+        [--out results.json] [--baseline old.json] [--regression-pct PCT]
+
+Starts the fakes (benchmarks/fakes.py) and the app under uvicorn on
+127.0.0.1, signs up bench users and seeds receipts, then drives the
+weighted mix of endpoints from N concurrent clients. It prints throughput
+and p50/p95/p99 latency per endpoint and writes them as JSON. With
+--baseline, any endpoint whose p95 grew by more than --regression-pct is
+reported and the exit status is 1.
+
+The app runs in ENV=local against a temporary SQLite file that is removed
+afterwards, never ./app.db. Seeding stops the run if a signup or seed
+upload fails or a user ends up without all its seed receipts.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+DEFAULT_IMAGE = os.path.join(os.path.dirname(__file__), os.pardir, "overflow", "test_image.jpeg")
+DEFAULT_MIX = "upload=1,search=4,count=4,update=1,ocr=1"
+ENDPOINTS = ("upload", "search", "count", "update", "ocr")
+
+
+def parse_mix(spec: str) -> dict:
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise SystemExit(f"unknown endpoint in --mix: {name!r} (choose from {', '.join(ENDPOINTS)})")
+        mix[name] = float(weight or 1)
+    return {k: v for k, v in mix.items() if v > 0}
+
+
+def percentile(sorted_values, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[k]
+
+
+def summarize(samples: dict, elapsed: float) -> dict:
+    """samples: endpoint -> list of (latency_ms, ok)."""
+    out = {}
+    for name, rows in sorted(samples.items()):
+        latencies = sorted(ms for ms, _ in rows)
+        errors = sum(1 for _, ok in rows if not ok)
+        out[name] = {
+            "requests": len(rows),
+            "errors": errors,
+            "error_rate": round(errors / len(rows), 4) if rows else 0.0,
+            "rps": round(len(rows) / elapsed, 2) if elapsed else 0.0,
+            "mean_ms": round(sum(latencies) / len(latencies), 1) if latencies else 0.0,
+            "p50_ms": round(percentile(latencies, 50), 1),
+            "p95_ms": round(percentile(latencies, 95), 1),
+            "p99_ms": round(percentile(latencies, 99), 1),
+            "max_ms": round(latencies[-1], 1) if latencies else 0.0,
+        }
+    return out
+
+
+class Bench:
+    def __init__(self, base_url: str, args, image: bytes, asset_url: str):
+        self.base_url = base_url
+        self.asset_url = asset_url
+        self.args = args
+        self.image = image
+        self.run_id = uuid.uuid4().hex[:6]
+        self.users = []  # (cookies, [public_id, ...])
+
+    async def setup(self, client):
+        import main  # the app is already imported by the server thread
+
+        for n in range(self.args.users):
+            username = f"bench-{self.run_id}-{n}"
+            resp = await client.post("/signup", data={
+                "username": username, "insurance_companies": "Maccabi, Clalit", "family_members": "Dana, Avi",
+            })
+            if resp.status_code != 302 or "session" not in resp.cookies:
+                raise SystemExit(f"signup of {username} failed: HTTP {resp.status_code}")
+            cookies = dict(resp.cookies)
+            public_ids = []
+            for i in range(self.args.seed_receipts):
+                name = f"seed {n} {i}"
+                await self.seed_upload(client, cookies, name)
+                public_ids.append("uploads/" + main.safe_public_id(name, "2024-01-02"))
+            count = (await client.get("/count", cookies=cookies)).json().get("count")
+            if count != len(public_ids):
+                raise SystemExit(f"{username} has {count} receipts after seeding {len(public_ids)}")
+            self.users.append((cookies, public_ids))
+
+    async def seed_upload(self, client, cookies, name: str, attempts: int = 3):
+        # the upload page answers 200 either way; only "Uploaded:" means it was stored
+        for _ in range(attempts):
+            resp = await self.upload(client, cookies, name)
+            if resp.status_code == 200 and "Uploaded:" in resp.text:
+                return
+        raise SystemExit(f"seed upload {name!r} failed: HTTP {resp.status_code}")
+
+    async def upload(self, client, cookies, name: str):
+        return await client.post(
+            "/upload", cookies=cookies,
+            data={"name": name, "date": "2024-01-02", "action": "save", "insurance_company": "Maccabi",
+                  "sent_to_insurance_0": "Maccabi", "refund_company_0": "Maccabi", "refund_amount_0": "120"},
+            files={"image": ("receipt.jpg", self.image, "image/jpeg")},
+        )
+
+    async def call(self, client, endpoint: str):
+        cookies, public_ids = random.choice(self.users)
+        if endpoint == "upload":
+            return await self.upload(client, cookies, f"load {uuid.uuid4().hex[:8]}")
+        if endpoint == "search":
+            return await client.get("/search", cookies=cookies, params=random.choice([
+                {"name": "seed"}, {"refunded": "no"}, {"insurance_company": "Maccabi"}, {},
+            ]))
+        if endpoint == "count":
+            return await client.get("/count", cookies=cookies)
+        if endpoint == "update":
+            return await client.post("/update", cookies=cookies, data={
+                "public_id": random.sample(public_ids, min(2, len(public_ids))),
+                "sent_to_insurance": "yes", "insurance_company": "Clalit",
+            })
+        if endpoint == "ocr":
+            # a fresh asset each call (the fake's bytes differ per path), so nothing is served from the OCR cache
+            return await client.post("/api/ocr/ocr", cookies=cookies, params={
+                "file_url": f"{self.asset_url}/bench/{uuid.uuid4().hex}.jpg", "file_type": "jpg",
+                "mode": self.args.ocr_mode,
+            })
+        raise ValueError(endpoint)
+
+    async def run(self) -> dict:
+        import httpx
+
+        mix = parse_mix(self.args.mix)
+        names, weights = list(mix), list(mix.values())
+        samples = {name: [] for name in names}
+        limits = httpx.Limits(max_connections=self.args.concurrency + 4)
+        async with httpx.AsyncClient(base_url=self.base_url, timeout=120, limits=limits) as client:
+            await self.setup(client)
+
+            deadline = time.perf_counter() + self.args.duration if not self.args.requests else None
+            remaining = [self.args.requests]
+
+            def more() -> bool:
+                if deadline is not None:
+                    return time.perf_counter() < deadline
+                remaining[0] -= 1
+                return remaining[0] >= 0
+
+            async def worker():
+                while more():
+                    endpoint = random.choices(names, weights)[0]
+                    started = time.perf_counter()
+                    try:
+                        resp = await self.call(client, endpoint)
+                        ok = resp.status_code < 400
+                    except Exception:
+                        ok = False
+                    samples[endpoint].append(((time.perf_counter() - started) * 1000, ok))
+
+            started = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(self.args.concurrency)))
+            elapsed = time.perf_counter() - started
+
+        endpoints = summarize(samples, elapsed)
+        total = summarize({"all": [row for rows in samples.values() for row in rows]}, elapsed)["all"]
+        return {"elapsed_s": round(elapsed, 2), "total": total, "endpoints": endpoints}
+
+
+def start_app(port: int):
+    import uvicorn
+    import main
+
+    config = uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning", lifespan="on")
+    server = uvicorn.Server(config)
+    thread = threading.Thread(target=server.run, name="bench-app", daemon=True)
+    thread.start()
+    return server, thread
+
+
+def wait_ready(base_url: str, timeout: float = 60.0):
+    import httpx
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"{base_url}/ready", timeout=2).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise SystemExit(f"app did not become ready at {base_url} within {timeout:.0f}s")
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def compare(result: dict, baseline: dict, regression_pct: float) -> list:
+    regressions = []
+    for name, now in result["endpoints"].items():
+        before = baseline.get("endpoints", {}).get(name)
+        if not before or not before.get("p95_ms"):
+            continue
+        change = 100 * (now["p95_ms"] - before["p95_ms"]) / before["p95_ms"]
+        line = f"{name}: p95 {before['p95_ms']}ms -> {now['p95_ms']}ms ({change:+.1f}%)"
+        if change > regression_pct:
+            regressions.append(line)
+        print(("REGRESSION " if change > regression_pct else "           ") + line)
+    return regressions
+
+
+def print_table(result: dict):
+    print(f"{'endpoint':<10} {'reqs':>6} {'err':>5} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+    rows = list(result["endpoints"].items()) + [("all", result["total"])]
+    for name, r in rows:
+        print(f"{name:<10} {r['requests']:>6} {r['errors']:>5} {r['rps']:>8} "
+              f"{r['p50_ms']:>8} {r['p95_ms']:>8} {r['p99_ms']:>8} {r['max_ms']:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of load (ignored with --requests)")
+    parser.add_argument("--requests", type=int, default=0, help="stop after this many requests instead")
+    parser.add_argument("--mix", default=DEFAULT_MIX)
+    parser.add_argument("--users", type=int, default=4)
+    parser.add_argument("--seed-receipts", type=int, default=3)
+    parser.add_argument("--image", default=DEFAULT_IMAGE)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--cloudinary-latency-ms", type=float, default=150.0)
+    parser.add_argument("--cloudinary-error-rate", type=float, default=0.0)
+    parser.add_argument("--ocr-latency-ms", type=float, default=400.0)
+    parser.add_argument("--ocr-error-rate", type=float, default=0.0)
+    parser.add_argument("--ocr-mode", default="route", choices=("route", "first", "best"),
+                        help="mode passed to /api/ocr/ocr")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="uniform +/- jitter added to both fakes")
+    parser.add_argument("--out", default=None, help="JSON results path (default benchmarks/results/load-<time>.json)")
+    parser.add_argument("--baseline", default=None, help="earlier results JSON to compare p95 against")
+    parser.add_argument("--regression-pct", type=float, default=15.0)
+    args = parser.parse_args()
+
+    # before anything imports database; the bench never touches the developer's ./app.db
+    db_dir = tempfile.mkdtemp(prefix="load-bench-")
+    os.environ["ENV"] = "local"
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(db_dir, 'bench.db')}"
+
+    from benchmarks.fakes import Faults, FakeCloudinary, FakeGoogleOcr, point_app_at_fakes
+
+    cloudinary_fake = FakeCloudinary(Faults(args.cloudinary_latency_ms, args.jitter_ms, args.cloudinary_error_rate)).start()
+    ocr_fake = FakeGoogleOcr(Faults(args.ocr_latency_ms, args.jitter_ms, args.ocr_error_rate)).start()
+
+    # the app reads these at startup; point_app_at_fakes then redirects the SDKs
+    os.environ.setdefault("CLOUDINARY_CLOUD_NAME", "bench")
+    os.environ.setdefault("CLOUDINARY_API_KEY", "bench")
+    os.environ.setdefault("CLOUDINARY_API_SECRET", "bench")
+    os.environ.setdefault("OCR_WARMUP", "0")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+    base_url = f"http://127.0.0.1:{args.port}"
+    server, thread = start_app(args.port)
+    wait_ready(base_url)
+    point_app_at_fakes(cloudinary_fake.url, ocr_fake.url, ocr_fake.grpc_target)
+
+    with open(args.image, "rb") as f:
+        image = f.read()
+
+    result = asyncio.run(Bench(base_url, args, image, f"{cloudinary_fake.url}/assets").run())
+    server.should_exit = True
+    thread.join(10)
+
+    result.update({
+        "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "git_commit": git_commit(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("out", "baseline")},
+        "fakes": {"cloudinary": cloudinary_fake.stats(), "google_ocr": ocr_fake.stats()},
+    })
+    cloudinary_fake.stop()
+    ocr_fake.stop()
+    shutil.rmtree(db_dir, ignore_errors=True)
+
+    print_table(result)
+    out = args.out or os.path.join(
+        os.path.dirname(__file__), "results", f"load-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"results written to {out}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.regression_pct)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
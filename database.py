@@ -1,26 +1,63 @@
 import os
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker, declarative_base
 from dotenv import load_dotenv
+from db_pool import TimedQueuePool, instrument_pool
+from db_timing import instrument_queries
 
 load_dotenv()
 
 ENV = os.getenv("ENV", "local")
 
+# Pool sizing; defaults are per environment and can be overridden with env vars
+_POOL_DEFAULTS = {
+    "local": {"size": 5, "overflow": 5, "timeout": 10},
+    "production": {"size": 10, "overflow": 10, "timeout": 5},
+}
+_pool = _POOL_DEFAULTS.get(ENV, _POOL_DEFAULTS["production"])
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", _pool["size"]))
+MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", _pool["overflow"]))
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", _pool["timeout"]))
+POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
 if ENV == "local":
-    DATABASE_URL = "sqlite:///./app.db"
+    # local mode is always SQLite; a sqlite:// DATABASE_URL picks another file (the load bench uses a temp one)
+    DATABASE_URL = os.getenv("DATABASE_URL", "")
+    if not DATABASE_URL.startswith("sqlite"):
+        DATABASE_URL = "sqlite:///./app.db"
     engine = create_engine(
         DATABASE_URL,
-        connect_args={"check_same_thread": False}
+        connect_args={"check_same_thread": False},
+        poolclass=TimedQueuePool,
+        pool_size=POOL_SIZE,
+        max_overflow=MAX_OVERFLOW,
+        pool_timeout=POOL_TIMEOUT,
     )
+
+    @event.listens_for(engine, "connect")
+    def _sqlite_pragmas(dbapi_connection, connection_record):
+        # WAL lets readers run while a writer commits; busy_timeout waits for locks instead of failing
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
 else:
     DATABASE_URL = os.environ["DATABASE_URL"]
     engine = create_engine(
         DATABASE_URL,
         pool_pre_ping=True,
+        poolclass=TimedQueuePool,
+        pool_size=POOL_SIZE,
+        max_overflow=MAX_OVERFLOW,
+        pool_timeout=POOL_TIMEOUT,
+        pool_recycle=POOL_RECYCLE,
         connect_args={"sslmode": "require"},
-        echo=True   # TEMPORARY
     )
 
+instrument_pool(engine)
+instrument_queries(engine)
+
 SessionLocal = sessionmaker(bind=engine)
-Base = declarative_base()
\ No newline at end of file
+Base = declarative_base()
@@ -0,0 +1,98 @@
+import logging
+import os
+import threading
+import time
+import traceback
+
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger('kabala')
+
+# a checkout held longer than this is reported as a probable leak
+DB_LEAK_SECONDS = float(os.getenv("DB_LEAK_SECONDS", "30"))
+# capture the stack of every checkout so leaks can be traced back (costly, off by default)
+DB_LEAK_TRACEBACK = os.getenv("DB_LEAK_TRACEBACK", "0") == "1"
+
+_lock = threading.Lock()
+_stats = {
+    "checkouts": 0,
+    "wait_total_ms": 0.0,
+    "wait_max_ms": 0.0,
+    "timeouts": 0,
+    "leaks_reported": 0,
+}
+# id(connection record) -> (checked out at, stack or None)
+_held = {}
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long callers wait for a connection."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except Exception:
+            with _lock:
+                _stats["timeouts"] += 1
+            raise
+        finally:
+            waited = (time.perf_counter() - started) * 1000
+            with _lock:
+                _stats["wait_total_ms"] += waited
+                _stats["wait_max_ms"] = max(_stats["wait_max_ms"], waited)
+
+
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    stack = ''.join(traceback.format_stack(limit=12)) if DB_LEAK_TRACEBACK else None
+    with _lock:
+        _stats["checkouts"] += 1
+        _held[id(connection_record)] = (time.monotonic(), stack)
+
+
+def _on_checkin(dbapi_connection, connection_record):
+    with _lock:
+        entry = _held.pop(id(connection_record), None)
+    if entry is None:
+        return
+    held_for = time.monotonic() - entry[0]
+    if held_for > DB_LEAK_SECONDS:
+        with _lock:
+            _stats["leaks_reported"] += 1
+        logger.warning(f"DB connection was held for {held_for:.1f}s before being returned to the pool")
+
+
+def instrument_pool(engine):
+    event.listen(engine, "checkout", _on_checkout)
+    event.listen(engine, "checkin", _on_checkin)
+
+
+def find_leaks() -> list:
+    """Checkouts currently held for longer than DB_LEAK_SECONDS."""
+    now = time.monotonic()
+    with _lock:
+        held = list(_held.values())
+    leaks = [{"held_s": round(now - t, 1), "stack": stack} for t, stack in held if now - t > DB_LEAK_SECONDS]
+    for leak in leaks:
+        logger.warning(f"Possible DB connection leak, held for {leak['held_s']}s" + (f"\n{leak['stack']}" if leak["stack"] else ''))
+    return leaks
+
+
+def pool_stats(engine) -> dict:
+    pool = engine.pool
+    with _lock:
+        stats = dict(_stats)
+    stats["wait_avg_ms"] = round(stats["wait_total_ms"] / stats["checkouts"], 2) if stats["checkouts"] else 0.0
+    stats["wait_total_ms"] = round(stats["wait_total_ms"], 1)
+    stats["wait_max_ms"] = round(stats["wait_max_ms"], 1)
+    if isinstance(pool, QueuePool):
+        stats.update({
+            "size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "checked_in": pool.checkedin(),
+            "overflow": max(pool.overflow(), 0),
+            "max_overflow": pool._max_overflow,
+        })
+    stats["leaks"] = len(find_leaks())
+    return stats
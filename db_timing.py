@@ -0,0 +1,53 @@
+import logging
+import os
+import time
+
+from sqlalchemy import event
+
+from metrics import db_query_duration
+
+logger = logging.getLogger('kabala.sql')
+
+# statements slower than this are logged with their SQL; 0 disables
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "500"))
+SLOW_QUERY_SQL_CHARS = 2000
+
+
+_STATEMENT_TYPES = {"SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "BEGIN", "COMMIT", "ROLLBACK", "PRAGMA"}
+
+
+def _statement_type(statement: str) -> str:
+    word = statement.lstrip()[:10].split(None, 1)
+    word = word[0].upper() if word else ""
+    # anything unusual (DDL, SAVEPOINT, ...) shares one label
+    return word if word in _STATEMENT_TYPES else "OTHER"
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["query_started"].pop()
+    elapsed = time.perf_counter() - started
+    db_query_duration.observe(elapsed, _statement_type(statement))
+    elapsed_ms = elapsed * 1000
+    if SLOW_QUERY_MS and elapsed_ms >= SLOW_QUERY_MS:
+        logger.warning(
+            f"Slow query ({elapsed_ms:.0f}ms): {statement[:SLOW_QUERY_SQL_CHARS]}",
+            extra={"duration_ms": round(elapsed_ms, 1)},
+        )
+
+
+def _handle_error(exception_context):
+    # the after hook does not run for a failed statement
+    conn = exception_context.connection
+    if conn is not None and conn.info.get("query_started"):
+        conn.info["query_started"].pop()
+
+
+def instrument_queries(engine):
+    """Time every statement on engine and log the slow ones."""
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
@@ -7,11 +7,22 @@ def get_db():
     db = SessionLocal()
     try:
         yield db
-        logger.info("DB dependency completed, committing")
+        logger.debug("DB dependency completed, committing")
         db.commit()
     except Exception:
         logger.error("DB dependency rollback triggered", exc_info=True)
         db.rollback()
         raise
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+async def get_async_db():
+    from async_database import AsyncSessionLocal
+    async with AsyncSessionLocal() as db:
+        try:
+            yield db
+            await db.commit()
+        except Exception:
+            logger.error("Async DB dependency rollback triggered", exc_info=True)
+            await db.rollback()
+            raise
@@ -1,20 +1,70 @@
+from langchain_core.runnables import RunnableLambda
 from langgraph.graph import StateGraph, END
 from graph_state import OCRState
-from nodes.vision_ocr import vision_ocr_node
-from nodes.document_ai_ocr import document_ai_ocr_node
-from nodes.router import ocr_router
+from nodes.vision_ocr import vision_ocr_node, vision_ocr_node_async
+from nodes.document_ai_ocr import document_ai_ocr_node, document_ai_ocr_node_async
+from nodes.router import ocr_router, route_by_type
+from nodes.local_ocr import local_ocr_node, local_ocr_node_async, local_router, escalation_tier
+from nodes.fanout import make_fanout_node, make_async_fanout_node
+from nodes.extract_fields import extract_fields_node
+from ocr_cache import cached_ocr_node
+from metrics import observed_ocr_node
 
-def build_ocr_graph():
+
+def _both(name, sync_node, async_node):
+    # graph.invoke (the job worker) runs sync_node, graph.ainvoke (the API) runs async_node
+    return RunnableLambda(sync_node, afunc=async_node, name=name)
+
+
+def build_ocr_graph(checkpointer=None):
     graph = StateGraph(OCRState)
-    graph.add_node("vision", vision_ocr_node)
-    graph.add_node("document_ai", document_ai_ocr_node)
+    vision = {}
+    document_ai = {}
+    for mode, vision_node, document_ai_node in (
+        ("sync", vision_ocr_node, document_ai_ocr_node),
+        ("async", vision_ocr_node_async, document_ai_ocr_node_async),
+    ):
+        vision[mode] = observed_ocr_node("vision", cached_ocr_node("vision_api")(vision_node))
+        document_ai[mode] = observed_ocr_node("document_ai", cached_ocr_node("document_ai")(document_ai_node))
+
+    graph.add_node("local", _both(
+        "local", observed_ocr_node("local", local_ocr_node), observed_ocr_node("local", local_ocr_node_async),
+    ))
+    graph.add_node("vision", _both(
+        "vision", escalation_tier("vision", vision["sync"]), escalation_tier("vision", vision["async"]),
+    ))
+    graph.add_node("document_ai", _both(
+        "document_ai",
+        escalation_tier("document_ai", document_ai["sync"]),
+        escalation_tier("document_ai", document_ai["async"]),
+    ))
+    graph.add_node("fanout", _both(
+        "fanout",
+        make_fanout_node({"vision_api": vision["sync"], "document_ai": document_ai["sync"]}),
+        make_async_fanout_node({"vision_api": vision["async"], "document_ai": document_ai["async"]}),
+    ))
+    graph.add_node("extract", extract_fields_node)
     graph.set_conditional_entry_point(
         ocr_router,
         {
             "vision": "vision",
-            "document_ai": "document_ai"
+            "document_ai": "document_ai",
+            "fanout": "fanout",
+            "local": "local",
+        }
+    )
+    graph.add_conditional_edges(
+        "local",
+        lambda state: local_router(state, route_by_type),
+        {
+            "done": "extract",
+            "vision": "vision",
+            "document_ai": "document_ai",
         }
     )
-    graph.add_edge("vision", END)
+    # document_ai returns its processor's entities; the text engines go through extract
+    graph.add_edge("vision", "extract")
+    graph.add_edge("fanout", "extract")
     graph.add_edge("document_ai", END)
-    return graph.compile()
+    graph.add_edge("extract", END)
+    return graph.compile(checkpointer=checkpointer)
@@ -3,6 +3,9 @@ from typing import TypedDict, Optional
 class OCRState(TypedDict):
     file_url: str
     file_type: str
+    content_hash: Optional[str]
     raw_text: Optional[str]
     structured_data: Optional[dict]
     metadata: dict
+    # None/"route": pick the engine by file_type; "first"/"best": run both (nodes/fanout.py)
+    ocr_mode: Optional[str]
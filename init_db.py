@@ -1,5 +1,21 @@
-from database import engine, Base
-from models import User, Receipt
+import logging
+
+from sqlalchemy import text
+
+from database import engine
+from migrations import upgrade
 
 def ensure_db():
-    Base.metadata.create_all(bind=engine)
+    # versioned migrations replace Base.metadata.create_all
+    upgrade(engine)
+
+
+def log_db_identity(engine):
+    """Log which database this process is talking to."""
+    logger = logging.getLogger('kabala')
+    if engine.dialect.name == "postgresql":
+        with engine.connect() as conn:
+            result = conn.execute(text("SELECT current_database(), current_schema(), inet_server_addr()"))
+            logger.info(f"DB IDENTITY: {result.fetchone()}")
+    else:
+        logger.info(f"DB IDENTITY: {engine.dialect.name} {engine.url.database}")
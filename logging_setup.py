@@ -0,0 +1,231 @@
+"""Queue-based JSON logging.
+
+Handlers only put records on a queue; a QueueListener thread does the
+formatting and the file/console writes, so request handlers never block on
+log I/O. Every record carries the id of the request that emitted it.
+
+Environment:
+  LOG_LEVEL         level for the kabala logger (default INFO)
+  LOG_FORMAT        json (default) or text
+  LOG_SAMPLE        per-logger sampling of INFO/DEBUG, e.g. "kabala.db=0.1,depts=0"
+  LOG_RATE_LIMIT    per-logger records per second, e.g. "kabala.upload=20"
+"""
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+LOG_DIR = os.path.join(os.path.dirname(__file__), 'logs')
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+
+request_id_var: contextvars.ContextVar = contextvars.ContextVar("request_id", default=None)
+
+_listener = None
+_setup_lock = threading.Lock()
+
+# attributes every LogRecord has; anything else came in through extra=
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "request_id"}
+
+
+def _parse_rules(spec: str) -> dict:
+    rules = {}
+    for part in (spec or "").split(","):
+        name, _, value = part.partition("=")
+        if name.strip() and value.strip():
+            try:
+                rules[name.strip()] = float(value)
+            except ValueError:
+                pass
+    return rules
+
+
+def _rule_for(rules: dict, name: str):
+    # most specific dotted prefix wins: "kabala.db" before "kabala"
+    while name:
+        if name in rules:
+            return rules[name]
+        name = name.rpartition(".")[0]
+    return None
+
+
+class RequestIdFilter(logging.Filter):
+    """Stamp the current request id on the record in the emitting thread."""
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Drop a share of INFO/DEBUG records per logger and cap their rate.
+
+    Warnings and errors always pass. How many records a rate limit dropped
+    is reported on the next record that gets through.
+    """
+
+    def __init__(self, sample: dict, rate: dict):
+        super().__init__()
+        self.sample = sample
+        self.rate = rate
+        self._buckets = {}  # logger name -> [tokens, last refill, dropped]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        ratio = _rule_for(self.sample, record.name)
+        if ratio is not None and random.random() >= ratio:
+            return False
+        limit = _rule_for(self.rate, record.name)
+        if limit is None:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.setdefault(record.name, [limit, now, 0])
+            bucket[0] = min(limit, bucket[0] + (now - bucket[1]) * limit)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1
+            if bucket[2]:
+                record.suppressed = bucket[2]
+                bucket[2] = 0
+        return True
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record):
+        # merge the args here, while they still hold their current values, but
+        # leave the formatting (and the JSON encoding) to the listener thread
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+            "thread": record.threadName,
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+def _formatter():
+    if LOG_FORMAT == "json":
+        return JsonFormatter()
+    return logging.Formatter(
+        '%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+
+
+def configure_logging(log_file: bool = True):
+    """Route every logger through one queue; safe to call more than once."""
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return
+
+        formatter = _formatter()
+        handlers = []
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(formatter)
+        handlers.append(console_handler)
+        if log_file:
+            os.makedirs(LOG_DIR, exist_ok=True)
+            file_handler = RotatingFileHandler(
+                os.path.join(LOG_DIR, 'app.log'),
+                maxBytes=10_000_000,  # 10MB
+                backupCount=5
+            )
+            file_handler.setFormatter(formatter)
+            handlers.append(file_handler)
+
+        log_queue = queue.SimpleQueue()
+        queue_handler = _QueueHandler(log_queue)
+        queue_handler.addFilter(RequestIdFilter())
+        queue_handler.addFilter(SamplingFilter(
+            _parse_rules(os.getenv("LOG_SAMPLE", "")),
+            _parse_rules(os.getenv("LOG_RATE_LIMIT", "")),
+        ))
+
+        root = logging.getLogger()
+        for h in list(root.handlers):
+            root.removeHandler(h)
+        root.addHandler(queue_handler)
+        root.setLevel(logging.WARNING)
+        logging.getLogger('kabala').setLevel(LOG_LEVEL)
+
+        _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Flush the queue and stop the writer thread."""
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+class RequestIdMiddleware:
+    """Give every request an id (from X-Request-ID or a new one) for its log lines."""
+
+    header = b"x-request-id"
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        request_id = None
+        for name, value in scope.get("headers", ()):
+            if name == self.header:
+                request_id = value.decode("latin-1")[:64]
+                break
+        request_id = request_id or uuid.uuid4().hex
+        token = request_id_var.set(request_id)
+        scope.setdefault("state", {})["request_id"] = request_id
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(self.header, request_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            request_id_var.reset(token)
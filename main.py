@@ -1,161 +1,181 @@
-from fastapi import FastAPI, UploadFile, File, Form, Request, Depends
-from fastapi.responses import JSONResponse, RedirectResponse
+import time
+_import_started = time.perf_counter()
+
+from dotenv import load_dotenv
+# Load environment variables from .env if present; modules below read them at import
+load_dotenv()
+
+from logging_setup import configure_logging, RequestIdMiddleware
+# before the imports below, so warnings they log at import go through the queue too
+configure_logging()
+
+from fastapi import FastAPI, APIRouter, UploadFile, File, Form, Request, Depends
+from fastapi.routing import APIRoute
+from fastapi.responses import JSONResponse, RedirectResponse, PlainTextResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 import os
-from dotenv import load_dotenv
 import re
 import json
 from datetime import datetime, timedelta
 import cloudinary
 import cloudinary.uploader
+import cloudinary.api
 from typing import Optional
 import sqlite3
-from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+import threading
+from sqlalchemy import delete, text
+from sqlalchemy.dialects import postgresql, sqlite
 import logging
-from logging.handlers import RotatingFileHandler
-from models import User, Receipt
+from models import User, Receipt, ReceiptInsuranceCompany
 from datetime import datetime
-from init_db import ensure_db
-from depts import get_db
-from database import SessionLocal, engine
-# Load environment variables from .env if present
-load_dotenv()
-from pathlib import Path
-
-from admin.views import setup_admin
+from depts import get_db, get_async_db
+from database import engine
+from db_pool import pool_stats
+from receipt_search import search_receipts, search_receipts_async, receipt_to_resource
+from async_database import ASYNC_DB_ENABLED
+import async_crud as adb
+from receipt_types import parse_date, parse_timestamp, refund_total
+from receipt_counts import get_receipt_count, adjust_receipt_count
+from upload_pipeline import run_stage, log_timings
+from ocr_worker import OcrWorkerPool, enqueue_ocr_job, file_type_for
+from ocr_clients import warmup as warmup_ocr_clients
+from ocr_cache import get_cached_ocr
+from nodes.extract_fields import merge_fields
+from image_prep import normalize_image
+from upload_ingest import UploadSizeLimitMiddleware, UploadTooLarge, ingest, CLOUDINARY_CHUNK_BYTES
+from user_session import SessionUserMiddleware, current_user, invalidate_user, set_session_cookie, clear_session_cookie
 from api.ocr import router as ocr_router
+import startup as app_startup
+import metrics
+from metrics import RequestMetricsMiddleware, cloudinary_call, timed_cloudinary
 
-def setup_google_credentials():
-    creds_json = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS_JSON")
-    if not creds_json:
-        return
-
-    creds_path = Path("/tmp/google-creds.json")
-    creds_path.write_text(creds_json)
-
-    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = str(creds_path)
-
-setup_google_credentials()
-
-import logging
+app = FastAPI(title="Receipt Uploader (FastAPI + Cloudinary)")
+app.add_middleware(UploadSizeLimitMiddleware, paths=("/upload",))
+app.add_middleware(SessionUserMiddleware)
+app.add_middleware(RequestIdMiddleware)
+app.add_middleware(RequestMetricsMiddleware)
+app.include_router(ocr_router, prefix="/api/ocr")
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s"
-)
 
 
+ocr_workers = None
 
-app = FastAPI(title="Receipt Uploader (FastAPI + Cloudinary)")
-app.include_router(ocr_router, prefix="/api/ocr")
 
+def warmup_ocr():
+    """Open the OCR client channels and build the graph off the request path."""
+    try:
+        with app_startup.timed_phase("ocr_clients_warmup"):
+            warmup_ocr_clients()
+        app_startup.ocr_graph.get()
+    except Exception:
+        logger.warning('OCR warmup failed', exc_info=True)
 
 
 @app.on_event("startup")
 def startup():
-    setup_admin(app, engine)
-    ensure_db()
-
-# Configure logging
-LOG_DIR = os.path.join(os.path.dirname(__file__), 'logs')
-os.makedirs(LOG_DIR, exist_ok=True)
+    global ocr_workers
+    app_startup.record_phase("import", (time.perf_counter() - _import_started) * 1000)
+    app_startup.cloudinary_config.get()
+    with app_startup.timed_phase("admin"):
+        from admin.views import setup_admin
+        setup_admin(app, engine)
+    app_startup.database.get()
+    # warming up imports google.cloud and langgraph; /ready does not wait for it
+    if os.getenv("OCR_WARMUP", "1") != "0":
+        threading.Thread(target=warmup_ocr, name="ocr-warmup", daemon=True).start()
+    # set OCR_INPROCESS_WORKERS=0 when running `python -m ocr_worker` separately
+    if os.getenv("OCR_INPROCESS_WORKERS", "1") != "0":
+        with app_startup.timed_phase("ocr_workers"):
+            ocr_workers = OcrWorkerPool()
+            ocr_workers.start()
+    app_startup.log_startup_report()
+
+
+@app.on_event("shutdown")
+def shutdown():
+    if ocr_workers:
+        ocr_workers.stop()
 
 logger = logging.getLogger('kabala')
-logger.setLevel(logging.DEBUG)
-
-# File handler with rotation
-file_handler = RotatingFileHandler(
-    os.path.join(LOG_DIR, 'app.log'),
-    maxBytes=10_000_000,  # 10MB
-    backupCount=5
-)
-file_handler.setLevel(logging.DEBUG)
-
-# Console handler
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO)
-
-# Formatter
-formatter = logging.Formatter(
-    '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
-file_handler.setFormatter(formatter)
-console_handler.setFormatter(formatter)
-
-logger.addHandler(file_handler)
-logger.addHandler(console_handler)
 
 logger.info('Application started')
 
-from sqlalchemy import text
+# Templates
+templates = Jinja2Templates(directory="templates")
 
-with engine.connect() as conn:
-    result = conn.execute(text("SELECT current_database(), current_schema(), inet_server_addr()"))
-    logger.info(f"DB IDENTITY: {result.fetchone()}")
 
 
-# Templates
-templates = Jinja2Templates(directory="templates")
+def get_verified_cookies(request: Request) -> tuple[Optional[str], Optional[str]]:
+    """Return (user_id, username) for the session SessionUserMiddleware resolved, or (None, None)."""
+    user = current_user(request)
+    if user is None:
+        return None, None
+    return str(user.user_id), user.username
 
 
+def safe_public_id(name: str, date_str: str) -> str:
+    base = f"{name}_{date_str}"
+    base = base.strip().replace(' ', '_')
+    base = re.sub(r'[^A-Za-z0-9_\-]', '', base)
+    return base[:200]
 
-# Cloudinary configuration
-cloud_name = os.environ.get('CLOUDINARY_CLOUD_NAME')
-api_key = os.environ.get('CLOUDINARY_API_KEY')
-api_secret = os.environ.get('CLOUDINARY_API_SECRET')
 
-if not (cloud_name and api_key and api_secret):
-    logger.warning('Cloudinary credentials are not set in environment variables')
+# Request parsing and responses shared by the sync handlers below and their
+# async versions at the bottom of this file; only the database calls differ.
 
-cloudinary.config(
-    cloud_name=cloud_name,
-    api_key=api_key,
-    api_secret=api_secret,
-    secure=True,
-)
+def session_user_id(request: Request) -> tuple[Optional[int], Optional[str]]:
+    """(user_id, username) of the session; user_id is None when there is none or it is malformed."""
+    user_id, username = get_verified_cookies(request)
+    if not user_id or not username:
+        return None, username
+    try:
+        return int(user_id), username
+    except (ValueError, TypeError):
+        return None, username
 
-# Cookie signing with itsdangerous
-SECRET_KEY = os.environ.get('SECRET_KEY')
-if not SECRET_KEY:
-    # Generate a default key (use env var in production!)
-    import secrets
-    SECRET_KEY = secrets.token_urlsafe(32)
-    logger.warning('SECRET_KEY not set in environment. Using generated key (not persistent).')
 
-serializer = URLSafeTimedSerializer(SECRET_KEY, salt='cookie-signer')
+def index_page(request: Request, username: Optional[str], count: int):
+    user_data = current_user(request)
 
+    family_members = user_data.family_member_names if user_data else []
+    insurance_companies = user_data.insurance_company_names if user_data else []
 
-def sign_cookie_value(value: str) -> str:
-    """Sign a cookie value for security."""
-    return serializer.dumps(value)
+    return templates.TemplateResponse('index.html', {"request": request, "count": count, "username": username, "family_members": family_members, "insurance_companies": insurance_companies})
 
 
-def verify_cookie_value(signed_value: str, max_age: int = None) -> Optional[str]:
-    """Verify and unsign a cookie value. Returns None if invalid."""
-    try:
-        return serializer.loads(signed_value, max_age=max_age)
-    except (BadSignature, SignatureExpired):
-        return None
+def login_response(request: Request, username: str, user_data):
+    if not user_data:
+        logger.warning(f'Login attempt with non-existent username: {username}')
+        return templates.TemplateResponse('login.html', {"request": request, "message": "Username not found"})
 
+    user_id = user_data.user_id
+    logger.info(f'User login successful: username={username}, user_id={user_id}')
+    resp = RedirectResponse(url='/', status_code=302)
+    set_session_cookie(resp, user_id, username, secure=True)
+    return resp
 
-def get_verified_cookies(request: Request) -> tuple[Optional[str], Optional[str]]:
-    """Safely get and verify user_id and username cookies. Returns (user_id, username) or (None, None)."""
-    user_id_signed = request.cookies.get('user_id')
-    username_signed = request.cookies.get('username')
-    
-    user_id = verify_cookie_value(user_id_signed) if user_id_signed else None
-    username = verify_cookie_value(username_signed) if username_signed else None
-    
-    return user_id, username
 
+def profile_fields(email, phone, family_members, insurance_companies) -> dict:
+    return {
+        'email': email or '',
+        'phone': phone or '',
+        'family_members': family_members or '',
+        'insurance_companies': insurance_companies or ''
+    }
 
-def safe_public_id(name: str, date_str: str) -> str:
-    base = f"{name}_{date_str}"
-    base = base.strip().replace(' ', '_')
-    base = re.sub(r'[^A-Za-z0-9_\-]', '', base)
-    return base[:200]
+
+def profile_redirect(message: str):
+    # Redirect back to profile page with message
+    resp = RedirectResponse(url='/profile', status_code=302)
+    resp.set_cookie('profile_message', message, httponly=True, )
+    return resp
+
+
+def search_page(request: Request, username: str, filters: dict, results=None, error=None):
+    if error is not None:
+        return templates.TemplateResponse('index.html', {"request": request, "message": f"Search failed: {error}", "results": [], "username": username})
+    return templates.TemplateResponse('index.html', {"request": request, "results": results, **filters, "username": username})
 
 
 @app.get("/health", response_class=JSONResponse)
@@ -163,58 +183,66 @@ def health_check():
     return {"status": "ok", "message": "API running"}
 
 
+@app.get("/ready", response_class=JSONResponse)
+def readiness_check():
+    """Ready once the DB is migrated and reachable; /health only says the process is up."""
+    report = app_startup.startup_report()
+    if not app_startup.database.done:
+        return JSONResponse({"ready": False, "reason": "database not initialized", "startup": report}, status_code=503)
+    try:
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+    except Exception as e:
+        return JSONResponse({"ready": False, "reason": f"database unreachable: {e}", "startup": report}, status_code=503)
+    return {"ready": True, "startup": report}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@metrics.register_collector
+def _pool_metrics():
+    stats = pool_stats(engine)
+    gauges = [
+        ("db_pool_checked_out", "gauge", "Connections currently checked out", "checked_out"),
+        ("db_pool_overflow", "gauge", "Overflow connections currently open", "overflow"),
+        ("db_pool_checkouts_total", "counter", "Connection checkouts", "checkouts"),
+        ("db_pool_timeouts_total", "counter", "Checkouts that timed out waiting for a connection", "timeouts"),
+    ]
+    return [(name, kind, help, [({}, stats[key])]) for name, kind, help, key in gauges if key in stats]
+
+
+@app.get("/health/db", response_class=JSONResponse)
+def db_pool_health():
+    return pool_stats(engine)
+
+
 @app.get('/')
 def ui(request: Request,
        db=Depends(get_db)):
-    user_id, username = get_verified_cookies(request)
+    user_id, username = session_user_id(request)
     
-    # get current count of images in Cloudinary uploads folder for this user
-    if user_id and username:
+    # get current count of receipts for this user
+    count = 0
+    if user_id is not None:
         try:
-            uid = int(user_id)
-        except (ValueError, TypeError):
-            uid = None
-        
-        if uid:
-            try:
-                search_result = cloudinary.Search().expression(f"folder:uploads AND context.user_id:{uid}").max_results(1).execute()
-                count = search_result.get('total_count') or search_result.get('total') or len(search_result.get('resources', []))
-            except Exception:
-                count = 0
-        else:
+            count = get_receipt_count(db, user_id)
+        except Exception:
             count = 0
-    else:
-        count = 0
 
-    user_data = get_user_db(db, username) if username else None
-    
-    # parse user data lists into arrays
-    family_members = []
-    insurance_companies = []
-    if user_data:
-        if user_data.family_members:
-            family_members = [x.strip() for x in user_data.family_members.split(',') if x.strip()]
-        if user_data.insurance_companies:
-            insurance_companies = [x.strip() for x in user_data.insurance_companies.split(',') if x.strip()]
-    
-    return templates.TemplateResponse('index.html', {"request": request, "count": count, "username": username, "family_members": family_members, "insurance_companies": insurance_companies})
+    return index_page(request, username, count)
 
 
 @app.get('/count')
-def count_endpoint(request: Request):
-    user_id, username = get_verified_cookies(request)
-    if not user_id or not username:
+def count_endpoint(request: Request, db=Depends(get_db)):
+    user_id, _ = session_user_id(request)
+    if user_id is None:
         return JSONResponse({"count": 0})
     
     try:
-        user_id = int(user_id)
-    except (ValueError, TypeError):
-        return JSONResponse({"count": 0})
-    
-    try:
-        search_result = cloudinary.Search().expression(f"folder:uploads AND context.user_id:{user_id}").max_results(1).execute()
-        cnt = search_result.get('total_count') or search_result.get('total') or len(search_result.get('resources', []))
-        return JSONResponse({"count": cnt})
+        return JSONResponse({"count": get_receipt_count(db, user_id)})
     except Exception as e:
         return JSONResponse({"error": str(e), "count": 0}, status_code=500)
 
@@ -247,9 +275,10 @@ def signup_post(request: Request, username: str = Form(...), phone: Optional[str
         return templates.TemplateResponse('signup.html', {"request": request, "message": "Username already exists. Please try another or sign in."})
     
     # try:
+    # committed here, not in get_db's teardown: the redirect's next request
+    # must find the user, and get_db only commits after the response is sent
     insert_user(db, username, phone or '', email or '', family_members or '', insurance_companies or '')
-    db.flush()
-    logger.info("Session flushed")
+    logger.info("User committed")
         # Get the new use's ID
     logger.info("Fetching user after insert")
     user_data = get_user_db(db, username)
@@ -263,8 +292,7 @@ def signup_post(request: Request, username: str = Form(...), phone: Optional[str
     
     # auto login
     resp = RedirectResponse(url='/', status_code=302)
-    resp.set_cookie('user_id', sign_cookie_value(str(user_id)), httponly=True, secure=False, samesite='lax')
-    resp.set_cookie('username', sign_cookie_value(username), httponly=True, secure=False, samesite='lax')
+    set_session_cookie(resp, user_id, username, secure=False)
     logger.info("Signup completed, returning response")
     return resp
 
@@ -272,17 +300,7 @@ def signup_post(request: Request, username: str = Form(...), phone: Optional[str
 @app.post('/login')
 def login_post(request: Request, username: str = Form(...), 
                db=Depends(get_db)):
-    user_data = get_user_db(db, username)
-    if not user_data:
-        logger.warning(f'Login attempt with non-existent username: {username}')
-        return templates.TemplateResponse('login.html', {"request": request, "message": "Username not found"})
-    
-    user_id = user_data.user_id
-    logger.info(f'User login successful: username={username}, user_id={user_id}')
-    resp = RedirectResponse(url='/', status_code=302)
-    resp.set_cookie('user_id', sign_cookie_value(str(user_id)), httponly=True, secure=True, samesite='lax')
-    resp.set_cookie('username', sign_cookie_value(username), httponly=True, secure=True, samesite='lax')
-    return resp
+    return login_response(request, username, get_user_db(db, username))
 
 
 @app.get('/logout')
@@ -290,8 +308,7 @@ def logout(request: Request):
     user_id, username = get_verified_cookies(request)
     logger.info(f'User logout: username={username}, user_id={user_id}')
     resp = RedirectResponse(url='/login', status_code=302)
-    resp.delete_cookie('user_id')
-    resp.delete_cookie('username')
+    clear_session_cookie(resp)
     return resp
 
 
@@ -302,17 +319,12 @@ def profile_get(request: Request,
     if not user_id or not username:
         return RedirectResponse(url='/login', status_code=302)
     
-    user_data = get_user_db(db, username)
+    user_data = current_user(request)
     if not user_data:
         return templates.TemplateResponse('profile.html', {"request": request, "message": "User not found"})
     
-    # Parse lists
-    family_members = []
-    insurance_companies = []
-    if user_data.family_members:
-        family_members = [x.strip() for x in user_data.family_members.split(',') if x.strip()]
-    if user_data.insurance_companies:
-        insurance_companies = [x.strip() for x in user_data.insurance_companies.split(',') if x.strip()]
+    family_members = user_data.family_member_names
+    insurance_companies = user_data.insurance_company_names
     
     # Get message from cookie if exists
     message = request.cookies.get('profile_message', '')
@@ -335,47 +347,21 @@ def profile_get(request: Request,
 
 
 @app.post('/profile')
-def profile_post(request: Request, email: Optional[str] = Form(None), phone: Optional[str] = Form(None), family_members: Optional[str] = Form(None), insurance_companies: Optional[str] = Form(None)):
+def profile_post(request: Request, email: Optional[str] = Form(None), phone: Optional[str] = Form(None), family_members: Optional[str] = Form(None), insurance_companies: Optional[str] = Form(None),
+                 db=Depends(get_db)):
     user_id, username = get_verified_cookies(request)
     if not user_id or not username:
         return RedirectResponse(url='/login', status_code=302)
     
     # Update user profile
     try:
-        db = SessionLocal()
-        update_user_db(db, username, {
-            'email': email or '',
-            'phone': phone or '',
-            'family_members': family_members or '',
-            'insurance_companies': insurance_companies or ''
-        })
+        update_user_db(db, username, profile_fields(email, phone, family_members, insurance_companies))
         message = "Profile updated successfully!"
     except Exception as e:
+        db.rollback()
         message = f"Error updating profile: {e}"
     
-    # Redirect back to profile page with message
-    resp = RedirectResponse(url='/profile', status_code=302)
-    resp.set_cookie('profile_message', message, httponly=True, )
-    return resp
-
-
-def run_ocr_on_image(image: UploadFile) -> dict:
-    from google.cloud import vision
-
-    client = vision.ImageAnnotatorClient()
-
-    content = image.file.read()
-    image = vision.Image(content=content)
-
-    response = client.text_detection(image=image)
-
-    if not response.text_annotations:
-        return {"text": ""}
-
-    return {
-        "text": response.text_annotations[0].description
-    }
-
+    return profile_redirect(message)
 
 
 @app.post('/upload')
@@ -388,15 +374,16 @@ async def upload_receipt(request: Request,
     # require a logged-in user
     user_id, username = get_verified_cookies(request)
     if not user_id or not username:
-        return templates.TemplateResponse('login.html', {"request": request, "message": "Please log in before uploading."})
+        # 401, not a 200 login page: a client that lost its session must see the upload was not stored
+        return templates.TemplateResponse('login.html', {"request": request, "message": "Please log in before uploading."}, status_code=401)
     
     user_id = int(user_id)
 
     if not name:
         return JSONResponse({"error": "name is required"}, status_code=422)
     
-    # Get user email and phone from database
-    user_data = get_user_db(db, username)
+    # email and phone come from the session's cached profile
+    user_data = current_user(request)
     user_email = user_data.email if user_data else ''
     user_phone = user_data.phone if user_data else ''
 
@@ -437,6 +424,10 @@ async def upload_receipt(request: Request,
             if company and amount:
                 refund_details_list.append({"company": company, "amount": amount})
     refund_details = json.dumps(refund_details_list) if refund_details_list else '[]'
+    try:
+        refund_sum = refund_total(refund_details_list)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=422)
     
     insurance_company = (form.get('insurance_company') or '').strip()
     account_username = (form.get('account_username') or username).strip()
@@ -483,56 +474,83 @@ async def upload_receipt(request: Request,
 
     context_str = '|'.join(ctx_parts)
 
+    timings = {}
+    ocr_result = None
+    ocr_job_id = None
+    file_type = file_type_for(image.content_type, image.filename)
+    try:
+        # single chunked pass: size check + content hash, no full copy in memory
+        ingested = await run_stage("ingest", timings, ingest, image.file)
+    except UploadTooLarge as e:
+        count = await run_stage("receipt_count", timings, get_receipt_count, db, user_id)
+        return templates.TemplateResponse('index.html', {"request": request, "message": f"Upload failed: {e.detail}", "results": [], "name": name, "date": date_str, "count": count, "username": username}, status_code=413)
+    content_hash = ingested.content_hash
+
+    # shrink phone photos before they go to Cloudinary and, via its URL, to OCR
+    prepared = await run_stage("prep", timings, normalize_image, image.file, image.content_type, ingested.size)
+    timings["bytes_in"] = prepared.original_bytes
+    timings["bytes_out"] = prepared.prepared_bytes
     try:
         # Upload using the underlying file-like object
-        result = cloudinary.uploader.upload(
-            image.file,
+        # upload_large streams the file in fixed-size chunks
+        result = await run_stage(
+            "cloudinary_upload", timings,
+            timed_cloudinary("upload_large", cloudinary.uploader.upload_large),
+            prepared.fileobj,
             public_id=public_id,
             folder='uploads',
             resource_type='image',
-            context=context_str
+            context=context_str,
+            chunk_size=CLOUDINARY_CHUNK_BYTES,
+            filename=image.filename or public_id,
         )
 
-        ocr_result = None
-
         if action == "ocr":
             try:
-                # IMPORTANT: rewind file, Cloudinary already consumed it
-                await image.seek(0)
-
-                # Call your OCR logic (Vision / LangGraph)
-                ocr_result = run_ocr_on_image(image)
-
-                logger.info(
-                    f"OCR completed for user={username}, public_id={public_id}"
-                )
+                engine_name = "document_ai" if file_type == "pdf" else "vision_api"
+                cached = await run_stage("ocr_cache", timings, get_cached_ocr, content_hash, engine_name)
+                if cached is not None:
+                    ocr_result = {
+                        "text": cached.get("raw_text") or "",
+                        "cached": True,
+                        "fields": merge_fields(cached.get("structured_data"), cached.get("raw_text")),
+                    }
+                    logger.info(f"OCR cache hit for user={username}, public_id={public_id}")
+                else:
+                    # OCR runs in the background worker pool; the page polls /api/ocr/jobs/{id}
+                    ocr_job_id = await run_stage(
+                        "ocr_enqueue", timings,
+                        enqueue_ocr_job,
+                        db,
+                        result.get('secure_url'),
+                        file_type,
+                        user_id=user_id,
+                        public_id=result.get('public_id', public_id),
+                        content_hash=content_hash,
+                    )
+                    logger.info(
+                        f"OCR job {ocr_job_id} queued for user={username}, public_id={public_id}"
+                    )
 
             except Exception as e:
                 logger.error(
-                    f"OCR failed for user={username}, public_id={public_id}: {e}"
+                    f"OCR enqueue failed for user={username}, public_id={public_id}: {e}"
                 )
                 ocr_result = {"error": str(e)}
 
-
         logger.info(f'Image uploaded successfully: public_id={public_id}, user_id={user_id}, username={username}')
     except Exception as e:
         logger.error(f'Upload failed for user {username} (id={user_id}): {e}')
         # stay on UI and show error message
         msg = f"Upload failed: {e}"
         try:
-            search_result = cloudinary.Search().expression(f"folder:uploads AND context.username:{username}").max_results(1).execute()
-            count = search_result.get('total_count') or search_result.get('total') or len(search_result.get('resources', []))
+            count = await run_stage("receipt_count", timings, get_receipt_count, db, user_id)
         except Exception:
             count = 0
         return templates.TemplateResponse('index.html', {"request": request, "message": msg, "results": [], "name": name, "date": date_str, "count": count, "username": username})
 
     # Success: store metadata in SQLite and show index UI with success message
     msg = f"Uploaded: {result.get('public_id', public_id)}"
-    try:
-        search_result = cloudinary.Search().expression(f"folder:uploads AND context.username:{username}").max_results(1).execute()
-        count = search_result.get('total_count') or search_result.get('total') or len(search_result.get('resources', []))
-    except Exception:
-        count = 0
 
     # save to sqlite
     rec = {
@@ -540,25 +558,37 @@ async def upload_receipt(request: Request,
         'user_id': user_id,
         'username': username,
         'name': name,
-        'date': date_str,
+        'date': parse_date(date_str),
         'sent_to_insurance': sent_to_insurance,
-        'refund_details': refund_details,
+        'refund_details': refund_details_list,
+        'refund_total': refund_sum,
         'insurance_company': insurance_company,
         'account_username': account_username,
         'family_count': family_count,
         'family_names': family_names,
         'how_work': how_work,
         'secure_url': result.get('secure_url'),
-        'created_at': result.get('created_at')
+        'created_at': parse_timestamp(result.get('created_at')),
     }
+
+    def save_receipt():
+        rec['sent_to_companies'] = link_companies(db, user_data, sent_to_list)
+        return insert_receipt(db, rec)
+
+    try:
+        await run_stage("db_insert", timings, save_receipt)
+    except Exception:
+        logger.error(f'Saving receipt {public_id} failed', exc_info=True)
+        db.rollback()
+
     try:
-        db = SessionLocal()
-        insert_receipt(db, rec)
+        count = await run_stage("receipt_count", timings, get_receipt_count, db, user_id)
     except Exception:
-        pass
+        count = 0
 
     # attach db copy to result so template can show values
     result['_db'] = rec
+    log_timings(public_id, timings)
 
     return templates.TemplateResponse('index.html', 
                                       {"request": request, 
@@ -568,77 +598,32 @@ async def upload_receipt(request: Request,
                                        "date": date_str, 
                                        "count": count, 
                                        "username": username,
-                                       "ocr": ocr_result, })
+                                       "ocr": ocr_result,
+                                       "ocr_job_id": ocr_job_id, })
 
 
 @app.get('/search')
-def search(request: Request, name: Optional[str] = None, date: Optional[str] = None, refunded: Optional[str] = None, sent_to_insurance: Optional[str] = None, insurance_company: Optional[str] = None):
-    """Search uploaded images by name, date and metadata using Cloudinary Search API."""
-    user_id, username = get_verified_cookies(request)
-    if not user_id or not username:
+def search(request: Request, name: Optional[str] = None, date: Optional[str] = None, refunded: Optional[str] = None, sent_to_insurance: Optional[str] = None, insurance_company: Optional[str] = None,
+           db=Depends(get_db)):
+    """Search uploaded receipts by name, date and metadata in the local receipts table."""
+    user_id, username = session_user_id(request)
+    if user_id is None:
         return RedirectResponse(url='/login', status_code=302)
-    
-    try:
-        user_id = int(user_id)
-    except (ValueError, TypeError):
-        return RedirectResponse(url='/login', status_code=302)
-    
-    expr_parts = [f"folder:uploads", f"context.user_id:{user_id}"]
-
-    if name:
-        # sanitize name to match how we build public_id
-        safe = re.sub(r'[^A-Za-z0-9_\-]', '', name.strip().replace(' ', '_'))
-        # Use quoted wildcard pattern for Cloudinary Search (Lucene-style)
-        expr_parts.append(f"public_id:'*{safe}*'")
-
-    if date:
-        try:
-            d = datetime.fromisoformat(date)
-            nxt = d + timedelta(days=1)
-            expr_parts.append(f"created_at>='{d.strftime('%Y-%m-%d')}'")
-            expr_parts.append(f"created_at<'{nxt.strftime('%Y-%m-%d')}'")
-        except Exception:
-            # ignore invalid date filter
-            pass
-
-    # metadata filters stored in context string
-    if refunded and refunded.lower() in ('yes', 'no'):
-        expr_parts.append(f"context:'refund_stage=*{refunded}*'")
-
-    if sent_to_insurance and sent_to_insurance.lower() in ('yes', 'no'):
-        if sent_to_insurance.lower() == 'yes':
-            expr_parts.append(f"context:'sent_to_insurance:*'")
-        else:
-            expr_parts.append(f"NOT context:'sent_to_insurance'")
-
-    if insurance_company:
-        safe_comp = re.sub(r'[^A-Za-z0-9_\- ]', '', insurance_company.strip())
-        # wildcard match on company name inside context
-        expr_parts.append(f"context:'insurance_company:*{safe_comp}*'")
-
-    expr = " AND ".join(expr_parts)
 
+    filters = {"name": name, "date": date, "refunded": refunded, "sent_to_insurance": sent_to_insurance, "insurance_company": insurance_company}
     try:
-        search_result = cloudinary.Search().expression(expr).max_results(100).execute()
-        resources = search_result.get('resources', [])
+        results = search_receipts(db, user_id, **filters)
     except Exception as e:
-        return templates.TemplateResponse('index.html', {"request": request, "message": f"Search failed: {e}", "results": [], "username": username})
-
-    # enrich results with DB metadata if available
-    enriched = []
-    db = SessionLocal()
-    for r in resources:
-        receipt = get_receipt_db(db, r.get('public_id'))
-        if receipt:
-            r['_db'] = receipt
-        enriched.append(r)
+        logger.error(f'Search failed for user {username} (id={user_id}): {e}')
+        return search_page(request, username, filters, error=e)
 
-    return templates.TemplateResponse('index.html', {"request": request, "results": enriched, "name": name, "date": date, "refunded": refunded, "sent_to_insurance": sent_to_insurance, "insurance_company": insurance_company, "username": username})
+    return search_page(request, username, filters, results)
 
 
 @app.post('/update')
-def update_metadata(request: Request, public_id: str = Form(...), refunded: Optional[str] = Form(None), sent_to_insurance: Optional[str] = Form(None), insurance_company: Optional[str] = Form(None)):
-    """Update metadata (context) for an existing image."""
+def update_metadata(request: Request, public_id: list[str] = Form(...), refunded: Optional[str] = Form(None), sent_to_insurance: Optional[str] = Form(None), insurance_company: Optional[str] = Form(None),
+                    db=Depends(get_db)):
+    """Update metadata (context) for one or more existing images."""
     user_id, username = get_verified_cookies(request)
     if not user_id or not username:
         return RedirectResponse(url='/login', status_code=302)
@@ -648,10 +633,11 @@ def update_metadata(request: Request, public_id: str = Form(...), refunded: Opti
     except (ValueError, TypeError):
         return RedirectResponse(url='/login', status_code=302)
     
-    # Verify user owns this receipt
-    db = SessionLocal()
-    db_rec = get_receipt_db(db, public_id)
-    if not db_rec or db_rec.get('user_id') != user_id:
+    public_ids = list(dict.fromkeys(public_id))
+
+    # Verify user owns every receipt, in one query
+    receipts = get_receipts_db(db, public_ids)
+    if len(receipts) != len(public_ids) or any(r.user_id != user_id for r in receipts.values()):
         return JSONResponse({"error": "Access denied"}, status_code=403)
     
     try:
@@ -687,31 +673,34 @@ def update_metadata(request: Request, public_id: str = Form(...), refunded: Opti
             ctx_parts.append(f"insurance_company={_safe(insurance_val)}")
         
         context_str = '|'.join(ctx_parts)
-        cloudinary.uploader.add_context(context_str, public_id=public_id)
+        with cloudinary_call("add_context"):
+            cloudinary.uploader.add_context(context_str, public_ids=public_ids)
         
         # also update sqlite
         update_fields = {
+            'sent_to_companies': link_companies(db, current_user(request), [insurance_val] if sent_val and insurance_val else []),
             'sent_to_insurance': sent_val,
-            'refund_details': refund_details,
+            'refund_details': refund_details_list,
+            'refund_total': refund_total(refund_details_list),
             'insurance_company': insurance_val
         }
-        update_receipt_db(db, public_id, update_fields)
+        update_receipts_db(db, receipts.values(), update_fields)
     except Exception as e:
+        logger.error(f'Update failed for {public_ids} by user {username} (id={user_id}): {e}')
+        # leave the session usable for get_db's commit
+        db.rollback()
         return JSONResponse({"error": str(e)}, status_code=500)
 
-    # fetch updated resource
-    try:
-        res = cloudinary.api.resource(public_id)
-    except Exception:
-        res = None
-
-    msg = f"Updated metadata for {public_id}"
-    return templates.TemplateResponse('index.html', {"request": request, "message": msg, "results": [res] if res else [], "count": 0, "username": username})
+    # render from the rows we just updated instead of re-fetching each resource
+    results = [receipt_to_resource(receipts[pid]) for pid in public_ids]
+    msg = f"Updated metadata for {', '.join(public_ids)}"
+    return templates.TemplateResponse('index.html', {"request": request, "message": msg, "results": results, "count": 0, "username": username})
 
 
 @app.post('/delete')
-def delete_image(request: Request, public_id: str = Form(...)):
-    """Delete an image by its Cloudinary public_id."""
+def delete_image(request: Request, public_id: list[str] = Form(...),
+                 db=Depends(get_db)):
+    """Delete one or more images by their Cloudinary public_id."""
     user_id, username = get_verified_cookies(request)
     if not user_id or not username:
         return RedirectResponse(url='/login', status_code=302)
@@ -720,32 +709,42 @@ def delete_image(request: Request, public_id: str = Form(...)):
         user_id = int(user_id)
     except (ValueError, TypeError):
         return RedirectResponse(url='/login', status_code=302)
-    
-    # Verify user owns this receipt
-    db = SessionLocal()
-    db_rec = get_receipt_db(db, public_id)
-    if not db_rec or db_rec.get('user_id') != user_id:
-        logger.warning(f'Unauthorized delete attempt: public_id={public_id}, user_id={user_id}, username={username}')
+
+    public_ids = list(dict.fromkeys(public_id))
+
+    # Verify user owns every receipt, in one query
+    receipts = get_receipts_db(db, public_ids)
+    if len(receipts) != len(public_ids) or any(r.user_id != user_id for r in receipts.values()):
+        logger.warning(f'Unauthorized delete attempt: public_ids={public_ids}, user_id={user_id}, username={username}')
         return JSONResponse({"error": "Access denied"}, status_code=403)
     
     try:
-        res = cloudinary.uploader.destroy(public_id, resource_type='image')
-        logger.info(f'Image deleted successfully: public_id={public_id}, user_id={user_id}, username={username}')
+        # the Admin API's bulk delete has a much lower rate limit than destroy; only use it for several ids
+        if len(public_ids) == 1:
+            with cloudinary_call("destroy"):
+                res = cloudinary.uploader.destroy(public_ids[0], resource_type='image')
+            outcome = {public_ids[0]: {'ok': 'deleted', 'not found': 'not_found'}.get(res.get('result'), res.get('result'))}
+        else:
+            with cloudinary_call("delete_resources"):
+                res = cloudinary.api.delete_resources(public_ids, resource_type='image')
+            outcome = res.get('deleted', {})
+        logger.info(f'Images deleted: public_ids={public_ids}, user_id={user_id}, username={username}')
     except Exception as e:
-        logger.error(f'Delete failed for {public_id} by user {username} (id={user_id}): {e}')
+        logger.error(f'Delete failed for {public_ids} by user {username} (id={user_id}): {e}')
         return templates.TemplateResponse('index.html', {"request": request, "message": f"Delete failed: {e}", "results": [], "username": username})
 
-    result_flag = res.get('result')
-    if result_flag in ('ok', 'deleted'):
-        msg = f"Deleted {public_id}"
-    else:
-        msg = f"Delete returned: {result_flag}"
+    deleted = [pid for pid in public_ids if outcome.get(pid) in ('deleted', 'not_found')]
+    failed = [pid for pid in public_ids if pid not in deleted]
+    msg = f"Deleted {', '.join(deleted)}" if deleted else "Nothing deleted"
+    if failed:
+        msg += f" (delete returned: {', '.join(f'{pid}={outcome.get(pid)}' for pid in failed)})"
 
     # remove from sqlite as well
     try:
-        delete_receipt_db(db, public_id)
+        delete_receipts_db(db, [receipts[pid] for pid in deleted])
     except Exception:
-        pass
+        logger.error(f'Removing deleted receipts {deleted} from the DB failed', exc_info=True)
+        db.rollback()
 
     return templates.TemplateResponse('index.html', {"request": request, "message": msg, "results": [], "username": username})
 
@@ -772,6 +771,8 @@ def insert_user(db, username, phone, email, family_members, insurance_companies)
         db.add(user)
         logger.info("User added to session")
 
+    invalidate_user(db, user.user_id)
+    db.commit()
     return user
 
 def get_user_db(db, username):
@@ -780,17 +781,53 @@ def get_user_db(db, username):
 def get_user_by_id(db, user_id):
     return db.query(User).filter(User.user_id == user_id).first()
 
+def link_companies(db, session_user, names) -> list:
+    """Company rows for names on the session user's account, creating missing ones."""
+    if not session_user or not names:
+        return []
+    user = get_user_by_id(db, session_user.user_id)
+    if user is None:
+        return []
+    if set(names) - set(session_user.insurance_company_names):
+        # new or re-activated companies change the cached profile
+        invalidate_user(db, user.user_id)
+    return [user.company(n) for n in names]
+
+def set_sent_to_companies(db, receipts, companies):
+    """Link each receipt to exactly these company rows.
+
+    Written as a DELETE and an INSERT .. ON CONFLICT DO NOTHING instead of
+    through the relationship collection: two requests updating the same
+    receipt would otherwise both delete the old link rows, and the ORM
+    fails the loser for matching fewer rows than it expected.
+    """
+    receipts = list(receipts)
+    public_ids = [r.public_id for r in receipts]
+    if not public_ids:
+        return
+    db.flush()  # new receipts and company rows need to exist for the links
+    db.execute(delete(ReceiptInsuranceCompany).where(ReceiptInsuranceCompany.public_id.in_(public_ids)))
+    rows = [{"public_id": pid, "company_id": c.id} for pid in public_ids for c in companies]
+    if rows:
+        insert = postgresql.insert if db.get_bind().dialect.name == "postgresql" else sqlite.insert
+        db.execute(insert(ReceiptInsuranceCompany.__table__).values(rows).on_conflict_do_nothing())
+    for receipt in receipts:
+        db.expire(receipt, ["sent_to_companies"])
+
 def insert_receipt(db, rec: dict):
     receipt = db.query(Receipt).filter(
         Receipt.public_id == rec["public_id"]
     ).first()
+    fields = {k: v for k, v in rec.items() if k != "sent_to_companies"}
 
     if receipt:
-        for k, v in rec.items():
+        for k, v in fields.items():
             setattr(receipt, k, v)
     else:
-        receipt = Receipt(**rec)
+        receipt = Receipt(**fields)
         db.add(receipt)
+        adjust_receipt_count(db, receipt.user_id, 1)
+    set_sent_to_companies(db, [receipt], rec.get("sent_to_companies") or [])
 
     db.commit()
     return receipt
@@ -816,6 +853,7 @@ def delete_receipt_db(db, public_id: str):
 
     if receipt:
         db.delete(receipt)
+        adjust_receipt_count(db, receipt.user_id, -1)
         db.commit()
 
 def get_receipt_db(db, public_id: str):
@@ -823,6 +861,33 @@ def get_receipt_db(db, public_id: str):
         Receipt.public_id == public_id
     ).first()
 
+def get_receipts_db(db, public_ids) -> dict:
+    """Fetch many receipts with a single IN (...) query, keyed by public_id."""
+    public_ids = list(public_ids)
+    if not public_ids:
+        return {}
+    rows = db.query(Receipt).filter(Receipt.public_id.in_(public_ids)).all()
+    return {r.public_id: r for r in rows}
+
+def update_receipts_db(db, receipts, fields: dict):
+    fields = dict(fields)
+    companies = fields.pop("sent_to_companies", None)
+    for receipt in receipts:
+        for k, v in fields.items():
+            setattr(receipt, k, v)
+    if companies is not None:
+        set_sent_to_companies(db, receipts, companies)
+    db.commit()
+
+def delete_receipts_db(db, receipts):
+    per_user = {}
+    for receipt in receipts:
+        db.delete(receipt)
+        per_user[receipt.user_id] = per_user.get(receipt.user_id, 0) + 1
+    for uid, n in per_user.items():
+        adjust_receipt_count(db, uid, -n)
+    db.commit()
+
 def update_user_db(db, username: str, fields: dict):
     user = db.query(User).filter(
         User.username == username
@@ -834,9 +899,98 @@ def update_user_db(db, username: str, fields: dict):
     for k, v in fields.items():
         setattr(user, k, v)
 
+    invalidate_user(db, user.user_id)
     db.commit()
     return user
 
 @app.post("/users")
 def create_user(username: str, db=Depends(get_db)):
-    return insert_user(db, username, None, None, None, None)
\ No newline at end of file
+    return insert_user(db, username, None, None, None, None)
+
+# Async handlers backed by asyncpg (async_crud). They replace the sync
+# versions above when ASYNC_DB_ENABLED; SQLite dev mode keeps the sync ones.
+# Only the routes that wait on the database per request are here. GET
+# /profile reads the session user and needs no query. /signup, /upload,
+# /update and /delete stay sync in both modes: they share link_companies,
+# set_sent_to_companies and the receipt-count bookkeeping with the upload
+# pipeline, which runs them on the sync engine.
+async_router = APIRouter()
+
+
+@async_router.get('/')
+async def ui_async(request: Request, db=Depends(get_async_db)):
+    user_id, username = session_user_id(request)
+
+    count = 0
+    if user_id is not None:
+        try:
+            count = await adb.get_receipt_count(db, user_id)
+        except Exception:
+            count = 0
+
+    return index_page(request, username, count)
+
+
+@async_router.get('/count')
+async def count_endpoint_async(request: Request, db=Depends(get_async_db)):
+    user_id, _ = session_user_id(request)
+    if user_id is None:
+        return JSONResponse({"count": 0})
+
+    try:
+        return JSONResponse({"count": await adb.get_receipt_count(db, user_id)})
+    except Exception as e:
+        return JSONResponse({"error": str(e), "count": 0}, status_code=500)
+
+
+@async_router.post('/login')
+async def login_post_async(request: Request, username: str = Form(...), db=Depends(get_async_db)):
+    return login_response(request, username, await adb.get_user_db(db, username))
+
+
+@async_router.post('/profile')
+async def profile_post_async(request: Request, email: Optional[str] = Form(None), phone: Optional[str] = Form(None), family_members: Optional[str] = Form(None), insurance_companies: Optional[str] = Form(None),
+                             db=Depends(get_async_db)):
+    user_id, username = get_verified_cookies(request)
+    if not user_id or not username:
+        return RedirectResponse(url='/login', status_code=302)
+
+    try:
+        await adb.update_user_db(db, username, profile_fields(email, phone, family_members, insurance_companies))
+        message = "Profile updated successfully!"
+    except Exception as e:
+        await db.rollback()
+        message = f"Error updating profile: {e}"
+
+    return profile_redirect(message)
+
+
+@async_router.get('/search')
+async def search_async(request: Request, name: Optional[str] = None, date: Optional[str] = None, refunded: Optional[str] = None, sent_to_insurance: Optional[str] = None, insurance_company: Optional[str] = None,
+                       db=Depends(get_async_db)):
+    user_id, username = session_user_id(request)
+    if user_id is None:
+        return RedirectResponse(url='/login', status_code=302)
+
+    filters = {"name": name, "date": date, "refunded": refunded, "sent_to_insurance": sent_to_insurance, "insurance_company": insurance_company}
+    try:
+        results = await search_receipts_async(db, user_id, **filters)
+    except Exception as e:
+        logger.error(f'Search failed for user {username} (id={user_id}): {e}')
+        return search_page(request, username, filters, error=e)
+
+    return search_page(request, username, filters, results)
+
+
+def use_async_routes(app, router):
+    """Swap the sync handlers for the router's async versions with the same path and method."""
+    replaced = {(r.path, m) for r in router.routes for m in r.methods}
+    app.router.routes = [
+        r for r in app.router.routes
+        if not (isinstance(r, APIRoute) and any((r.path, m) in replaced for m in r.methods))
+    ]
+    app.include_router(router)
+
+
+if ASYNC_DB_ENABLED:
+    use_async_routes(app, async_router)
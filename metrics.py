@@ -0,0 +1,248 @@
+"""In-process metrics in Prometheus text format, served at /metrics.
+
+Counters and histograms are plain dicts behind one lock per metric; an
+observation is a bucket search and a few additions, cheap enough for every
+request, query and outbound call.
+"""
+import bisect
+import functools
+import inspect
+import threading
+import time
+from contextlib import contextmanager
+
+# seconds; covers a fast SELECT up to a slow Document AI call
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry = []
+_collectors = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=None) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _num(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            yield f"{self.name}{_labels(self.labelnames, labels)} {_num(value)}"
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, seconds: float, *labels):
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            if i < len(self.buckets):
+                series[i] += 1
+            series[-2] += seconds
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def samples(self):
+        with self._lock:
+            items = sorted((labels, list(series)) for labels, series in self._series.items())
+        for labels, series in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, series):
+                cumulative += n
+                le = 'le="%s"' % _num(bound)
+                yield f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}"
+            le = 'le="+Inf"'
+            yield f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {series[-1]}"
+            yield f"{self.name}_sum{_labels(self.labelnames, labels)} {_num(round(series[-2], 6))}"
+            yield f"{self.name}_count{_labels(self.labelnames, labels)} {series[-1]}"
+
+
+def register_collector(fn):
+    """fn() returns [(name, kind, help, [(labels dict, value), ...]), ...] at scrape time."""
+    _collectors.append(fn)
+    return fn
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    for collect in _collectors:
+        for name, kind, help, samples in collect():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{_labels(labels.keys(), labels.values())} {_num(value)}")
+    return "\n".join(lines) + "\n"
+
+
+http_request_duration = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route template",
+    labels=("method", "route", "status"),
+)
+cloudinary_call_duration = Histogram(
+    "cloudinary_call_duration_seconds", "Cloudinary API call latency", labels=("call",),
+)
+cloudinary_calls = Counter(
+    "cloudinary_calls_total", "Cloudinary API calls by outcome", labels=("call", "outcome"),
+)
+ocr_duration = Histogram(
+    "ocr_duration_seconds", "OCR graph node latency by engine", labels=("engine",),
+)
+ocr_results = Counter(
+    "ocr_results_total", "OCR graph node runs by engine and outcome", labels=("engine", "outcome"),
+)
+ocr_graph_runs = Counter(
+    "ocr_graph_runs_total", "OCR graph invocations: fresh, resumed or replayed from a checkpoint", labels=("outcome",),
+)
+ocr_client_call_duration = Histogram(
+    "ocr_client_call_duration_seconds", "Google OCR client call latency", labels=("client",),
+)
+ocr_slot_wait = Histogram(
+    "ocr_slot_wait_seconds", "Time an async Google OCR call waits for a concurrency slot", labels=("client",),
+)
+db_query_duration = Histogram(
+    "db_query_duration_seconds", "SQL statement latency by statement type", labels=("statement",),
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+upload_stage_duration = Histogram(
+    "upload_stage_duration_seconds", "Time /upload spends in each pipeline stage", labels=("stage",),
+)
+upload_stage_wait = Histogram(
+    "upload_stage_wait_seconds", "Time /upload waits for a stage's concurrency slot", labels=("stage",),
+)
+
+
+@contextmanager
+def cloudinary_call(call: str):
+    """Time one Cloudinary SDK call and count it as ok or error."""
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        cloudinary_call_duration.observe(time.perf_counter() - started, call)
+        cloudinary_calls.inc(call, outcome)
+
+
+def timed_cloudinary(call: str, fn):
+    """fn wrapped in cloudinary_call(call), for calls handed to an executor."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with cloudinary_call(call):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def _observe_ocr(node_name: str, started: float, result=None):
+    if result is None:
+        ocr_duration.observe(time.perf_counter() - started, node_name)
+        ocr_results.inc(node_name, "error")
+        return
+    metadata = result.get("metadata") or {}
+    engine = metadata.get("engine") or node_name
+    outcome = "error" if metadata.get("error") else ("cache_hit" if metadata.get("cache") == "hit" else "ok")
+    ocr_duration.observe(time.perf_counter() - started, engine)
+    ocr_results.inc(engine, outcome)
+
+
+def observed_ocr_node(node_name: str, fn):
+    """Wrap a graph node (sync or async) to record its latency and outcome under metadata["engine"]."""
+    if inspect.iscoroutinefunction(fn):
+        async def async_wrapper(state):
+            started = time.perf_counter()
+            try:
+                result = await fn(state)
+            except Exception:
+                _observe_ocr(node_name, started)
+                raise
+            _observe_ocr(node_name, started, result)
+            return result
+        return functools.wraps(fn)(async_wrapper)
+
+    def wrapper(state):
+        started = time.perf_counter()
+        try:
+            result = fn(state)
+        except Exception:
+            _observe_ocr(node_name, started)
+            raise
+        _observe_ocr(node_name, started, result)
+        return result
+    return functools.wraps(fn)(wrapper)
+
+
+class RequestMetricsMiddleware:
+    """Observe every HTTP request's latency under its route template."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_and_record_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_and_record_status)
+        finally:
+            route = scope.get("route")
+            # the template ("/api/ocr/jobs/{job_id}"), never the raw path, to keep label cardinality bounded
+            template = getattr(route, "path", None) or scope.get("root_path") or "unmatched"
+            http_request_duration.observe(time.perf_counter() - started, scope["method"], template, str(status[0]))
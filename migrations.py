@@ -0,0 +1,287 @@
+"""Versioned schema migrations.
+
+Run at startup through init_db.ensure_db(), or by hand:
+    python -m migrations upgrade     # apply pending migrations
+    python -m migrations current     # print the applied version
+    python -m migrations history     # list all migrations
+
+Each migration runs in its own transaction and is recorded in
+schema_version, so it is applied exactly once per database.
+"""
+import json
+import logging
+import sys
+from datetime import datetime
+
+from sqlalchemy import Column, ForeignKey, Index, Integer, MetaData, String, Table, Text, inspect, select, text
+
+from database import engine
+import models  # the tables m004 and m005 introduce
+from receipt_types import parse_date, parse_timestamp, parse_refunds, refund_total
+
+logger = logging.getLogger('kabala')
+
+_version_meta = MetaData()
+schema_version = Table(
+    "schema_version", _version_meta,
+    Column("version", Integer, primary_key=True),
+    Column("name", String, nullable=False),
+    Column("applied_at", String, nullable=False),
+)
+
+
+def _columns(conn, table: str) -> dict:
+    return {c["name"]: c for c in inspect(conn).get_columns(table)}
+
+
+def _is_type(column: dict, *names: str) -> bool:
+    return type(column["type"]).__name__.upper() in names
+
+
+# The schema as it stood before versioned migrations, which m001 creates.
+# Frozen: later changes go in their own migration, never here or in models
+# read by m001, so a new database walks the same steps as an old one.
+_baseline = MetaData()
+Table(
+    "users", _baseline,
+    Column("user_id", Integer, primary_key=True, index=True),
+    Column("username", String, unique=True, nullable=False),
+    Column("phone", String),
+    Column("email", String),
+    Column("family_members", Text),
+    Column("insurance_companies", Text),
+    Column("created_at", String),
+)
+Table(
+    "receipts", _baseline,
+    Column("public_id", String, primary_key=True),
+    Column("user_id", Integer, ForeignKey("users.user_id")),
+    Column("username", String),
+    Column("name", String),
+    Column("date", String),
+    Column("sent_to_insurance", String),
+    Column("refund_details", Text),
+    Column("insurance_company", String),
+    Column("account_username", String),
+    Column("family_count", Integer),
+    Column("family_names", Text),
+    Column("how_work", Text),
+    Column("secure_url", String),
+    Column("created_at", String),
+    Index("ix_receipts_user_date", "user_id", "date"),
+    Index("ix_receipts_user_insurance_company", "user_id", "insurance_company"),
+    Index("ix_receipts_user_sent_to_insurance", "user_id", "sent_to_insurance"),
+)
+Table(
+    "receipt_counts", _baseline,
+    Column("user_id", Integer, ForeignKey("users.user_id"), primary_key=True),
+    Column("count", Integer, nullable=False),
+)
+Table(
+    "ocr_jobs", _baseline,
+    Column("job_id", String, primary_key=True),
+    Column("user_id", Integer, ForeignKey("users.user_id")),
+    Column("public_id", String),
+    Column("file_url", String, nullable=False),
+    Column("file_type", String, nullable=False),
+    Column("content_hash", String),
+    Column("status", String, nullable=False),
+    Column("result", Text),
+    Column("error", Text),
+    Column("attempts", Integer, nullable=False),
+    Column("created_at", String),
+    Column("updated_at", String),
+    Index("ix_ocr_jobs_status_created", "status", "created_at"),
+)
+Table(
+    "ocr_cache", _baseline,
+    Column("content_hash", String, primary_key=True),
+    Column("engine", String, primary_key=True),
+    Column("result", Text, nullable=False),
+    Column("hits", Integer, nullable=False),
+    Column("created_at", String, index=True),
+)
+
+
+def m001_baseline(conn):
+    # checkfirst: databases from before migrations already have some of these
+    _baseline.create_all(bind=conn)
+
+
+def m002_typed_receipts(conn):
+    """Move receipt/user dates, timestamps and refunds off strings."""
+    pg = conn.dialect.name == "postgresql"
+
+    if "refund_total" not in _columns(conn, "receipts"):
+        conn.execute(text("ALTER TABLE receipts ADD COLUMN refund_total NUMERIC(12, 2)"))
+    # added with the OCR cache, before there were migrations
+    if "content_hash" not in _columns(conn, "ocr_jobs"):
+        conn.execute(text("ALTER TABLE ocr_jobs ADD COLUMN content_hash VARCHAR"))
+
+    # 1. normalise the stored values so every row converts cleanly
+    rows = conn.execute(text("SELECT public_id, date, created_at, refund_details FROM receipts")).fetchall()
+    for public_id, date_val, created_val, refunds_val in rows:
+        d = parse_date(date_val)
+        ts = parse_timestamp(created_val)
+        refunds = parse_refunds(refunds_val)
+        try:
+            total = refund_total(refunds)
+        except ValueError as e:
+            logger.warning(f"Receipt {public_id}: {e}; refund_total left empty")
+            total = None
+        conn.execute(
+            text("UPDATE receipts SET date = :d, created_at = :c, refund_details = :r, refund_total = :t "
+                 "WHERE public_id = :p"),
+            {
+                "d": d.isoformat() if d else None,
+                "c": (ts.isoformat(sep=' ') if ts else None),
+                "r": json.dumps(refunds),
+                "t": str(total) if total is not None else None,
+                "p": public_id,
+            },
+        )
+
+    for user_id, created_val in conn.execute(text("SELECT user_id, created_at FROM users")).fetchall():
+        ts = parse_timestamp(created_val)
+        conn.execute(
+            text("UPDATE users SET created_at = :c WHERE user_id = :u"),
+            {"c": ts.isoformat(sep=' ') if ts else None, "u": user_id},
+        )
+
+    # 2. change the column types; SQLite stores these as text either way
+    if pg:
+        receipts = _columns(conn, "receipts")
+        if not _is_type(receipts["date"], "DATE"):
+            conn.execute(text("ALTER TABLE receipts ALTER COLUMN date TYPE DATE USING date::date"))
+        if not _is_type(receipts["created_at"], "TIMESTAMP", "DATETIME"):
+            conn.execute(text("ALTER TABLE receipts ALTER COLUMN created_at TYPE TIMESTAMP USING created_at::timestamp"))
+        if not _is_type(receipts["refund_details"], "JSONB"):
+            conn.execute(text("ALTER TABLE receipts ALTER COLUMN refund_details TYPE JSONB USING refund_details::jsonb"))
+        if not _is_type(_columns(conn, "users")["created_at"], "TIMESTAMP", "DATETIME"):
+            conn.execute(text("ALTER TABLE users ALTER COLUMN created_at TYPE TIMESTAMP USING created_at::timestamp"))
+
+
+def m003_indexes(conn):
+    # create_all only builds indexes together with a new table, so databases
+    # from before these indexes existed are missing some of them
+    for name, table, columns in (
+        ("ix_receipts_username", "receipts", "username"),
+        ("ix_receipts_user_date", "receipts", "user_id, date"),
+        ("ix_receipts_user_insurance_company", "receipts", "user_id, insurance_company"),
+        ("ix_receipts_user_sent_to_insurance", "receipts", "user_id, sent_to_insurance"),
+        ("ix_receipts_user_refund_total", "receipts", "user_id, refund_total"),
+        ("ix_ocr_jobs_status_created", "ocr_jobs", "status, created_at"),
+        ("ix_ocr_cache_created_at", "ocr_cache", "created_at"),
+    ):
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})"))
+
+
+def m004_family_and_companies(conn):
+    """Move comma/pipe-joined user lists into family_member, user_insurance_company
+    and receipt_insurance_company, then drop the old string columns."""
+    for model in (models.FamilyMember, models.UserInsuranceCompany, models.ReceiptInsuranceCompany):
+        model.__table__.create(bind=conn, checkfirst=True)
+
+    user_cols = _columns(conn, "users")
+    if "family_members" not in user_cols:
+        return
+
+    family = models.FamilyMember.__table__
+    companies = models.UserInsuranceCompany.__table__
+    links = models.ReceiptInsuranceCompany.__table__
+    company_ids = {}
+
+    def company_id(user_id, name):
+        key = (user_id, name)
+        if key not in company_ids:
+            position = sum(1 for u, _ in company_ids if u == user_id)
+            company_ids[key] = conn.execute(companies.insert().values(
+                user_id=user_id, name=name, position=position, active=False
+            )).inserted_primary_key[0]
+        return company_ids[key]
+
+    users = conn.execute(text("SELECT user_id, family_members, insurance_companies FROM users")).fetchall()
+    for user_id, family_str, companies_str in users:
+        for i, name in enumerate(models.split_names(family_str)):
+            conn.execute(family.insert().values(user_id=user_id, name=name, position=i))
+        for name in models.split_names(companies_str):
+            cid = company_id(user_id, name)
+            conn.execute(companies.update().where(companies.c.id == cid).values(active=True))
+
+    receipts = conn.execute(text(
+        "SELECT public_id, user_id, sent_to_insurance, insurance_company FROM receipts WHERE user_id IS NOT NULL"
+    )).fetchall()
+    for public_id, user_id, sent, insurance_company in receipts:
+        names = models.split_names(sent, sep='|')
+        # /update stored a yes/no flag instead of names; the company is in insurance_company
+        if [n.lower() for n in names] in (['yes'], ['on'], ['true']):
+            names = [insurance_company] if insurance_company else []
+        for name in names:
+            conn.execute(links.insert().values(public_id=public_id, company_id=company_id(user_id, name)))
+
+    conn.execute(text("ALTER TABLE users DROP COLUMN family_members"))
+    conn.execute(text("ALTER TABLE users DROP COLUMN insurance_companies"))
+
+
+def m005_ocr_checkpoints(conn):
+    for model in (models.OcrCheckpoint, models.OcrCheckpointWrite):
+        model.__table__.create(bind=conn, checkfirst=True)
+
+
+def m006_ocr_job_leases(conn):
+    if "lease_until" not in _columns(conn, "ocr_jobs"):
+        conn.execute(text("ALTER TABLE ocr_jobs ADD COLUMN lease_until VARCHAR"))
+
+
+MIGRATIONS = [
+    (1, "baseline", m001_baseline),
+    (2, "typed receipts", m002_typed_receipts),
+    (3, "query indexes", m003_indexes),
+    (4, "family members and insurance companies", m004_family_and_companies),
+    (5, "ocr graph checkpoints", m005_ocr_checkpoints),
+    (6, "ocr job leases", m006_ocr_job_leases),
+]
+
+
+def current_version(bind=engine) -> int:
+    with bind.connect() as conn:
+        if not inspect(conn).has_table("schema_version"):
+            return 0
+        return conn.execute(select(schema_version.c.version).order_by(schema_version.c.version.desc())).scalar() or 0
+
+
+def upgrade(bind=engine) -> int:
+    _version_meta.create_all(bind=bind)
+    version = current_version(bind)
+    for number, name, migrate in MIGRATIONS:
+        if number <= version:
+            continue
+        logger.info(f"Applying migration {number:03d} {name}")
+        with bind.begin() as conn:
+            migrate(conn)
+            conn.execute(schema_version.insert().values(
+                version=number, name=name, applied_at=datetime.utcnow().isoformat()
+            ))
+        version = number
+    return version
+
+
+def main(argv):
+    command = argv[1] if len(argv) > 1 else "upgrade"
+    if command == "upgrade":
+        print(f"schema at version {upgrade()}")
+    elif command == "current":
+        print(current_version())
+    elif command == "history":
+        for number, name, _ in MIGRATIONS:
+            print(f"{number:03d} {name}")
+    else:
+        print(__doc__)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    from logging_setup import configure_logging
+    configure_logging()
+    sys.exit(main(sys.argv))
@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String, Text, ForeignKey
+from sqlalchemy import Column, Integer, String, Text, ForeignKey, Index, Date, DateTime, Numeric, JSON, Boolean, UniqueConstraint, LargeBinary
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship
 from database import Base
 
@@ -9,11 +10,102 @@ class User(Base):
     username = Column(String, unique=True, nullable=False)
     phone = Column(String)
     email = Column(String)
-    family_members = Column(Text)
-    insurance_companies = Column(Text)
-    created_at = Column(String)
+    created_at = Column(DateTime)
 
     receipts = relationship("Receipt", back_populates="user")
+    family = relationship(
+        "FamilyMember", order_by="FamilyMember.position",
+        cascade="all, delete-orphan", lazy="selectin",
+    )
+    companies = relationship(
+        "UserInsuranceCompany", order_by="UserInsuranceCompany.position",
+        cascade="all, delete-orphan", lazy="selectin",
+    )
+
+    @property
+    def family_member_names(self) -> list:
+        return [f.name for f in self.family]
+
+    @property
+    def insurance_company_names(self) -> list:
+        return [c.name for c in self.companies if c.active]
+
+    # The comma-joined strings the forms send and the templates show.
+    # Assigning one replaces the related rows.
+    @property
+    def family_members(self) -> str:
+        return ', '.join(self.family_member_names)
+
+    @family_members.setter
+    def family_members(self, value):
+        names = split_names(value)
+        self.family = [FamilyMember(name=n, position=i) for i, n in enumerate(names)]
+
+    @property
+    def insurance_companies(self) -> str:
+        return ', '.join(self.insurance_company_names)
+
+    @insurance_companies.setter
+    def insurance_companies(self, value):
+        names = split_names(value)
+        # companies dropped from the profile stay (inactive) so receipts keep their links
+        for c in self.companies:
+            c.active = False
+        for i, n in enumerate(names):
+            company = self.company(n)
+            company.position = i
+
+    def company(self, name: str) -> "UserInsuranceCompany":
+        """Return this user's company row for name, creating it if needed."""
+        for c in self.companies:
+            if c.name == name:
+                c.active = True
+                return c
+        c = UserInsuranceCompany(name=name, position=len(self.companies), active=True)
+        self.companies.append(c)
+        return c
+
+
+def split_names(value, sep=',') -> list:
+    if not value:
+        return []
+    names = []
+    for x in value.split(sep):
+        x = x.strip()
+        if x and x not in names:
+            names.append(x)
+    return names
+
+
+class FamilyMember(Base):
+    __tablename__ = "family_member"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.user_id"), nullable=False, index=True)
+    name = Column(String, nullable=False)
+    position = Column(Integer, nullable=False, default=0)
+
+
+class UserInsuranceCompany(Base):
+    __tablename__ = "user_insurance_company"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.user_id"), nullable=False)
+    name = Column(String, nullable=False)
+    position = Column(Integer, nullable=False, default=0)
+    active = Column(Boolean, nullable=False, default=True)
+
+    __table_args__ = (
+        UniqueConstraint("user_id", "name", name="uq_user_insurance_company_user_name"),
+    )
+
+
+class ReceiptInsuranceCompany(Base):
+    """Which of the user's insurance companies a receipt was sent to."""
+    __tablename__ = "receipt_insurance_company"
+
+    public_id = Column(String, ForeignKey("receipts.public_id", ondelete="CASCADE"), primary_key=True)
+    company_id = Column(Integer, ForeignKey("user_insurance_company.id"), primary_key=True, index=True)
 
 
 class Receipt(Base):
@@ -21,17 +113,104 @@ class Receipt(Base):
 
     public_id = Column(String, primary_key=True)
     user_id = Column(Integer, ForeignKey("users.user_id"))
-    username = Column(String)
+    username = Column(String, index=True)
     name = Column(String)
-    date = Column(String)
+    date = Column(Date)
     sent_to_insurance = Column(String)
-    refund_details = Column(Text)
+    # list of {"company", "amount"}; refund_total is their sum, NULL when there are none
+    refund_details = Column(JSON().with_variant(JSONB(), "postgresql"))
+    refund_total = Column(Numeric(12, 2))
     insurance_company = Column(String)
     account_username = Column(String)
     family_count = Column(Integer)
     family_names = Column(Text)
     how_work = Column(Text)
     secure_url = Column(String)
-    created_at = Column(String)
+    created_at = Column(DateTime)
 
     user = relationship("User", back_populates="receipts")
+    sent_to_companies = relationship(
+        "UserInsuranceCompany", secondary="receipt_insurance_company", lazy="selectin",
+    )
+
+    @property
+    def sent_to_company_names(self) -> list:
+        return [c.name for c in self.sent_to_companies]
+
+    __table_args__ = (
+        Index("ix_receipts_user_date", "user_id", "date"),
+        Index("ix_receipts_user_insurance_company", "user_id", "insurance_company"),
+        Index("ix_receipts_user_sent_to_insurance", "user_id", "sent_to_insurance"),
+        Index("ix_receipts_user_refund_total", "user_id", "refund_total"),
+    )
+
+
+class ReceiptCount(Base):
+    __tablename__ = "receipt_counts"
+
+    user_id = Column(Integer, ForeignKey("users.user_id"), primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class OcrJob(Base):
+    __tablename__ = "ocr_jobs"
+
+    job_id = Column(String, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.user_id"))
+    public_id = Column(String)
+    file_url = Column(String, nullable=False)
+    file_type = Column(String, nullable=False)
+    content_hash = Column(String)
+    status = Column(String, nullable=False, default="queued")
+    result = Column(Text)
+    error = Column(Text)
+    attempts = Column(Integer, nullable=False, default=0)
+    created_at = Column(String)
+    updated_at = Column(String)
+    # a running job whose worker stops renewing this is requeued
+    lease_until = Column(String)
+
+    __table_args__ = (
+        Index("ix_ocr_jobs_status_created", "status", "created_at"),
+    )
+
+
+class OcrCacheEntry(Base):
+    __tablename__ = "ocr_cache"
+
+    content_hash = Column(String, primary_key=True)
+    engine = Column(String, primary_key=True)
+    result = Column(Text, nullable=False)
+    hits = Column(Integer, nullable=False, default=0)
+    created_at = Column(String, index=True)
+
+
+class OcrCheckpoint(Base):
+    """One LangGraph checkpoint of an OCR graph run (see ocr_checkpoint.py)."""
+    __tablename__ = "ocr_checkpoints"
+
+    thread_id = Column(String, primary_key=True)
+    checkpoint_ns = Column(String, primary_key=True, default="")
+    checkpoint_id = Column(String, primary_key=True)
+    parent_checkpoint_id = Column(String)
+    checkpoint_type = Column(String, nullable=False)
+    checkpoint = Column(LargeBinary, nullable=False)
+    metadata_type = Column(String, nullable=False)
+    checkpoint_metadata = Column("metadata", LargeBinary, nullable=False)
+    created_at = Column(String, index=True)
+
+
+class OcrCheckpointWrite(Base):
+    """A node's pending writes against a checkpoint, kept so a resumed run skips it."""
+    __tablename__ = "ocr_checkpoint_writes"
+
+    thread_id = Column(String, primary_key=True)
+    checkpoint_ns = Column(String, primary_key=True, default="")
+    checkpoint_id = Column(String, primary_key=True)
+    task_id = Column(String, primary_key=True)
+    idx = Column(Integer, primary_key=True)
+    channel = Column(String, nullable=False)
+    value_type = Column(String, nullable=False)
+    value = Column(LargeBinary, nullable=False)
+    task_path = Column(String, nullable=False, default="")
+
@@ -1,21 +1,168 @@
+"""Document AI OCR, page-parallel for multi-page PDFs.
+
+Synchronous process_document caps the pages per call and its latency grows
+with the page count, so a PDF longer than PDF_PAGES_PER_CHUNK is split into
+page ranges (with pypdf) that are processed concurrently. Text, entities
+and confidence are merged back in page order. When the graph is streamed
+with stream_mode="custom", every page is written out as soon as its chunk
+is done. Without pypdf the whole document goes in one call.
+"""
+import asyncio
+import contextvars
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 from google.cloud import documentai
+from langgraph.config import get_stream_writer
+
+from ocr_clients import afetch_file, call_slot, fetch_file, get_async_client, get_documentai_client, track_call
 
 PROJECT_ID = "YOUR_PROJECT_ID"
 LOCATION = "us"
 PROCESSOR_ID = "YOUR_PROCESSOR_ID"
 
-def document_ai_ocr_node(state):
-    client = documentai.DocumentProcessorServiceClient()
-    name = client.processor_path(PROJECT_ID, LOCATION, PROCESSOR_ID)
-    request = documentai.ProcessRequest(
-        name=name,
-        document_uri=state["file_url"]
+PDF_PAGES_PER_CHUNK = int(os.getenv("PDF_PAGES_PER_CHUNK", "5"))
+PDF_CHUNK_WORKERS = int(os.getenv("PDF_CHUNK_WORKERS", "16"))
+
+_executor = ThreadPoolExecutor(max_workers=PDF_CHUNK_WORKERS, thread_name_prefix="docai-pages")
+
+_MAGIC = (
+    (b"%PDF", "application/pdf"),
+    (b"\x89PNG", "image/png"),
+    (b"GIF8", "image/gif"),
+    (b"II*\x00", "image/tiff"),
+    (b"MM\x00*", "image/tiff"),
+    (b"BM", "image/bmp"),
+)
+
+
+def _mime_type(data: bytes) -> str:
+    for magic, mime_type in _MAGIC:
+        if data.startswith(magic):
+            return mime_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/jpeg"
+
+
+def split_pages(data: bytes, mime_type: str) -> list:
+    """[(first page number, bytes)], one entry per chunk of PDF_PAGES_PER_CHUNK pages."""
+    if mime_type != "application/pdf":
+        return [(1, data)]
+    try:
+        from pypdf import PdfReader, PdfWriter
+    except ImportError:
+        return [(1, data)]
+    reader = PdfReader(io.BytesIO(data))
+    count = len(reader.pages)
+    if count <= PDF_PAGES_PER_CHUNK:
+        return [(1, data)]
+    chunks = []
+    for start in range(0, count, PDF_PAGES_PER_CHUNK):
+        writer = PdfWriter()
+        for page in reader.pages[start:start + PDF_PAGES_PER_CHUNK]:
+            writer.add_page(page)
+        out = io.BytesIO()
+        writer.write(out)
+        chunks.append((start + 1, out.getvalue()))
+    return chunks
+
+
+def _request(client, content: bytes, mime_type: str):
+    # Document AI reads inline bytes or gs:// URIs, not our Cloudinary URLs
+    return documentai.ProcessRequest(
+        name=client.processor_path(PROJECT_ID, LOCATION, PROCESSOR_ID),
+        raw_document=documentai.RawDocument(content=content, mime_type=mime_type),
     )
-    result = client.process_document(request=request)
-    doc = result.document
-    state["raw_text"] = doc.text
-    state["structured_data"] = {
-        ent.type_: ent.mention_text for ent in doc.entities
-    }
+
+
+def _page_writer():
+    try:
+        return get_stream_writer()
+    except RuntimeError:
+        # called outside a graph run (ocr_batch): nobody to stream to
+        return lambda _: None
+
+
+def _write_pages(write, first_page: int, doc):
+    if not doc.pages:
+        write({"page": first_page, "text": doc.text, "confidence": None})
+    for n, page in enumerate(doc.pages):
+        text = "".join(doc.text[int(s.start_index):int(s.end_index)] for s in page.layout.text_anchor.text_segments)
+        write({"page": first_page + n, "text": text, "confidence": page.layout.confidence})
+
+
+def _apply(state, chunks: list):
+    """Merge [(first page, Document)] into state in page order."""
+    chunks = sorted(chunks, key=lambda c: c[0])
+    texts = [doc.text for _, doc in chunks]
+    state["raw_text"] = "".join(t if t.endswith("\n") else t + "\n" for t in texts[:-1]) + texts[-1]
+    # one value per type, the most confident; on a tie the earlier page wins
+    best = {}
+    for _, doc in chunks:
+        for ent in doc.entities:
+            if ent.type_ not in best or ent.confidence > best[ent.type_].confidence:
+                best[ent.type_] = ent
+    state["structured_data"] = {type_: ent.mention_text for type_, ent in best.items()}
+    pages = [page for _, doc in chunks for page in doc.pages]
+    state["metadata"]["confidence"] = sum(p.layout.confidence for p in pages) / len(pages) if pages else None
     state["metadata"]["engine"] = "document_ai"
+    if len(chunks) > 1:
+        state["metadata"]["pdf"] = {"pages": len(pages), "chunks": len(chunks)}
     return state
+
+
+def document_ai_ocr_node(state):
+    data = fetch_file(state["file_url"])
+    mime_type = _mime_type(data)
+    client = get_documentai_client()
+    write = _page_writer()
+
+    def process(first_page, content):
+        with track_call("document_ai"):
+            result = client.process_document(request=_request(client, content, mime_type))
+        return first_page, result.document
+
+    chunks = split_pages(data, mime_type)
+    if len(chunks) == 1:
+        done = [process(*chunks[0])]
+        _write_pages(write, *done[0])
+        return _apply(state, done)
+
+    futures = [_executor.submit(contextvars.copy_context().run, process, *chunk) for chunk in chunks]
+    done = []
+    try:
+        for future in as_completed(futures):
+            done.append(future.result())
+            _write_pages(write, *done[-1])
+    finally:
+        for future in futures:
+            future.cancel()
+    return _apply(state, done)
+
+
+async def document_ai_ocr_node_async(state):
+    data = await afetch_file(state["file_url"])
+    mime_type = _mime_type(data)
+    client = get_async_client("document_ai")
+    write = _page_writer()
+
+    async def process(first_page, content):
+        async with call_slot("document_ai"):
+            with track_call("document_ai"):
+                result = await client.process_document(request=_request(client, content, mime_type))
+        return first_page, result.document
+
+    # pypdf is CPU work; a long PDF would stall every other request on the loop
+    chunks = await asyncio.to_thread(split_pages, data, mime_type)
+    tasks = [asyncio.create_task(process(*chunk)) for chunk in chunks]
+    done = []
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            done.append(await next_done)
+            _write_pages(write, *done[-1])
+    finally:
+        for task in tasks:
+            task.cancel()
+    return _apply(state, done)
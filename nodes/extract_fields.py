@@ -0,0 +1,177 @@
+"""Pull the amount, date, provider and currency out of receipt text.
+
+Plain regex parsing of the OCR text, tuned for the Hebrew and English
+receipts we see: totals next to סה"כ / לתשלום / Total, day-first dates,
+₪ / ש"ח / NIS amounts. Every pattern is compiled once at import; the
+results only pre-fill the upload form, so a miss is None rather than a
+guess.
+"""
+import re
+from datetime import date
+from decimal import Decimal, InvalidOperation
+from typing import Optional
+
+_HEB = "֐-׿"
+_QUOTE = "\"'׳״”"  # ASCII quotes, geresh, gershayim, right double quote
+
+# 1,234.50 | 1234.50 | 350,00 | 350 -- but not part of a date, time or longer number
+_AMOUNT = re.compile(r"(?<![\d.,/:\-])(\d{1,3}(?:,\d{3})+(?:\.\d{1,2})?|\d+(?:[.,]\d{1,2})?)(?![\d/:]|[.,]\d)")
+
+_TOTAL = re.compile(
+    r"(?<![a-z])(?:grand\s+total|total\s+due|amount\s+due|balance\s+due|total|to\s+pay)"
+    rf"|סה[{_QUOTE}]?כ|סך\s+(?:ה)?הכו?ל|לתשלום",
+    re.IGNORECASE,
+)
+# lines whose amounts are never the total
+_NOT_TOTAL = re.compile(r"(?<![a-z])(?:sub\s*-?\s*total|change|discount)|עודף|הנחה", re.IGNORECASE)
+
+_CURRENCIES = (
+    (re.compile(rf"₪|(?<![{_HEB}])ש[{_QUOTE}]?ח(?![{_HEB}])|\bNIS\b|\bILS\b", re.IGNORECASE), "ILS"),
+    (re.compile(r"\$|\bUSD\b", re.IGNORECASE), "USD"),
+    (re.compile(r"€|\bEUR\b", re.IGNORECASE), "EUR"),
+    (re.compile(r"£|\bGBP\b", re.IGNORECASE), "GBP"),
+)
+
+_EN_MONTHS = {m: i for i, m in enumerate(
+    ("jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"), start=1)}
+_HE_MONTHS = {m: i for i, m in enumerate(
+    ("ינואר", "פברואר", "מרץ", "אפריל", "מאי", "יוני", "יולי", "אוגוסט", "ספטמבר", "אוקטובר", "נובמבר", "דצמבר"),
+    start=1)}
+
+_DATE_ISO = re.compile(r"(?<!\d)(\d{4})[-/.](\d{1,2})[-/.](\d{1,2})(?!\d)")
+_DATE_NUMERIC = re.compile(r"(?<![\d.])(\d{1,2})[./-](\d{1,2})[./-](\d{4}|\d{2})(?![\d])")
+_DATE_EN_DMY = re.compile(r"(?<!\d)(\d{1,2})\s+(jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\.?,?\s+(\d{4})", re.IGNORECASE)
+_DATE_EN_MDY = re.compile(r"\b(jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\.?\s+(\d{1,2}),?\s+(\d{4})", re.IGNORECASE)
+_DATE_HE = re.compile(r"(?<!\d)(\d{1,2})\s+ב?(" + "|".join(_HE_MONTHS) + r")\s+(\d{4})")
+_DATE_LABEL = re.compile(r"(?<![a-z])date|תאריך", re.IGNORECASE)
+
+# receipt boilerplate that heads the page but is not who issued it
+_NOT_PROVIDER = re.compile(
+    r"(?<![a-z])(?:receipt|invoice|tax\s+invoice|tel|phone|fax|vat|reg\.?\s*no|www\.|http)"
+    rf"|קבלה|חשבונית|עוסק|ח[{_QUOTE}]?פ|טל[{_QUOTE}.:]|טלפון|פקס|מס[{_QUOTE}]",
+    re.IGNORECASE,
+)
+_PROVIDER_HINT = re.compile(
+    r"(?<![a-z])(?:ltd|inc|llc|clinic|hospital|pharmacy|medical|dr\.)"
+    rf"|בע[{_QUOTE}]?מ|מרפא[הת]|בית\s+מרקחת|ד[{_QUOTE}]ר|קופת\s+חולים",
+    re.IGNORECASE,
+)
+_LETTERS = re.compile(rf"[A-Za-z{_HEB}]")
+PROVIDER_SCAN_LINES = 6
+PROVIDER_MAX_CHARS = 80
+
+
+def _to_decimal(raw: str) -> Optional[Decimal]:
+    if "," in raw and "." not in raw and len(raw.rsplit(",", 1)[1]) <= 2:
+        raw = raw.replace(",", ".")  # 350,00
+    try:
+        return Decimal(raw.replace(",", ""))
+    except InvalidOperation:
+        return None
+
+
+def _amounts(line: str) -> list:
+    values = (_to_decimal(m.group(1)) for m in _AMOUNT.finditer(line))
+    return [v for v in values if v is not None and v > 0]
+
+
+def _currency(text: str) -> Optional[str]:
+    counts = {code: len(pattern.findall(text)) for pattern, code in _CURRENCIES}
+    best = max(counts, key=counts.get)
+    return best if counts[best] else None
+
+
+def _amount(lines: list) -> tuple:
+    """(amount, line) from the total lines, else the largest amount with a currency mark."""
+    candidates = []
+    for n, line in enumerate(lines):
+        if not _TOTAL.search(line) or _NOT_TOTAL.search(line):
+            continue
+        found = _amounts(_TOTAL.split(line, maxsplit=1)[-1]) or _amounts(line)
+        if not found and n + 1 < len(lines):
+            # the label and its value on separate lines
+            found, line = _amounts(lines[n + 1]), lines[n + 1]
+        candidates += [(v, line) for v in found]
+    if not candidates:
+        candidates = [(v, line) for line in lines if _currency(line) for v in _amounts(line)]
+    if not candidates:
+        return None, None
+    # the total is never smaller than the subtotal or VAT lines that share its labels
+    return max(candidates, key=lambda c: c[0])
+
+
+def _make_date(year: int, month: int, day: int) -> Optional[date]:
+    if year < 100:
+        year += 2000
+    if day <= 12 < month:
+        day, month = month, day  # a US-style date
+    try:
+        return date(year, month, day)
+    except ValueError:
+        return None
+
+
+def _dates(line: str) -> list:
+    found = []
+    for m in _DATE_ISO.finditer(line):
+        found.append((m.start(), _make_date(int(m.group(1)), int(m.group(2)), int(m.group(3)))))
+    for m in _DATE_NUMERIC.finditer(line):
+        found.append((m.start(), _make_date(int(m.group(3)), int(m.group(2)), int(m.group(1)))))
+    for m in _DATE_EN_DMY.finditer(line):
+        found.append((m.start(), _make_date(int(m.group(3)), _EN_MONTHS[m.group(2).lower()], int(m.group(1)))))
+    for m in _DATE_EN_MDY.finditer(line):
+        found.append((m.start(), _make_date(int(m.group(3)), _EN_MONTHS[m.group(1).lower()], int(m.group(2)))))
+    for m in _DATE_HE.finditer(line):
+        found.append((m.start(), _make_date(int(m.group(3)), _HE_MONTHS[m.group(2)], int(m.group(1)))))
+    return [d for _, d in sorted(found, key=lambda f: f[0]) if d is not None]
+
+
+def _date(lines: list) -> Optional[date]:
+    labelled = [line for line in lines if _DATE_LABEL.search(line)]
+    for line in labelled + lines:
+        found = _dates(line)
+        if found:
+            return found[0]
+    return None
+
+
+def _provider(lines: list) -> Optional[str]:
+    head = []
+    for line in lines[:PROVIDER_SCAN_LINES]:
+        if len(_LETTERS.findall(line)) < 2 or _NOT_PROVIDER.search(line) or _TOTAL.search(line) or _dates(line):
+            continue
+        head.append(line)
+    if not head:
+        return None
+    hinted = [line for line in head if _PROVIDER_HINT.search(line)]
+    return (hinted or head)[0][:PROVIDER_MAX_CHARS]
+
+
+def extract_fields(text: Optional[str]) -> dict:
+    """amount / currency / date / provider from one receipt's text; None where not found."""
+    lines = [" ".join(line.split()) for line in (text or "").splitlines()]
+    lines = [line for line in lines if line]
+    amount, amount_line = _amount(lines)
+    found = _date(lines)
+    return {
+        "amount": f"{amount:.2f}" if amount is not None else None,
+        # the mark on the total line decides; otherwise whatever the receipt uses most
+        "currency": (amount_line and _currency(amount_line)) or _currency(text or ""),
+        "date": found.isoformat() if found else None,
+        "provider": _provider(lines),
+    }
+
+
+def extract_batch(texts) -> list:
+    return [extract_fields(text) for text in texts]
+
+
+def merge_fields(structured_data: Optional[dict], text: Optional[str]) -> dict:
+    """structured_data with the extracted fields added; values already there win."""
+    fields = {k: v for k, v in extract_fields(text).items() if v is not None}
+    return {**fields, **(structured_data or {})}
+
+
+def extract_fields_node(state):
+    state["structured_data"] = merge_fields(state.get("structured_data"), state.get("raw_text"))
+    return state
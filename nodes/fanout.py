@@ -0,0 +1,170 @@
+import asyncio
+import contextvars
+import logging
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+logger = logging.getLogger('kabala')
+
+FIRST = "first"  # return the first usable result
+BEST = "best"    # wait for every engine (up to its timeout) and keep the highest score
+FANOUT_MODES = (FIRST, BEST)
+
+OCR_MODE = os.getenv("OCR_MODE", "route")
+OCR_FANOUT_WORKERS = int(os.getenv("OCR_FANOUT_WORKERS", "16"))
+
+
+def _parse_timeouts(spec: str) -> dict:
+    out = {}
+    for part in spec.split(","):
+        name, _, value = part.partition("=")
+        if name.strip() and value.strip():
+            out[name.strip()] = float(value)
+    return out
+
+
+# seconds each engine gets before its branch is abandoned
+ENGINE_TIMEOUTS = {"vision_api": 10.0, "document_ai": 30.0}
+ENGINE_TIMEOUTS.update(_parse_timeouts(os.getenv("OCR_ENGINE_TIMEOUTS", "")))
+
+_executor = ThreadPoolExecutor(max_workers=OCR_FANOUT_WORKERS, thread_name_prefix="ocr-fanout")
+
+
+def usable(state) -> bool:
+    return bool(state and (state.get("raw_text") or "").strip())
+
+
+def score(state) -> float:
+    """Engine confidence when it reports one, else a length-based stand-in.
+
+    The stand-in stays below any real confidence so a reported score wins.
+    """
+    if not usable(state):
+        return 0.0
+    confidence = state["metadata"].get("confidence")
+    if confidence is not None:
+        return 0.5 + confidence / 2
+    return min(len(state["raw_text"].strip()) / 2000, 0.5)
+
+
+def _mode(state) -> str:
+    mode = state.get("ocr_mode") or OCR_MODE
+    return mode if mode in FANOUT_MODES else FIRST
+
+
+def _collect(report: dict, finished: list, engine: str, f, started: float):
+    """Record one finished branch (a Future or an asyncio Task)."""
+    elapsed = round((time.perf_counter() - started) * 1000, 1)
+    try:
+        result = f.result()
+    except Exception as e:
+        report[engine] = {"status": "error", "ms": elapsed, "error": str(e)}
+        return
+    finished.append((engine, result))
+    report[engine] = {
+        "status": "ok" if usable(result) else "empty",
+        "ms": elapsed,
+        "score": round(score(result), 3),
+    }
+
+
+def _pick(state, mode: str, finished: list, report: dict):
+    candidates = [(engine, s) for engine, s in finished if usable(s)]
+    if mode == BEST and candidates:
+        winner, result = max(candidates, key=lambda c: score(c[1]))
+    elif candidates:
+        winner, result = candidates[0]
+    elif finished:
+        winner, result = finished[0]
+    else:
+        errors = "; ".join(f"{e}: {r.get('error') or r['status']}" for e, r in report.items())
+        raise RuntimeError(f"every OCR engine failed ({errors})")
+
+    state["raw_text"] = result.get("raw_text")
+    state["structured_data"] = result.get("structured_data")
+    state["metadata"] = {
+        **result["metadata"],
+        "fanout": {"mode": mode, "winner": winner, "engines": report},
+    }
+    logger.info(f"OCR fan-out ({mode}) picked {winner} for {state['file_url']}: {report}")
+    return state
+
+
+def make_fanout_node(engines: dict):
+    """A graph node that runs every engine in engines concurrently.
+
+    engines maps the metadata["engine"] name to its (already wrapped) node.
+    LangGraph joins parallel branches only after all of them finish, so the
+    race runs inside one node: each branch gets its own copy of the state,
+    the losers are cancelled (or, once started, left to finish in the
+    background with their result dropped), and the winner's state is
+    returned with a metadata["fanout"] summary.
+    """
+    def fanout_ocr_node(state):
+        mode = _mode(state)
+        started = time.perf_counter()
+        futures = {}
+        for engine, node in engines.items():
+            branch = {**state, "metadata": {}}
+            ctx = contextvars.copy_context()
+            futures[_executor.submit(ctx.run, node, branch)] = engine
+
+        deadlines = {f: started + ENGINE_TIMEOUTS.get(engine, 30.0) for f, engine in futures.items()}
+        report = {}
+        finished = []  # (engine, state) in completion order
+        pending = set(futures)
+        while pending:
+            now = time.perf_counter()
+            timeout = max(0.0, min(deadlines[f] for f in pending) - now)
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for f in done:
+                _collect(report, finished, futures[f], f, started)
+            now = time.perf_counter()
+            for f in [f for f in pending if now >= deadlines[f]]:
+                f.cancel()
+                pending.discard(f)
+                report[futures[f]] = {"status": "timeout", "ms": round((now - started) * 1000, 1)}
+            if mode == FIRST and any(usable(s) for _, s in finished):
+                break
+        for f in pending:
+            f.cancel()
+            report[futures[f]] = {"status": "cancelled", "ms": round((time.perf_counter() - started) * 1000, 1)}
+        return _pick(state, mode, finished, report)
+
+    return fanout_ocr_node
+
+
+def make_async_fanout_node(engines: dict):
+    """make_fanout_node for async engine nodes: the branches are tasks on the
+    running loop, and cancelling a loser really cancels its in-flight call."""
+    async def fanout_ocr_node_async(state):
+        mode = _mode(state)
+        started = time.perf_counter()
+        tasks = {asyncio.create_task(node({**state, "metadata": {}})): engine for engine, node in engines.items()}
+
+        deadlines = {t: started + ENGINE_TIMEOUTS.get(engine, 30.0) for t, engine in tasks.items()}
+        report = {}
+        finished = []
+        pending = set(tasks)
+        try:
+            while pending:
+                timeout = max(0.0, min(deadlines[t] for t in pending) - time.perf_counter())
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    _collect(report, finished, tasks[t], t, started)
+                now = time.perf_counter()
+                for t in [t for t in pending if now >= deadlines[t]]:
+                    t.cancel()
+                    pending.discard(t)
+                    report[tasks[t]] = {"status": "timeout", "ms": round((now - started) * 1000, 1)}
+                if mode == FIRST and any(usable(s) for _, s in finished):
+                    break
+        finally:
+            # also reached when the request itself is cancelled
+            for t in pending:
+                t.cancel()
+                report[tasks[t]] = {"status": "cancelled", "ms": round((time.perf_counter() - started) * 1000, 1)}
+        return _pick(state, mode, finished, report)
+
+    return fanout_ocr_node_async
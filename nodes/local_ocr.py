@@ -0,0 +1,187 @@
+"""On-box OCR tier that runs before the Google engines.
+
+Tesseract reads the image in a process pool; when its mean word confidence
+clears OCR_LOCAL_MIN_CONFIDENCE the graph stops there, otherwise the state
+goes on to vision / document_ai. Each tier appends its engine, latency and
+confidence to state["metadata"]["tiers"]; when a receipt is escalated the
+cloud tier also records how closely the local text agreed with it, which is
+the running accuracy estimate for the local tier.
+
+Needs pytesseract and the tesseract binary (with the heb and eng language
+data). Without them the tier is skipped and every image goes to Google.
+"""
+import asyncio
+import difflib
+import inspect
+import io
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import wraps
+
+from ocr_clients import afetch_file, fetch_file
+
+logger = logging.getLogger('kabala')
+
+OCR_LOCAL_TIER = os.getenv("OCR_LOCAL_TIER", "1") != "0"
+OCR_LOCAL_WORKERS = int(os.getenv("OCR_LOCAL_WORKERS", "2"))
+OCR_LOCAL_LANGS = os.getenv("OCR_LOCAL_LANGS", "heb+eng")
+# 0..1; tesseract word confidences are averaged and scaled from 0..100
+OCR_LOCAL_MIN_CONFIDENCE = float(os.getenv("OCR_LOCAL_MIN_CONFIDENCE", "0.85"))
+OCR_LOCAL_TIMEOUT = float(os.getenv("OCR_LOCAL_TIMEOUT", "10"))
+# a receipt with less text than this is more likely a bad read than a short receipt
+OCR_LOCAL_MIN_CHARS = int(os.getenv("OCR_LOCAL_MIN_CHARS", "20"))
+
+_pool = None
+_pool_lock = threading.Lock()
+_available = None
+
+
+def local_ocr_available() -> bool:
+    global _available
+    if _available is None:
+        try:
+            import pytesseract  # noqa: F401
+            _available = shutil.which("tesseract") is not None
+        except ImportError:
+            _available = False
+        if OCR_LOCAL_TIER and not _available:
+            logger.info("Local OCR tier disabled: pytesseract or the tesseract binary is missing")
+    return OCR_LOCAL_TIER and _available
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=OCR_LOCAL_WORKERS)
+    return _pool
+
+
+def _tesseract(image_bytes: bytes, langs: str):
+    """Runs in a pool process: (text, mean confidence 0..1 or None)."""
+    import pytesseract
+    from PIL import Image, ImageOps
+
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(image_bytes))).convert("L")
+    data = pytesseract.image_to_data(image, lang=langs, output_type=pytesseract.Output.DICT)
+    lines = {}
+    confidences = []
+    for i, word in enumerate(data["text"]):
+        conf = float(data["conf"][i])
+        if not word.strip() or conf < 0:
+            continue
+        key = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+        lines.setdefault(key, []).append(word)
+        confidences.append(conf)
+    text = "\n".join(" ".join(words) for _, words in sorted(lines.items()))
+    return text, (sum(confidences) / len(confidences) / 100 if confidences else None)
+
+
+def _tier(state, entry: dict):
+    state["metadata"].setdefault("tiers", []).append(entry)
+
+
+def _failed(state, entry: dict, started: float, error: Exception):
+    # any failure just means the cloud tier does the work
+    entry.update(ms=round((time.perf_counter() - started) * 1000, 1), error=str(error), accepted=False)
+    _tier(state, entry)
+    logger.warning(f"Local OCR failed for {state['file_url']}: {error}")
+    return state
+
+
+def _read(state, entry: dict, started: float, fetched: float, text: str, confidence):
+    accepted = confidence is not None and confidence >= OCR_LOCAL_MIN_CONFIDENCE and len(text) >= OCR_LOCAL_MIN_CHARS
+    entry.update(
+        ms=round((time.perf_counter() - started) * 1000, 1),
+        fetch_ms=round((fetched - started) * 1000, 1),
+        confidence=round(confidence, 3) if confidence is not None else None,
+        chars=len(text),
+        accepted=accepted,
+    )
+    _tier(state, entry)
+    state["raw_text"] = text
+    if accepted:
+        state["metadata"]["engine"] = "tesseract"
+        state["metadata"]["confidence"] = confidence
+    return state
+
+
+def local_ocr_node(state):
+    started = time.perf_counter()
+    entry = {"tier": "local", "engine": "tesseract"}
+    try:
+        image_bytes = fetch_file(state["file_url"])
+        fetched = time.perf_counter()
+        text, confidence = _get_pool().submit(_tesseract, image_bytes, OCR_LOCAL_LANGS).result(OCR_LOCAL_TIMEOUT)
+    except Exception as e:
+        return _failed(state, entry, started, e)
+    return _read(state, entry, started, fetched, text, confidence)
+
+
+async def local_ocr_node_async(state):
+    started = time.perf_counter()
+    entry = {"tier": "local", "engine": "tesseract"}
+    try:
+        image_bytes = await afetch_file(state["file_url"])
+        fetched = time.perf_counter()
+        future = _get_pool().submit(_tesseract, image_bytes, OCR_LOCAL_LANGS)
+        text, confidence = await asyncio.wait_for(asyncio.wrap_future(future), OCR_LOCAL_TIMEOUT)
+    except Exception as e:
+        return _failed(state, entry, started, e)
+    return _read(state, entry, started, fetched, text, confidence)
+
+
+def local_router(state, escalate):
+    """After the local tier: finish, or hand over to escalate(state)'s node."""
+    tiers = state["metadata"].get("tiers") or []
+    if tiers and tiers[-1].get("accepted"):
+        return "done"
+    return escalate(state)
+
+
+def _agreement(local_text: str, cloud_text: str) -> float:
+    # share of characters the local read got right, taking the cloud text as truth
+    return round(difflib.SequenceMatcher(None, local_text, cloud_text, autojunk=False).ratio(), 3)
+
+
+def escalation_tier(tier: str, node):
+    """Wrap a cloud node (sync or async) so it reports as a tier and scores the local read against it."""
+    def before(state):
+        return state.get("raw_text") if state["metadata"].get("tiers") else None, time.perf_counter()
+
+    # timed before the local read is scored, so ms is the cloud call alone
+    def after(state, started):
+        entry = {
+            "tier": tier,
+            "engine": state["metadata"].get("engine"),
+            "ms": round((time.perf_counter() - started) * 1000, 1),
+            "confidence": state["metadata"].get("confidence"),
+        }
+        _tier(state, entry)
+        return entry
+
+    if inspect.iscoroutinefunction(node):
+        @wraps(node)
+        async def async_wrapper(state):
+            local_text, started = before(state)
+            state = await node(state)
+            entry = after(state, started)
+            if local_text is not None and state.get("raw_text"):
+                # SequenceMatcher is quadratic on long texts; keep it off the event loop
+                entry["local_agreement"] = await asyncio.to_thread(_agreement, local_text, state["raw_text"])
+            return state
+        return async_wrapper
+
+    @wraps(node)
+    def wrapper(state):
+        local_text, started = before(state)
+        state = node(state)
+        entry = after(state, started)
+        if local_text is not None and state.get("raw_text"):
+            entry["local_agreement"] = _agreement(local_text, state["raw_text"])
+        return state
+    return wrapper
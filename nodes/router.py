@@ -1,4 +1,18 @@
-def ocr_router(state):
+from nodes.fanout import FANOUT_MODES, OCR_MODE
+from nodes.local_ocr import local_ocr_available
+
+
+def route_by_type(state):
     if state["file_type"] == "pdf":
         return "document_ai"
     return "vision"
+
+
+def ocr_router(state):
+    # "first"/"best" race both engines; the default routes by file type
+    if (state.get("ocr_mode") or OCR_MODE) in FANOUT_MODES:
+        return "fanout"
+    # images try the on-box tier first and escalate only when it is unsure
+    if state["file_type"] != "pdf" and local_ocr_available():
+        return "local"
+    return route_by_type(state)
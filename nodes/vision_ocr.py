@@ -1,11 +1,36 @@
 from google.cloud import vision
+from ocr_clients import call_slot, get_async_client, get_vision_client, track_call
 
-def vision_ocr_node(state):
-    client = vision.ImageAnnotatorClient()
-    image = vision.Image()
-    image.source.image_uri = state["file_url"]
-    response = client.text_detection(image=image)
+
+def _apply(state, response):
+    # a per-image failure comes back as a normal response with error set
+    if response.error.message:
+        raise RuntimeError(f"Vision OCR failed: {response.error.message}")
     texts = response.text_annotations
     state["raw_text"] = texts[0].description if texts else ""
+    pages = response.full_text_annotation.pages
+    state["metadata"]["confidence"] = sum(p.confidence for p in pages) / len(pages) if pages else None
     state["metadata"]["engine"] = "vision_api"
     return state
+
+
+def vision_ocr_node(state):
+    client = get_vision_client()
+    image = vision.Image()
+    image.source.image_uri = state["file_url"]
+    with track_call("vision"):
+        response = client.text_detection(image=image)
+    return _apply(state, response)
+
+
+async def vision_ocr_node_async(state):
+    # the async client has no text_detection helper; this is the request it builds
+    request = vision.AnnotateImageRequest(
+        image=vision.Image(source=vision.ImageSource(image_uri=state["file_url"])),
+        features=[vision.Feature(type_=vision.Feature.Type.TEXT_DETECTION)],
+    )
+    client = get_async_client("vision")
+    async with call_slot("vision"):
+        with track_call("vision"):
+            response = await client.batch_annotate_images(requests=[request])
+    return _apply(state, response.responses[0])
@@ -0,0 +1,148 @@
+import asyncio
+import json
+import logging
+import os
+
+from ocr_cache import cached_ocr_node, get_cached_ocr, hash_bytes, put_cached_ocr
+from ocr_clients import FetchRejected, afetch_file, call_slot, check_file_url, get_async_client, remember_file, track_call
+from metrics import ocr_duration, ocr_results
+from nodes.extract_fields import extract_batch, extract_fields
+
+logger = logging.getLogger('kabala')
+
+# Vision accepts at most 16 images per synchronous batch_annotate_images call
+VISION_BATCH_SIZE = 16
+# files downloaded (and hashed) at once for one batch
+OCR_BATCH_CONCURRENCY = int(os.getenv("OCR_BATCH_CONCURRENCY", "8"))
+OCR_BATCH_MAX_ITEMS = int(os.getenv("OCR_BATCH_MAX_ITEMS", "64"))
+
+
+def _result(index, item, raw_text=None, structured_data=None, engine=None, error=None, cache=None):
+    if engine:
+        ocr_results.inc(engine, "error" if error else "ok")
+    metadata = {"engine": engine} if engine else {}
+    if cache:
+        metadata["cache"] = cache
+    return {
+        "index": index,
+        "file_url": item["file_url"],
+        "file_type": item["file_type"],
+        "raw_text": raw_text,
+        "structured_data": structured_data,
+        "metadata": metadata,
+        "error": error,
+    }
+
+
+async def _fetch(index, item, slots):
+    """(content_hash, pdf bytes, error) for one item, hashed from the bytes we download ourselves."""
+    try:
+        async with slots:
+            data = await afetch_file(check_file_url(item["file_url"]))
+    except FetchRejected as e:
+        return None, None, _result(index, item, error=str(e))
+    except Exception as e:
+        logger.warning(f"Could not fetch {item['file_url']} for batch OCR: {e}")
+        return None, None, _result(index, item, error="Could not fetch file_url")
+    # Document AI takes the bytes; Vision reads the image from its URL, so those are dropped here
+    return await asyncio.to_thread(hash_bytes, data), data if item["file_type"] == "pdf" else None, None
+
+
+async def _vision_group(group):
+    """OCR up to VISION_BATCH_SIZE images with one batch_annotate_images call."""
+    from google.cloud import vision
+
+    requests = [
+        vision.AnnotateImageRequest(
+            image=vision.Image(source=vision.ImageSource(image_uri=item["file_url"])),
+            features=[vision.Feature(type_=vision.Feature.Type.TEXT_DETECTION)],
+        )
+        for _, item, _ in group
+    ]
+    client = get_async_client("vision")
+    try:
+        async with call_slot("vision"):
+            with track_call("vision"), ocr_duration.time("vision_api"):
+                response = await client.batch_annotate_images(requests=requests)
+    except Exception as e:
+        return [_result(i, item, engine="vision_api", error=str(e)) for i, item, _ in group]
+
+    texts = [res.text_annotations[0].description if res.text_annotations else "" for res in response.responses]
+    out = []
+    for (i, item, content_hash), res, text, fields in zip(group, response.responses, texts, extract_batch(texts)):
+        if res.error.message:
+            out.append(_result(i, item, engine="vision_api", error=res.error.message))
+            continue
+        if text:
+            # the same entry the graph's vision node stores; fields are extracted after it
+            await asyncio.to_thread(put_cached_ocr, content_hash, "vision_api", {"raw_text": text, "structured_data": None})
+        out.append(_result(i, item, raw_text=text, structured_data=fields, engine="vision_api", cache="miss"))
+    return out
+
+
+async def _document_ai_item(index, item, content_hash):
+    # Document AI batch_process_documents only reads from and writes to GCS,
+    # so PDFs are processed one request each, in parallel with the image groups.
+    from nodes.document_ai_ocr import document_ai_ocr_node_async
+
+    state = {
+        "file_url": item["file_url"],
+        "file_type": item["file_type"],
+        "content_hash": content_hash,
+        "raw_text": None,
+        "structured_data": None,
+        "metadata": {},
+    }
+    try:
+        with ocr_duration.time("document_ai"):
+            state = await cached_ocr_node("document_ai")(document_ai_ocr_node_async)(state)
+    except Exception as e:
+        return [_result(index, item, engine="document_ai", error=str(e))]
+    return [_result(index, item, raw_text=state["raw_text"], structured_data=state["structured_data"],
+                    engine="document_ai", cache=state["metadata"].get("cache"))]
+
+
+def plan_batches(ready):
+    """Split (index, item, content_hash) into Vision groups of images and single Document AI jobs."""
+    images = [entry for entry in ready if entry[1]["file_type"] != "pdf"]
+    pdfs = [entry for entry in ready if entry[1]["file_type"] == "pdf"]
+    jobs = [(_vision_group, (images[n:n + VISION_BATCH_SIZE],)) for n in range(0, len(images), VISION_BATCH_SIZE)]
+    jobs += [(_document_ai_item, entry) for entry in pdfs]
+    return jobs
+
+
+async def stream_batch(items):
+    """Yield one NDJSON line per item, in completion order.
+
+    Every file is downloaded and hashed here, as /ocr does, so images seen
+    before come from the OCR cache and only the rest go to Vision. Google
+    calls hold call_slot like the graph's, under the caller's per-user limit.
+    """
+    slots = asyncio.Semaphore(OCR_BATCH_CONCURRENCY)
+    fetched = await asyncio.gather(*(_fetch(i, item, slots) for i, item in enumerate(items)))
+    ready = []
+    for (i, item), (content_hash, data, error) in zip(enumerate(items), fetched):
+        if error:
+            yield json.dumps(error) + "\n"
+            continue
+        if data is not None:
+            # in this context, so the Document AI tasks created below see it
+            remember_file(item["file_url"], data)
+        if item["file_type"] != "pdf":
+            cached = await asyncio.to_thread(get_cached_ocr, content_hash, "vision_api")
+            if cached is not None:
+                raw_text = cached.get("raw_text")
+                fields = cached.get("structured_data") or extract_fields(raw_text)
+                yield json.dumps(_result(i, item, raw_text=raw_text, structured_data=fields,
+                                         engine="vision_api", cache="hit")) + "\n"
+                continue
+        ready.append((i, item, content_hash))
+
+    tasks = [asyncio.create_task(fn(*args)) for fn, args in plan_batches(ready)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            for res in await next_done:
+                yield json.dumps(res) + "\n"
+    finally:
+        for task in tasks:
+            task.cancel()
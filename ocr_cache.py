@@ -0,0 +1,162 @@
+import asyncio
+import hashlib
+import inspect
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from functools import wraps
+
+from sqlalchemy import update
+
+from database import SessionLocal
+from models import OcrCacheEntry
+
+logger = logging.getLogger('kabala')
+
+OCR_CACHE_MEMORY_ITEMS = int(os.getenv("OCR_CACHE_MEMORY_ITEMS", "512"))
+OCR_CACHE_TTL_SECONDS = int(os.getenv("OCR_CACHE_TTL_SECONDS", str(30 * 24 * 3600)))
+
+# (content_hash, engine) -> (stored_at, result); most recently used last
+_memory: "OrderedDict[tuple[str, str], tuple[datetime, dict]]" = OrderedDict()
+_lock = threading.Lock()
+
+
+def hash_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _expired(stored_at: datetime) -> bool:
+    return datetime.utcnow() - stored_at > timedelta(seconds=OCR_CACHE_TTL_SECONDS)
+
+
+def _remember(key, stored_at: datetime, result: dict):
+    with _lock:
+        _memory[key] = (stored_at, result)
+        _memory.move_to_end(key)
+        while len(_memory) > OCR_CACHE_MEMORY_ITEMS:
+            _memory.popitem(last=False)
+
+
+def get_cached_ocr(content_hash: str, engine: str):
+    """Return the cached OCR result for these bytes and engine, or None."""
+    if not content_hash:
+        return None
+    key = (content_hash, engine)
+    with _lock:
+        hit = _memory.get(key)
+        if hit is not None:
+            if not _expired(hit[0]):
+                _memory.move_to_end(key)
+                return hit[1]
+            del _memory[key]
+
+    db = SessionLocal()
+    try:
+        entry = db.get(OcrCacheEntry, key)
+        if entry is None:
+            return None
+        stored_at = datetime.fromisoformat(entry.created_at)
+        if _expired(stored_at):
+            db.delete(entry)
+            db.commit()
+            return None
+        db.execute(
+            update(OcrCacheEntry)
+            .where(OcrCacheEntry.content_hash == content_hash, OcrCacheEntry.engine == engine)
+            .values(hits=OcrCacheEntry.hits + 1)
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+        result = json.loads(entry.result)
+    finally:
+        db.close()
+
+    _remember(key, stored_at, result)
+    return result
+
+
+def put_cached_ocr(content_hash: str, engine: str, result: dict):
+    if not content_hash:
+        return
+    stored_at = datetime.utcnow()
+    db = SessionLocal()
+    try:
+        db.merge(OcrCacheEntry(
+            content_hash=content_hash,
+            engine=engine,
+            result=json.dumps(result),
+            hits=0,
+            created_at=stored_at.isoformat(),
+        ))
+        db.commit()
+    except Exception:
+        # a cache write must never fail the OCR itself
+        db.rollback()
+        logger.warning(f"Failed to store OCR cache entry {content_hash[:12]}/{engine}", exc_info=True)
+    finally:
+        db.close()
+    _remember((content_hash, engine), stored_at, result)
+
+
+def purge_expired_ocr_cache() -> int:
+    cutoff = (datetime.utcnow() - timedelta(seconds=OCR_CACHE_TTL_SECONDS)).isoformat()
+    db = SessionLocal()
+    try:
+        n = db.query(OcrCacheEntry).filter(OcrCacheEntry.created_at < cutoff).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+    with _lock:
+        for key in [k for k, (stored_at, _) in _memory.items() if _expired(stored_at)]:
+            del _memory[key]
+    return n
+
+
+def cached_ocr_node(engine: str):
+    """Wrap an OCR graph node so repeated content skips the Google call.
+
+    Only states carrying a content_hash are cached; URL-only requests
+    go straight to the engine. A read with no text is not cached, so a
+    blank or failed read is retried next time rather than kept for the TTL.
+    """
+    def hit(state, cached):
+        state["raw_text"] = cached.get("raw_text")
+        state["structured_data"] = cached.get("structured_data")
+        state["metadata"]["engine"] = engine
+        state["metadata"]["cache"] = "hit"
+        return state
+
+    def entry(state):
+        state["metadata"]["cache"] = "miss"
+        return {"raw_text": state.get("raw_text"), "structured_data": state.get("structured_data")}
+
+    def decorator(node):
+        if inspect.iscoroutinefunction(node):
+            @wraps(node)
+            async def async_wrapper(state):
+                content_hash = state.get("content_hash")
+                # the cache is a database lookup; keep it off the event loop
+                cached = await asyncio.to_thread(get_cached_ocr, content_hash, engine) if content_hash else None
+                if cached is not None:
+                    return hit(state, cached)
+                state = await node(state)
+                if content_hash and state.get("raw_text"):
+                    await asyncio.to_thread(put_cached_ocr, content_hash, engine, entry(state))
+                return state
+            return async_wrapper
+
+        @wraps(node)
+        def wrapper(state):
+            content_hash = state.get("content_hash")
+            cached = get_cached_ocr(content_hash, engine)
+            if cached is not None:
+                return hit(state, cached)
+            state = node(state)
+            if content_hash and state.get("raw_text"):
+                put_cached_ocr(content_hash, engine, entry(state))
+            return state
+        return wrapper
+    return decorator
@@ -0,0 +1,176 @@
+"""Durable LangGraph checkpoints for the OCR graph, stored in our own database.
+
+Every OCR run is a LangGraph thread keyed by the file (content hash, else
+URL), its type and the OCR mode, and each finished node is checkpointed to
+ocr_checkpoints / ocr_checkpoint_writes. invoke_ocr_graph uses that to make
+retries idempotent: a finished thread that read text returns its stored
+final state, an interrupted one (crash, timeout, failed node) resumes
+after the last node that finished, and a new file (or a blank read) runs
+the graph from the start.
+astream_ocr_graph does the same while streaming PDF pages as they finish.
+The saver itself is in ocr_checkpoint_saver, which imports langgraph.
+"""
+import asyncio
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import threading
+import weakref
+from datetime import datetime, timedelta
+
+from database import SessionLocal
+from metrics import ocr_graph_runs
+from models import OcrCheckpoint, OcrCheckpointWrite
+
+logger = logging.getLogger('kabala')
+
+OCR_CHECKPOINTS = os.getenv("OCR_CHECKPOINTS", "1") != "0"
+OCR_CHECKPOINT_TTL_SECONDS = int(os.getenv("OCR_CHECKPOINT_TTL_SECONDS", str(7 * 24 * 3600)))
+
+
+def purge_expired_checkpoints() -> int:
+    """Drop every thread whose newest checkpoint is older than OCR_CHECKPOINT_TTL_SECONDS."""
+    cutoff = (datetime.utcnow() - timedelta(seconds=OCR_CHECKPOINT_TTL_SECONDS)).isoformat()
+    db = SessionLocal()
+    try:
+        fresh = db.query(OcrCheckpoint.thread_id).filter(OcrCheckpoint.created_at >= cutoff)
+        expired = [t for (t,) in db.query(OcrCheckpoint.thread_id).filter(
+            OcrCheckpoint.created_at < cutoff, OcrCheckpoint.thread_id.not_in(fresh),
+        ).distinct()]
+        if expired:
+            db.query(OcrCheckpointWrite).filter(OcrCheckpointWrite.thread_id.in_(expired)).delete(synchronize_session=False)
+            db.query(OcrCheckpoint).filter(OcrCheckpoint.thread_id.in_(expired)).delete(synchronize_session=False)
+            db.commit()
+    finally:
+        db.close()
+    return len(expired)
+
+
+def ocr_thread_id(state) -> str:
+    """The same file, type and mode always map to the same thread."""
+    from nodes.fanout import OCR_MODE
+
+    source = state.get("content_hash") or hashlib.sha256(state["file_url"].encode()).hexdigest()
+    return f"ocr:{source}:{state['file_type']}:{state.get('ocr_mode') or OCR_MODE}"
+
+
+def _plan(thread_id: str, snapshot) -> str:
+    """How to run a thread given its latest checkpoint: replayed, resumed or fresh.
+
+    A finished thread that read no text runs again, like the OCR cache,
+    so a blank read is not returned for as long as the checkpoint lives.
+    """
+    if snapshot.values and not snapshot.next and snapshot.values.get("raw_text"):
+        outcome = "replayed"
+        logger.debug(f"OCR thread {thread_id} already finished, returning its stored state")
+    elif snapshot.next:
+        outcome = "resumed"
+        logger.info(f"Resuming OCR thread {thread_id} at {', '.join(snapshot.next)}")
+    else:
+        outcome = "fresh"
+    ocr_graph_runs.inc(outcome)
+    return outcome
+
+
+# a retry that arrives while the first attempt is still running waits for it
+# rather than starting a second run of the same thread in this process;
+# thread_id -> [lock, holders + waiters], dropped when the last one leaves
+_thread_locks: dict = {}
+_thread_locks_guard = threading.Lock()
+_async_thread_locks = weakref.WeakKeyDictionary()  # loop -> {thread_id: [asyncio.Lock, users]}
+
+
+@contextlib.contextmanager
+def _thread_lock(thread_id: str):
+    with _thread_locks_guard:
+        entry = _thread_locks.setdefault(thread_id, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _thread_locks_guard:
+            entry[1] -= 1
+            if not entry[1]:
+                del _thread_locks[thread_id]
+
+
+def invoke_ocr_graph(graph, state):
+    """graph.invoke(state), but finished runs are returned and interrupted ones resumed."""
+    if graph.checkpointer is None:
+        return graph.invoke(state)
+    thread_id = ocr_thread_id(state)
+    config = {"configurable": {"thread_id": thread_id}}
+    with _thread_lock(thread_id):
+        snapshot = graph.get_state(config)
+        outcome = _plan(thread_id, snapshot)
+        if outcome == "replayed":
+            return snapshot.values
+        return graph.invoke(None if outcome == "resumed" else state, config)
+
+
+@contextlib.asynccontextmanager
+async def _async_lock(thread_id: str):
+    # no guard needed: only this loop's tasks touch its dict
+    locks = _async_thread_locks.setdefault(asyncio.get_running_loop(), {})
+    entry = locks.setdefault(thread_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del locks[thread_id]
+
+
+async def ainvoke_ocr_graph(graph, state):
+    """invoke_ocr_graph with graph.ainvoke, for callers on the event loop."""
+    if graph.checkpointer is None:
+        return await graph.ainvoke(state)
+    thread_id = ocr_thread_id(state)
+    config = {"configurable": {"thread_id": thread_id}}
+    async with _async_lock(thread_id):
+        snapshot = await graph.aget_state(config)
+        outcome = _plan(thread_id, snapshot)
+        if outcome == "replayed":
+            return snapshot.values
+        return await graph.ainvoke(None if outcome == "resumed" else state, config)
+
+
+async def astream_ocr_graph(graph, state):
+    """ainvoke_ocr_graph as NDJSON lines.
+
+    A {"type": "page"} line for each page as Document AI finishes it, then
+    one {"type": "result"} line with the final state, or {"type": "error"}
+    if the run fails after the response has started.
+    """
+    config = None
+    graph_input = state
+    lock = contextlib.nullcontext()
+    if graph.checkpointer is not None:
+        thread_id = ocr_thread_id(state)
+        config = {"configurable": {"thread_id": thread_id}}
+        lock = _async_lock(thread_id)
+    async with lock:
+        try:
+            if config is not None:
+                snapshot = await graph.aget_state(config)
+                outcome = _plan(thread_id, snapshot)
+                if outcome == "replayed":
+                    yield json.dumps({"type": "result", "result": snapshot.values}) + "\n"
+                    return
+                graph_input = None if outcome == "resumed" else state
+            final = None
+            async for mode, chunk in graph.astream(graph_input, config, stream_mode=["custom", "values"]):
+                if mode == "custom":
+                    yield json.dumps({"type": "page", **chunk}) + "\n"
+                else:
+                    final = chunk
+        except Exception as e:
+            logger.error(f"Streaming OCR of {state['file_url']} failed: {e}")
+            yield json.dumps({"type": "error", "error": str(e)}) + "\n"
+            return
+        yield json.dumps({"type": "result", "result": final}) + "\n"
@@ -0,0 +1,177 @@
+"""DbCheckpointSaver: LangGraph checkpoints in ocr_checkpoints / ocr_checkpoint_writes.
+
+Kept apart from ocr_checkpoint because langgraph.checkpoint.base pulls in
+langchain_core; only startup.ocr_graph imports this, when it builds the graph.
+"""
+import asyncio
+from datetime import datetime
+
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    CheckpointTuple,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+)
+from sqlalchemy.dialects import postgresql, sqlite
+
+from database import SessionLocal, engine
+from models import OcrCheckpoint, OcrCheckpointWrite
+
+
+def _upsert(model, rows: list, replace: bool):
+    """One INSERT .. ON CONFLICT statement for rows.
+
+    Checkpoints are written several times per OCR run; a single statement
+    never holds a read lock it then has to upgrade, which is what makes
+    concurrent SQLite writers wait on each other's busy timeouts.
+    """
+    insert = postgresql.insert if engine.dialect.name == "postgresql" else sqlite.insert
+    stmt = insert(model.__table__).values(rows)
+    keys = [c.name for c in model.__table__.primary_key.columns]
+    if not replace:
+        return stmt.on_conflict_do_nothing(index_elements=keys)
+    return stmt.on_conflict_do_update(
+        index_elements=keys,
+        set_={c.name: stmt.excluded[c.name] for c in model.__table__.columns if c.name not in keys},
+    )
+
+
+def _config(thread_id, checkpoint_ns, checkpoint_id):
+    if checkpoint_id is None:
+        return None
+    return {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint_id}}
+
+
+class DbCheckpointSaver(BaseCheckpointSaver):
+    """A checkpoint saver on SessionLocal.
+
+    Checkpoints are stored whole, channel values included: OCR states are
+    a few KB, so the per-channel blob table the upstream savers use to
+    share unchanged values between checkpoints is not worth its joins.
+    The async methods run the sync ones in a thread.
+    """
+
+    def _tuple(self, db, row: OcrCheckpoint) -> CheckpointTuple:
+        writes = (
+            db.query(OcrCheckpointWrite)
+            .filter_by(thread_id=row.thread_id, checkpoint_ns=row.checkpoint_ns, checkpoint_id=row.checkpoint_id)
+            .order_by(OcrCheckpointWrite.task_id, OcrCheckpointWrite.idx)
+            .all()
+        )
+        return CheckpointTuple(
+            config=_config(row.thread_id, row.checkpoint_ns, row.checkpoint_id),
+            checkpoint=self.serde.loads_typed((row.checkpoint_type, row.checkpoint)),
+            metadata=self.serde.loads_typed((row.metadata_type, row.checkpoint_metadata)),
+            parent_config=_config(row.thread_id, row.checkpoint_ns, row.parent_checkpoint_id),
+            pending_writes=[(w.task_id, w.channel, self.serde.loads_typed((w.value_type, w.value))) for w in writes],
+        )
+
+    def get_tuple(self, config):
+        configurable = config["configurable"]
+        db = SessionLocal()
+        try:
+            query = db.query(OcrCheckpoint).filter_by(
+                thread_id=configurable["thread_id"], checkpoint_ns=configurable.get("checkpoint_ns", ""),
+            )
+            if checkpoint_id := get_checkpoint_id(config):
+                query = query.filter_by(checkpoint_id=checkpoint_id)
+            # checkpoint ids are time-ordered (uuid6), so the largest is the latest
+            row = query.order_by(OcrCheckpoint.checkpoint_id.desc()).first()
+            return self._tuple(db, row) if row is not None else None
+        finally:
+            db.close()
+
+    def list(self, config, *, filter=None, before=None, limit=None):
+        db = SessionLocal()
+        try:
+            query = db.query(OcrCheckpoint)
+            if config:
+                configurable = config["configurable"]
+                query = query.filter_by(thread_id=configurable["thread_id"])
+                if configurable.get("checkpoint_ns") is not None:
+                    query = query.filter_by(checkpoint_ns=configurable["checkpoint_ns"])
+                if checkpoint_id := get_checkpoint_id(config):
+                    query = query.filter_by(checkpoint_id=checkpoint_id)
+            if before and (before_id := get_checkpoint_id(before)):
+                query = query.filter(OcrCheckpoint.checkpoint_id < before_id)
+            tuples = []
+            for row in query.order_by(OcrCheckpoint.checkpoint_id.desc()):
+                if limit is not None and len(tuples) >= limit:
+                    break
+                checkpoint_tuple = self._tuple(db, row)
+                if filter and any(checkpoint_tuple.metadata.get(k) != v for k, v in filter.items()):
+                    continue
+                tuples.append(checkpoint_tuple)
+        finally:
+            db.close()
+        yield from tuples
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        configurable = config["configurable"]
+        thread_id = configurable["thread_id"]
+        checkpoint_ns = configurable.get("checkpoint_ns", "")
+        checkpoint_type, checkpoint_bytes = self.serde.dumps_typed(checkpoint)
+        metadata_type, metadata_bytes = self.serde.dumps_typed(get_checkpoint_metadata(config, metadata))
+        row = {
+            "thread_id": thread_id,
+            "checkpoint_ns": checkpoint_ns,
+            "checkpoint_id": checkpoint["id"],
+            "parent_checkpoint_id": configurable.get("checkpoint_id"),
+            "checkpoint_type": checkpoint_type,
+            "checkpoint": checkpoint_bytes,
+            "metadata_type": metadata_type,
+            "metadata": metadata_bytes,
+            "created_at": datetime.utcnow().isoformat(),
+        }
+        with engine.begin() as conn:
+            conn.execute(_upsert(OcrCheckpoint, [row], replace=True))
+        return _config(thread_id, checkpoint_ns, checkpoint["id"])
+
+    def put_writes(self, config, writes, task_id, task_path=""):
+        configurable = config["configurable"]
+        key = {
+            "thread_id": configurable["thread_id"],
+            "checkpoint_ns": configurable.get("checkpoint_ns", ""),
+            "checkpoint_id": configurable["checkpoint_id"],
+            "task_id": task_id,
+        }
+        regular, special = [], []
+        for n, (channel, value) in enumerate(writes):
+            idx = WRITES_IDX_MAP.get(channel, n)
+            value_type, value_bytes = self.serde.dumps_typed(value)
+            row = {**key, "idx": idx, "channel": channel, "value_type": value_type, "value": value_bytes,
+                   "task_path": task_path}
+            (regular if idx >= 0 else special).append(row)
+        with engine.begin() as conn:
+            # a regular write is recorded once; the special ones (error, interrupt) keep the latest
+            if regular:
+                conn.execute(_upsert(OcrCheckpointWrite, regular, replace=False))
+            if special:
+                conn.execute(_upsert(OcrCheckpointWrite, special, replace=True))
+
+    def delete_thread(self, thread_id):
+        db = SessionLocal()
+        try:
+            db.query(OcrCheckpointWrite).filter_by(thread_id=thread_id).delete(synchronize_session=False)
+            db.query(OcrCheckpoint).filter_by(thread_id=thread_id).delete(synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    async def aget_tuple(self, config):
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self, config, *, filter=None, before=None, limit=None):
+        tuples = await asyncio.to_thread(lambda: list(self.list(config, filter=filter, before=before, limit=limit)))
+        for checkpoint_tuple in tuples:
+            yield checkpoint_tuple
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config, writes, task_id, task_path=""):
+        await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id):
+        await asyncio.to_thread(self.delete_thread, thread_id)
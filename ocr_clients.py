@@ -0,0 +1,298 @@
+import asyncio
+import contextvars
+import logging
+import os
+import threading
+import time
+import weakref
+from contextlib import AsyncExitStack, asynccontextmanager, contextmanager
+from urllib.parse import urlsplit
+
+from metrics import ocr_client_call_duration, ocr_slot_wait
+from startup import google_credentials
+from upload_ingest import MAX_UPLOAD_BYTES, READ_CHUNK_BYTES
+
+logger = logging.getLogger('kabala')
+
+WARMUP_TIMEOUT = 5.0
+
+# outstanding async Google calls per process, and per user within that
+OCR_MAX_IN_FLIGHT = int(os.getenv("OCR_MAX_IN_FLIGHT", "200"))
+OCR_MAX_IN_FLIGHT_PER_USER = int(os.getenv("OCR_MAX_IN_FLIGHT_PER_USER", "10"))
+
+# who the OCR calls in this context are for; None skips the per-user limit
+ocr_user_var = contextvars.ContextVar("ocr_user", default=None)
+
+OCR_FETCH_TIMEOUT = float(os.getenv("OCR_FETCH_TIMEOUT", "10"))
+# files are only downloaded from here: our Cloudinary delivery URLs, never whatever a caller names
+OCR_FETCH_ORIGINS = {o.strip().rstrip("/") for o in os.getenv("OCR_FETCH_ORIGINS", "https://res.cloudinary.com").split(",") if o.strip()}
+
+# url -> bytes the request already downloaded, so the OCR nodes don't fetch them again
+_prefetched = contextvars.ContextVar("ocr_prefetched", default={})
+
+_clients = {}
+_stats = {}
+_lock = threading.Lock()
+
+
+def _new_stats():
+    return {
+        "created_at": None,
+        "setup_ms": None,
+        "warm": False,
+        "calls": 0,
+        "errors": 0,
+        "total_ms": 0.0,
+        "max_ms": 0.0,
+    }
+
+
+def _build_vision():
+    from google.cloud import vision
+    return vision.ImageAnnotatorClient()
+
+
+def _build_documentai():
+    from google.cloud import documentai
+    return documentai.DocumentProcessorServiceClient()
+
+
+_builders = {
+    "vision": _build_vision,
+    "document_ai": _build_documentai,
+}
+
+
+def _build_vision_async():
+    from google.cloud import vision
+    return vision.ImageAnnotatorAsyncClient()
+
+
+def _build_documentai_async():
+    from google.cloud import documentai
+    return documentai.DocumentProcessorServiceAsyncClient()
+
+
+_async_builders = {
+    "vision": _build_vision_async,
+    "document_ai": _build_documentai_async,
+}
+# grpc.aio channels and asyncio semaphores belong to the loop that made them
+_async_clients = weakref.WeakKeyDictionary()  # loop -> {name: client}
+_limits = weakref.WeakKeyDictionary()  # loop -> _Limits
+
+
+def get_client(name: str):
+    """Return the process-wide client for name, creating it on first use.
+
+    Google clients are thread-safe and hold their own gRPC channel, so one
+    instance is shared by every request and worker thread.
+    """
+    client = _clients.get(name)
+    if client is not None:
+        return client
+    with _lock:
+        client = _clients.get(name)
+        if client is None:
+            google_credentials.get()
+            started = time.perf_counter()
+            client = _builders[name]()
+            stats = _stats.setdefault(name, _new_stats())
+            stats["created_at"] = time.time()
+            stats["setup_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            _clients[name] = client
+            logger.info(f"Created {name} client in {stats['setup_ms']} ms")
+    return client
+
+
+def get_async_client(name: str):
+    """The asyncio (grpc.aio) client for name on the running event loop."""
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    client = clients.get(name)
+    if client is None:
+        google_credentials.get()
+        started = time.perf_counter()
+        client = clients[name] = _async_builders[name]()
+        logger.info(f"Created async {name} client in {round((time.perf_counter() - started) * 1000, 1)} ms")
+    return client
+
+
+def set_builder(name: str, builder, async_builder=None):
+    """Change how the client for name is built and drop any existing one.
+
+    Lets benchmarks point the shared clients at local stand-ins.
+    """
+    with _lock:
+        _builders[name] = builder
+        _clients.pop(name, None)
+        if async_builder is not None:
+            _async_builders[name] = async_builder
+            for clients in _async_clients.values():
+                clients.pop(name, None)
+
+
+def get_vision_client():
+    return get_client("vision")
+
+
+def get_documentai_client():
+    return get_client("document_ai")
+
+
+class FetchRejected(ValueError):
+    """A file URL we will not download."""
+
+
+class FileTooLarge(FetchRejected):
+    pass
+
+
+def allow_fetch_origin(origin: str):
+    OCR_FETCH_ORIGINS.add(origin.rstrip("/"))
+
+
+def check_file_url(url: str) -> str:
+    parts = urlsplit(url)
+    if f"{parts.scheme}://{parts.netloc}" not in OCR_FETCH_ORIGINS:
+        raise FetchRejected("file_url must be the URL of an uploaded file")
+    return url
+
+
+def remember_file(url: str, data: bytes):
+    """Let fetch_file / afetch_file in the current context (one request) return data for url.
+
+    The bytes stay out of the graph state, which is checkpointed to the database.
+    """
+    _prefetched.set({**_prefetched.get(), url: data})
+
+
+def _from_prefetch(url: str):
+    return _prefetched.get().get(url)
+
+
+def _add_chunk(buf: bytearray, chunk: bytes):
+    buf += chunk
+    if len(buf) > MAX_UPLOAD_BYTES:
+        raise FileTooLarge(f"file is larger than {MAX_UPLOAD_BYTES} bytes")
+
+
+def fetch_file(url: str) -> bytes:
+    """Download an uploaded file (a Cloudinary URL) for engines that take bytes.
+
+    Streamed with a MAX_UPLOAD_BYTES cap; redirects are not followed.
+    """
+    data = _from_prefetch(url)
+    if data is not None:
+        return data
+    import requests
+    check_file_url(url)
+    buf = bytearray()
+    with requests.get(url, timeout=OCR_FETCH_TIMEOUT, stream=True, allow_redirects=False) as resp:
+        resp.raise_for_status()
+        for chunk in resp.iter_content(READ_CHUNK_BYTES):
+            _add_chunk(buf, chunk)
+    return bytes(buf)
+
+
+async def afetch_file(url: str) -> bytes:
+    data = _from_prefetch(url)
+    if data is not None:
+        return data
+    import httpx
+    check_file_url(url)
+    buf = bytearray()
+    async with httpx.AsyncClient(timeout=OCR_FETCH_TIMEOUT) as client:
+        async with client.stream("GET", url) as resp:
+            resp.raise_for_status()
+            async for chunk in resp.aiter_bytes(READ_CHUNK_BYTES):
+                _add_chunk(buf, chunk)
+    return bytes(buf)
+
+
+def _wait_for_channel(client, timeout: float) -> bool:
+    import grpc
+    channel = getattr(client.transport, "grpc_channel", None)
+    if channel is None:
+        return False
+    grpc.channel_ready_future(channel).result(timeout=timeout)
+    return True
+
+
+def warmup(names=None, timeout: float = WARMUP_TIMEOUT):
+    """Create the clients and open their channels before the first request."""
+    for name in names or _builders:
+        try:
+            client = get_client(name)
+            _stats[name]["warm"] = _wait_for_channel(client, timeout)
+        except Exception as e:
+            # missing credentials or no network should not stop startup
+            logger.warning(f"Warmup of {name} client failed: {e}")
+
+
+@contextmanager
+def track_call(name: str):
+    """Record latency and errors for one call made with a shared client."""
+    started = time.perf_counter()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        elapsed = (time.perf_counter() - started) * 1000
+        ocr_client_call_duration.observe(elapsed / 1000, name)
+        with _lock:
+            stats = _stats.setdefault(name, _new_stats())
+            stats["calls"] += 1
+            stats["total_ms"] += elapsed
+            stats["max_ms"] = max(stats["max_ms"], elapsed)
+            if not ok:
+                stats["errors"] += 1
+
+
+class _Limits:
+    def __init__(self):
+        self.total = asyncio.Semaphore(OCR_MAX_IN_FLIGHT)
+        self.users = {}  # user -> [semaphore, tasks holding or waiting for it]
+
+
+@asynccontextmanager
+async def call_slot(name: str):
+    """Hold a process-wide slot, and a per-user one, for one async Google call.
+
+    The user's own slot is taken first, so a user with a long backlog waits
+    on their own limit without holding global slots everyone else needs.
+    """
+    loop = asyncio.get_running_loop()
+    limits = _limits.get(loop)
+    if limits is None:
+        limits = _limits[loop] = _Limits()
+    user = ocr_user_var.get()
+    entry = None
+    if user is not None:
+        entry = limits.users.setdefault(user, [asyncio.Semaphore(OCR_MAX_IN_FLIGHT_PER_USER), 0])
+        entry[1] += 1
+    started = time.perf_counter()
+    try:
+        async with AsyncExitStack() as stack:
+            if entry is not None:
+                await stack.enter_async_context(entry[0])
+            await stack.enter_async_context(limits.total)
+            ocr_slot_wait.observe(time.perf_counter() - started, name)
+            yield
+    finally:
+        if entry is not None:
+            entry[1] -= 1
+            if not entry[1]:
+                del limits.users[user]
+
+
+def client_stats() -> dict:
+    with _lock:
+        out = {}
+        for name, s in _stats.items():
+            out[name] = dict(s)
+            out[name]["connected"] = name in _clients
+            out[name]["avg_ms"] = round(s["total_ms"] / s["calls"], 1) if s["calls"] else None
+            out[name]["total_ms"] = round(s["total_ms"], 1)
+            out[name]["max_ms"] = round(s["max_ms"], 1)
+        return out
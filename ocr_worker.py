@@ -0,0 +1,287 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import update
+
+from database import SessionLocal
+from models import OcrJob
+from startup import ocr_graph
+from ocr_cache import purge_expired_ocr_cache
+from ocr_checkpoint import invoke_ocr_graph, purge_expired_checkpoints
+
+logger = logging.getLogger('kabala')
+
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", "2"))
+POLL_INTERVAL = float(os.getenv("OCR_POLL_INTERVAL", "2.0"))
+MAX_ATTEMPTS = int(os.getenv("OCR_MAX_ATTEMPTS", "3"))
+# a running job's worker renews its lease every OCR_JOB_HEARTBEAT seconds;
+# a job whose lease ran out lost its worker (crash, restart) and is requeued
+LEASE_SECONDS = float(os.getenv("OCR_JOB_LEASE_SECONDS", "120"))
+HEARTBEAT_SECONDS = float(os.getenv("OCR_JOB_HEARTBEAT", str(LEASE_SECONDS / 4)))
+# idle workers drop expired OCR cache entries and graph checkpoints this often
+PURGE_INTERVAL = float(os.getenv("OCR_PURGE_INTERVAL", "3600"))
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+# set whenever a job is enqueued by this process so idle workers wake up immediately
+_wakeup = threading.Event()
+
+_purge_lock = threading.Lock()
+_next_purge = 0.0
+
+
+def _now() -> str:
+    return datetime.utcnow().isoformat()
+
+
+def _lease() -> str:
+    return (datetime.utcnow() + timedelta(seconds=LEASE_SECONDS)).isoformat()
+
+
+def file_type_for(content_type: str, filename: str = '') -> str:
+    if content_type == "application/pdf" or (filename or '').lower().endswith(".pdf"):
+        return "pdf"
+    return "image"
+
+
+def enqueue_ocr_job(db, file_url: str, file_type: str, user_id=None, public_id=None, content_hash=None) -> str:
+    job_id = uuid.uuid4().hex
+    job = OcrJob(
+        job_id=job_id,
+        user_id=user_id,
+        public_id=public_id,
+        file_url=file_url,
+        file_type=file_type,
+        content_hash=content_hash,
+        status=QUEUED,
+        created_at=_now(),
+        updated_at=_now(),
+    )
+    db.add(job)
+    db.commit()
+    _wakeup.set()
+    return job_id
+
+
+def get_ocr_job(db, job_id: str, user_id):
+    """The job, or None when it does not exist or belongs to another user."""
+    job = db.get(OcrJob, job_id)
+    if job is None or user_id is None or job.user_id != user_id:
+        return None
+    return job
+
+
+def job_to_dict(job: OcrJob) -> dict:
+    return {
+        "job_id": job.job_id,
+        "status": job.status,
+        "public_id": job.public_id,
+        "result": json.loads(job.result) if job.result else None,
+        "error": job.error,
+        "created_at": job.created_at,
+        "updated_at": job.updated_at,
+    }
+
+
+def _claim_next_job(db):
+    """Atomically move the oldest queued job to running. Safe across processes."""
+    candidates = (
+        db.query(OcrJob.job_id)
+        .filter(OcrJob.status == QUEUED)
+        .order_by(OcrJob.created_at)
+        .limit(5)
+        .all()
+    )
+    for (job_id,) in candidates:
+        claimed = db.execute(
+            update(OcrJob)
+            .where(OcrJob.job_id == job_id, OcrJob.status == QUEUED)
+            .values(status=RUNNING, attempts=OcrJob.attempts + 1, updated_at=_now(), lease_until=_lease())
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.commit()
+        if claimed:
+            return db.get(OcrJob, job_id)
+    return None
+
+
+def requeue_expired_jobs(db) -> int:
+    """Put running jobs whose lease expired back on the queue, or fail them when out of attempts."""
+    now = _now()
+    expired = (OcrJob.status == RUNNING) & ((OcrJob.lease_until < now) | (OcrJob.lease_until.is_(None)))
+    failed = db.execute(
+        update(OcrJob)
+        .where(expired, OcrJob.attempts >= MAX_ATTEMPTS)
+        .values(status=FAILED, error="worker lost", updated_at=now, lease_until=None)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    requeued = db.execute(
+        update(OcrJob)
+        .where(expired)
+        .values(status=QUEUED, updated_at=now, lease_until=None)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.commit()
+    if failed or requeued:
+        logger.warning(f"Recovered OCR jobs with expired leases: {requeued} requeued, {failed} failed")
+    return requeued
+
+
+def purge_expired_ocr_state():
+    """Purge the OCR cache and checkpoint tables, at most once per PURGE_INTERVAL in this process."""
+    global _next_purge
+    with _purge_lock:
+        if time.monotonic() < _next_purge:
+            return
+        _next_purge = time.monotonic() + PURGE_INTERVAL
+    entries = purge_expired_ocr_cache()
+    threads = purge_expired_checkpoints()
+    if entries or threads:
+        logger.info(f"Purged {entries} expired OCR cache entries and {threads} checkpoint threads")
+
+
+def _ours(job_id: str, attempts: int):
+    """Still the claim this worker made: not requeued, and not claimed again by another worker since."""
+    return (OcrJob.job_id == job_id) & (OcrJob.status == RUNNING) & (OcrJob.attempts == attempts)
+
+
+def _heartbeat(job_id: str, attempts: int, done: threading.Event):
+    while not done.wait(HEARTBEAT_SECONDS):
+        db = SessionLocal()
+        try:
+            db.execute(
+                update(OcrJob)
+                .where(_ours(job_id, attempts))
+                .values(lease_until=_lease())
+                .execution_options(synchronize_session=False)
+            )
+            db.commit()
+        except Exception:
+            logger.warning(f"Renewing the lease of OCR job {job_id} failed", exc_info=True)
+        finally:
+            db.close()
+
+
+def _run_job(db, job: OcrJob):
+    state = {
+        "file_url": job.file_url,
+        "file_type": job.file_type,
+        "content_hash": job.content_hash,
+        "raw_text": None,
+        "structured_data": None,
+        "metadata": {},
+    }
+    job_id, attempts, public_id = job.job_id, job.attempts, job.public_id
+    done = threading.Event()
+    threading.Thread(target=_heartbeat, args=(job_id, attempts, done), name=f"ocr-lease-{job_id[:8]}", daemon=True).start()
+    try:
+        final = invoke_ocr_graph(ocr_graph.get(), state)
+        outcome = {
+            "status": DONE,
+            "error": None,
+            "result": json.dumps({
+                "text": final.get("raw_text") or "",
+                "structured_data": final.get("structured_data"),
+                "metadata": final.get("metadata", {}),
+            }),
+        }
+    except Exception as e:
+        # put it back on the queue until it runs out of attempts
+        outcome = {"status": FAILED if attempts >= MAX_ATTEMPTS else QUEUED, "error": str(e)}
+        logger.error(f"OCR job {job_id} failed (attempt {attempts}): {e}")
+    finally:
+        done.set()
+    # a lease that expired mid-run may have been requeued and claimed by another worker; its outcome stands
+    written = db.execute(
+        update(OcrJob)
+        .where(_ours(job_id, attempts))
+        .values(**outcome, updated_at=_now(), lease_until=None)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.commit()
+    if not written:
+        logger.warning(f"OCR job {job_id} lost its lease during attempt {attempts}; its {outcome['status']} outcome was dropped")
+    elif outcome["status"] == DONE:
+        logger.info(f"OCR job {job_id} done (public_id={public_id})")
+
+
+def drain_once() -> bool:
+    """Process one queued job. Returns False when the queue is empty."""
+    db = SessionLocal()
+    try:
+        job = _claim_next_job(db)
+        if job is None:
+            return False
+        _run_job(db, job)
+        return True
+    finally:
+        db.close()
+
+
+def _worker_loop(stop: threading.Event):
+    last_recovery = time.monotonic()
+    while not stop.is_set():
+        try:
+            if drain_once():
+                continue
+            # also pick up jobs lost by other worker processes
+            if time.monotonic() - last_recovery > LEASE_SECONDS:
+                last_recovery = time.monotonic()
+                db = SessionLocal()
+                try:
+                    requeue_expired_jobs(db)
+                finally:
+                    db.close()
+            purge_expired_ocr_state()
+        except Exception:
+            logger.error("OCR worker loop error", exc_info=True)
+        _wakeup.wait(POLL_INTERVAL)
+        _wakeup.clear()
+
+
+class OcrWorkerPool:
+    def __init__(self, workers: int = OCR_WORKERS):
+        self.workers = workers
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        # jobs a previous process left running never finish on their own
+        db = SessionLocal()
+        try:
+            requeue_expired_jobs(db)
+        except Exception:
+            logger.error("Requeueing expired OCR jobs failed", exc_info=True)
+        finally:
+            db.close()
+        for i in range(self.workers):
+            t = threading.Thread(target=_worker_loop, args=(self._stop,), name=f"ocr-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        logger.info(f"Started {self.workers} OCR workers")
+
+    def stop(self, timeout: float = 5.0):
+        self._stop.set()
+        _wakeup.set()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+
+if __name__ == "__main__":
+    # Standalone worker: python -m ocr_worker
+    from logging_setup import configure_logging
+    configure_logging()
+    from startup import database
+    database.get()
+    pool = OcrWorkerPool()
+    pool.start()
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pool.stop()
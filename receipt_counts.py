@@ -0,0 +1,101 @@
+import os
+import threading
+import time
+from typing import Optional
+
+from sqlalchemy import event, func, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from models import Receipt, ReceiptCount
+
+# other processes change counts too; a cached value is trusted this long
+RECEIPT_COUNT_TTL_SECONDS = float(os.getenv("RECEIPT_COUNT_TTL_SECONDS", "30"))
+
+# user_id -> (stored_at, committed receipt count), shared by all requests in this process
+_cache: dict[int, tuple[float, int]] = {}
+_lock = threading.Lock()
+
+_PENDING_KEY = "receipt_counts_pending"
+
+
+def cached_receipt_count(user_id: int) -> Optional[int]:
+    with _lock:
+        hit = _cache.get(user_id)
+        if hit is None:
+            return None
+        if time.monotonic() - hit[0] > RECEIPT_COUNT_TTL_SECONDS:
+            del _cache[user_id]
+            return None
+        return hit[1]
+
+
+def stage_receipt_count(db, user_id: int, n: int) -> None:
+    """Publish n to the in-memory cache once db's transaction commits."""
+    db.info.setdefault(_PENDING_KEY, {})[user_id] = n
+
+
+def upsert_count(db, user_id: int, n: int, delta: int):
+    """INSERT the first counter row as n, or add delta to the row a concurrent request just created."""
+    insert = postgresql.insert if db.get_bind().dialect.name == "postgresql" else sqlite.insert
+    stmt = insert(ReceiptCount.__table__).values(user_id=user_id, count=n)
+    return stmt.on_conflict_do_update(
+        index_elements=["user_id"],
+        set_={"count": ReceiptCount.__table__.c["count"] + delta},
+    )
+
+
+def get_receipt_count(db, user_id: int) -> int:
+    """Return the user's receipt count, from memory when possible.
+
+    Read-only: a user without a counter row yet gets a COUNT(*) and the row
+    is created by the first adjust_receipt_count.
+    """
+    cached = cached_receipt_count(user_id)
+    if cached is not None:
+        return cached
+
+    row = db.get(ReceiptCount, user_id)
+    if row is None:
+        n = db.query(func.count(Receipt.public_id)).filter(Receipt.user_id == user_id).scalar() or 0
+    else:
+        n = row.count
+    stage_receipt_count(db, user_id, n)
+    return n
+
+
+def adjust_receipt_count(db, user_id: int, delta: int) -> None:
+    """Change the stored count inside the caller's transaction.
+
+    The in-memory value is only updated once that transaction commits.
+    """
+    if user_id is None:
+        return
+    result = db.execute(
+        update(ReceiptCount)
+        .where(ReceiptCount.user_id == user_id)
+        .values(count=ReceiptCount.count + delta)
+    )
+    if result.rowcount == 0:
+        # no counter yet; the pending insert/delete is already flushed
+        db.flush()
+        n = db.query(func.count(Receipt.public_id)).filter(Receipt.user_id == user_id).scalar() or 0
+        db.execute(upsert_count(db, user_id, n, delta))
+    n = db.query(ReceiptCount.count).filter(ReceiptCount.user_id == user_id).scalar()
+    stage_receipt_count(db, user_id, n)
+
+
+# Registered on Session itself so sync sessions and the sessions behind
+# AsyncSession both publish their counts.
+@event.listens_for(Session, "after_commit")
+def _publish_counts(session):
+    pending = session.info.pop(_PENDING_KEY, None)
+    if pending:
+        now = time.monotonic()
+        with _lock:
+            _cache.update((user_id, (now, n)) for user_id, n in pending.items())
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_counts(session):
+    session.info.pop(_PENDING_KEY, None)
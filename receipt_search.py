@@ -0,0 +1,105 @@
+import json
+import re
+from datetime import datetime
+from typing import Optional
+
+import cloudinary
+from sqlalchemy import or_, select
+
+from models import Receipt, UserInsuranceCompany
+
+MAX_RESULTS = 100
+
+
+def _image_url(receipt: Receipt) -> Optional[str]:
+    # secure_url is stored on upload; only older rows need the URL built.
+    # build_url is computed locally by the SDK, it does not call the API.
+    if receipt.secure_url:
+        return receipt.secure_url
+    try:
+        return cloudinary.CloudinaryImage(receipt.public_id).build_url(secure=True)
+    except ValueError:
+        # cloud_name not configured
+        return None
+
+
+def receipt_to_resource(receipt: Receipt) -> dict:
+    """Shape a Receipt row like a Cloudinary Search resource for the templates."""
+    custom = {
+        "user_id": str(receipt.user_id) if receipt.user_id is not None else '',
+        "username": receipt.username or '',
+    }
+    if receipt.sent_to_insurance:
+        custom["sent_to_insurance"] = receipt.sent_to_insurance
+    if receipt.sent_to_companies:
+        custom["sent_to_companies"] = ', '.join(receipt.sent_to_company_names)
+    if receipt.insurance_company:
+        custom["insurance_company"] = receipt.insurance_company
+    if receipt.refund_details:
+        custom["refund_details"] = json.dumps(receipt.refund_details)
+
+    return {
+        "public_id": receipt.public_id,
+        "secure_url": _image_url(receipt),
+        "created_at": receipt.created_at.isoformat() if receipt.created_at else None,
+        "context": {"custom": custom},
+        "_db": receipt,
+    }
+
+
+def build_search_query(user_id: int, name=None, date=None, refunded=None,
+                       sent_to_insurance=None, insurance_company=None, limit=MAX_RESULTS):
+    """Build the SELECT for a user's receipt search.
+
+    Every query is anchored on user_id so it is served by one of the
+    (user_id, ...) composite indexes on the receipts table.
+    """
+    q = select(Receipt).where(Receipt.user_id == user_id)
+
+    if name:
+        # sanitize name to match how we build public_id
+        safe = re.sub(r'[^A-Za-z0-9_\-]', '', name.strip().replace(' ', '_'))
+        if safe:
+            q = q.where(Receipt.public_id.contains(safe, autoescape=True))
+
+    if date:
+        try:
+            q = q.where(Receipt.date == datetime.fromisoformat(date).date())
+        except ValueError:
+            # ignore invalid date filter
+            pass
+
+    if refunded and refunded.lower() in ('yes', 'no'):
+        # refund_total is NULL exactly when there are no refunds
+        if refunded.lower() == 'yes':
+            q = q.where(Receipt.refund_total.is_not(None))
+        else:
+            q = q.where(Receipt.refund_total.is_(None))
+
+    if sent_to_insurance and sent_to_insurance.lower() in ('yes', 'no'):
+        not_sent = or_(Receipt.sent_to_insurance.is_(None), Receipt.sent_to_insurance == '')
+        q = q.where(~not_sent if sent_to_insurance.lower() == 'yes' else not_sent)
+
+    if insurance_company:
+        comp = insurance_company.strip()
+        if comp:
+            # exact matches: the (user_id, insurance_company) index, or the
+            # receipt_insurance_company link for receipts sent to that company
+            q = q.where(or_(
+                Receipt.insurance_company == comp,
+                Receipt.sent_to_companies.any(UserInsuranceCompany.name == comp),
+            ))
+
+    return q.order_by(Receipt.date.desc(), Receipt.created_at.desc()).limit(limit)
+
+
+def search_receipts(db, user_id: int, **filters):
+    """Search a user's receipts in the local DB."""
+    rows = db.execute(build_search_query(user_id, **filters)).scalars().all()
+    return [receipt_to_resource(r) for r in rows]
+
+
+async def search_receipts_async(db, user_id: int, **filters):
+    """search_receipts for an AsyncSession."""
+    rows = (await db.execute(build_search_query(user_id, **filters))).scalars().all()
+    return [receipt_to_resource(r) for r in rows]
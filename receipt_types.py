@@ -0,0 +1,70 @@
+"""Conversions from the loosely typed values we get from forms and Cloudinary."""
+import json
+from datetime import date, datetime, timezone
+from decimal import Decimal, InvalidOperation
+from typing import Optional
+
+
+def parse_date(value) -> Optional[date]:
+    if value is None or isinstance(value, date) and not isinstance(value, datetime):
+        return value
+    if isinstance(value, datetime):
+        return value.date()
+    try:
+        return datetime.fromisoformat(str(value).strip()[:10]).date()
+    except ValueError:
+        return None
+
+
+def parse_timestamp(value) -> Optional[datetime]:
+    """Parse an ISO timestamp (Cloudinary sends '...Z') into naive UTC."""
+    if value is None or isinstance(value, datetime):
+        return value
+    text = str(value).strip()
+    if not text:
+        return None
+    try:
+        ts = datetime.fromisoformat(text.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return ts
+
+
+def parse_refunds(value) -> list:
+    if isinstance(value, list):
+        return value
+    if not value:
+        return []
+    try:
+        parsed = json.loads(value)
+    except (TypeError, ValueError):
+        return []
+    return parsed if isinstance(parsed, list) else []
+
+
+# Receipt.refund_total is Numeric(12, 2); anything from here up rounds past it
+_REFUND_TOTAL_LIMIT = Decimal("9999999999.995")
+
+
+def refund_total(refunds: list) -> Optional[Decimal]:
+    """Sum of refund amounts, or None when there are no refunds.
+
+    Unparseable amounts are skipped. Raises ValueError for NaN or Infinity,
+    or for a total too large to store.
+    """
+    if not refunds:
+        return None
+    total = Decimal("0")
+    for r in refunds:
+        try:
+            amount = Decimal(str(r.get("amount") or "0").replace(',', ''))
+        except (InvalidOperation, AttributeError):
+            continue
+        if not amount.is_finite():
+            raise ValueError(f"Invalid refund amount: {r.get('amount')}")
+        total += amount
+    if abs(total) >= _REFUND_TOTAL_LIMIT:
+        raise ValueError(f"Refund total is too large: {total}")
+    return total
@@ -0,0 +1,129 @@
+"""Lazy initializers for the expensive parts of the app, with a timing report.
+
+Nothing here runs at import. Each initializer runs once, on first use (or
+from the startup hook), and records how long it took so cold starts can be
+read phase by phase from the log and from /ready.
+"""
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+logger = logging.getLogger('kabala')
+
+# phase name -> {"ms", "ok", "error"} in the order phases finished
+_phases: dict = {}
+_phases_lock = threading.Lock()
+
+
+def record_phase(name: str, ms: float, ok: bool = True, error: str = None):
+    with _phases_lock:
+        _phases[name] = {"ms": round(ms, 1), "ok": ok, "error": error}
+
+
+@contextmanager
+def timed_phase(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        record_phase(name, (time.perf_counter() - started) * 1000, ok=False, error=str(e))
+        raise
+    record_phase(name, (time.perf_counter() - started) * 1000)
+
+
+def startup_report() -> dict:
+    with _phases_lock:
+        return {name: dict(p) for name, p in _phases.items()}
+
+
+def log_startup_report():
+    parts = ", ".join(
+        f"{name}={p['ms']}ms" + ("" if p["ok"] else " (failed)")
+        for name, p in startup_report().items()
+    )
+    logger.info(f"Startup phases: {parts}")
+
+
+class LazyInit:
+    """Run fn once, on the first get(), and time it as a startup phase."""
+
+    def __init__(self, name: str, fn):
+        self.name = name
+        self._fn = fn
+        self._value = None
+        self._done = False
+        self._lock = threading.Lock()
+
+    @property
+    def done(self) -> bool:
+        return self._done
+
+    def get(self):
+        if self._done:
+            return self._value
+        with self._lock:
+            if not self._done:
+                with timed_phase(self.name):
+                    self._value = self._fn()
+                self._done = True
+        return self._value
+
+
+def lazy(name: str):
+    def decorator(fn):
+        return LazyInit(name, fn)
+    return decorator
+
+
+@lazy("google_credentials")
+def google_credentials():
+    creds_json = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS_JSON")
+    if not creds_json:
+        return None
+
+    creds_path = Path("/tmp/google-creds.json")
+    creds_path.write_text(creds_json)
+
+    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = str(creds_path)
+    return creds_path
+
+
+@lazy("cloudinary")
+def cloudinary_config():
+    import cloudinary
+
+    cloud_name = os.environ.get('CLOUDINARY_CLOUD_NAME')
+    api_key = os.environ.get('CLOUDINARY_API_KEY')
+    api_secret = os.environ.get('CLOUDINARY_API_SECRET')
+
+    if not (cloud_name and api_key and api_secret):
+        logger.warning('Cloudinary credentials are not set in environment variables')
+
+    cloudinary.config(
+        cloud_name=cloud_name,
+        api_key=api_key,
+        api_secret=api_secret,
+        secure=True,
+    )
+
+
+@lazy("database")
+def database():
+    from database import engine
+    from init_db import ensure_db, log_db_identity
+
+    ensure_db()
+    log_db_identity(engine)
+    return engine
+
+
+@lazy("ocr_graph")
+def ocr_graph():
+    # langgraph and the google.cloud node modules are the slowest imports in the app
+    from graph_factory import build_ocr_graph
+    from ocr_checkpoint import OCR_CHECKPOINTS
+    from ocr_checkpoint_saver import DbCheckpointSaver
+    return build_ocr_graph(DbCheckpointSaver() if OCR_CHECKPOINTS else None)
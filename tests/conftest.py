@@ -0,0 +1,88 @@
+"""Shared fixtures. The app runs in local mode on a throwaway SQLite database.
+
+The environment is set before anything imports database, as the load bench
+does, so the tests never touch ./app.db.
+"""
+import os
+import shutil
+import tempfile
+
+_db_dir = tempfile.mkdtemp(prefix="kabala-tests-")
+os.environ["ENV"] = "local"
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_db_dir, 'test.db')}"
+os.environ.setdefault("SECRET_KEY", "test-secret")
+os.environ.setdefault("OCR_WARMUP", "0")
+os.environ.setdefault("OCR_INPROCESS_WORKERS", "0")
+os.environ.setdefault("OCR_LOCAL_TIER", "0")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from types import SimpleNamespace  # noqa: E402
+from uuid import uuid4  # noqa: E402
+
+import pytest  # noqa: E402
+
+
+@pytest.fixture(scope="session", autouse=True)
+def schema():
+    from migrations import upgrade
+    upgrade()
+    yield
+    shutil.rmtree(_db_dir, ignore_errors=True)
+
+
+@pytest.fixture
+def db():
+    from database import SessionLocal
+    session = SessionLocal()
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def make_user(db):
+    from models import User
+
+    def make(**fields):
+        user = User(username=f"user-{uuid4().hex[:8]}", **fields)
+        db.add(user)
+        db.commit()
+        return user
+    return make
+
+
+@pytest.fixture(scope="session")
+def fakes():
+    from benchmarks.fakes import FakeCloudinary, FakeGoogleOcr
+    servers = SimpleNamespace(cloudinary=FakeCloudinary().start(), ocr=FakeGoogleOcr().start())
+    yield servers
+    servers.cloudinary.stop()
+    servers.ocr.stop()
+
+
+@pytest.fixture(scope="session")
+def app(fakes):
+    """The app, started once, with Cloudinary and the OCR clients pointed at the fakes."""
+    from fastapi.testclient import TestClient
+    from benchmarks.fakes import point_app_at_fakes
+    import main
+
+    with TestClient(main.app):
+        point_app_at_fakes(fakes.cloudinary.url, fakes.ocr.url, fakes.ocr.grpc_target)
+        yield main.app
+
+
+@pytest.fixture
+def client(app):
+    from fastapi.testclient import TestClient
+    return TestClient(app)
+
+
+@pytest.fixture
+def login(client):
+    """Sign a new user up on client; returns the username."""
+    def signup(**fields):
+        username = f"user-{uuid4().hex[:8]}"
+        resp = client.post("/signup", data={"username": username, **fields}, follow_redirects=False)
+        assert resp.status_code == 302
+        return username
+    return signup
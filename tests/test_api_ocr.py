@@ -0,0 +1,46 @@
+from uuid import uuid4
+
+import ocr_clients
+from ocr_cache import hash_bytes
+
+
+def asset_url(fakes, ext="jpg"):
+    return f"{fakes.cloudinary.url}/assets/tests/{uuid4().hex}.{ext}"
+
+
+def asset_fetches(fakes):
+    return fakes.cloudinary.stats()["calls"].get("GET assets", 0)
+
+
+def test_requires_a_session(client, fakes):
+    resp = client.post("/api/ocr/ocr", params={"file_url": asset_url(fakes), "file_type": "image"})
+    assert resp.status_code == 401
+
+
+def test_only_fetches_uploaded_files(client, login):
+    login()
+    for url in ("http://169.254.169.254/latest/meta-data", "https://example.com/a.jpg", "file:///etc/passwd"):
+        resp = client.post("/api/ocr/ocr", params={"file_url": url, "file_type": "image"})
+        assert resp.status_code == 422, url
+
+
+def test_file_over_the_upload_limit_is_rejected(client, login, fakes, monkeypatch):
+    login()
+    monkeypatch.setattr(ocr_clients, "MAX_UPLOAD_BYTES", 100)
+    resp = client.post("/api/ocr/ocr", params={"file_url": asset_url(fakes), "file_type": "image"})
+    assert resp.status_code == 413
+
+
+def test_hashes_the_fetched_bytes_and_fetches_once(client, login, fakes):
+    login()
+    url = asset_url(fakes, "pdf")
+    before = asset_fetches(fakes)
+    # a content_hash from the client is ignored
+    resp = client.post("/api/ocr/ocr", params={"file_url": url, "file_type": "pdf", "content_hash": "0" * 64})
+    assert resp.status_code == 200
+    body = resp.json()
+    path = url[len(fakes.cloudinary.url):]
+    assert body["content_hash"] == hash_bytes(fakes.cloudinary.asset + path.encode())
+    assert body["raw_text"]
+    # Document AI reads the bytes the endpoint already downloaded
+    assert asset_fetches(fakes) == before + 1
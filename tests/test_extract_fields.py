@@ -0,0 +1,65 @@
+import pytest
+
+from nodes.extract_fields import extract_batch, extract_fields, merge_fields
+
+HEBREW_RECEIPT = "Dr. Cohen Clinic\nקבלה מס' 1042\nתאריך: 02/01/2024\nסה\"כ לתשלום: 350.00 ₪"
+
+
+def test_hebrew_receipt():
+    assert extract_fields(HEBREW_RECEIPT) == {
+        "amount": "350.00", "currency": "ILS", "date": "2024-01-02", "provider": "Dr. Cohen Clinic",
+    }
+
+
+@pytest.mark.parametrize("text, amount", [
+    ("Subtotal 100.00\nVAT 17.00\nTotal 117.00", "117.00"),
+    ("Total\n1,234.50", "1234.50"),
+    ("Total due: 350,00 NIS", "350.00"),
+    ("Total 80.00\nCash 100.00\nChange 20.00", "80.00"),
+    ("סה\"כ 45", "45.00"),
+    ("Coffee ₪ 12.00\nCake ₪ 18.50", "18.50"),
+    ("Receipt 2024-03-05 10:30", None),
+])
+def test_amount(text, amount):
+    assert extract_fields(text)["amount"] == amount
+
+
+@pytest.mark.parametrize("text, found", [
+    ("Date: 2024-03-05", "2024-03-05"),
+    ("תאריך 05.03.24", "2024-03-05"),
+    ("Issued 03/25/2024", "2024-03-25"),
+    ("5 March 2024", "2024-03-05"),
+    ("March 5, 2024", "2024-03-05"),
+    ("5 במרץ 2024", "2024-03-05"),
+    ("Printed 01/02/2023\nDate 07/08/2024", "2024-08-07"),
+    ("31/02/2024", None),
+])
+def test_date(text, found):
+    assert extract_fields(text)["date"] == found
+
+
+@pytest.mark.parametrize("text, currency", [
+    ("Total 10 ש\"ח", "ILS"),
+    ("Total $10.00", "USD"),
+    ("Total 10.00 EUR", "EUR"),
+    ("Total 10.00", None),
+])
+def test_currency(text, currency):
+    assert extract_fields(text)["currency"] == currency
+
+
+def test_provider_skips_boilerplate_and_prefers_a_business_name():
+    text = "Tax Invoice\nTel: 03-1234567\nHappy Day\nמרפאת השרון בע\"מ\nTotal 10"
+    assert extract_fields(text)["provider"] == "מרפאת השרון בע\"מ"
+
+
+def test_empty_text():
+    assert extract_fields(None) == {"amount": None, "currency": None, "date": None, "provider": None}
+    assert extract_batch(["", HEBREW_RECEIPT])[1]["amount"] == "350.00"
+
+
+def test_merge_keeps_engine_values():
+    merged = merge_fields({"total_amount": "351.00", "provider": "Engine Provider"}, HEBREW_RECEIPT)
+    assert merged["provider"] == "Engine Provider"
+    assert merged["total_amount"] == "351.00"
+    assert merged["amount"] == "350.00"
@@ -0,0 +1,93 @@
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+import ocr_cache
+from models import OcrCacheEntry
+from ocr_cache import cached_ocr_node, get_cached_ocr, purge_expired_ocr_cache, put_cached_ocr
+
+
+def new_hash():
+    return ocr_cache.hash_bytes(uuid4().bytes)
+
+
+def state(content_hash):
+    return {"file_url": "https://res.cloudinary.com/x.jpg", "file_type": "image", "content_hash": content_hash,
+            "raw_text": None, "structured_data": None, "metadata": {}}
+
+
+def test_entry_is_read_back_from_the_database(db):
+    h = new_hash()
+    put_cached_ocr(h, "vision_api", {"raw_text": "total 10"})
+    ocr_cache._memory.clear()
+    assert get_cached_ocr(h, "vision_api") == {"raw_text": "total 10"}
+    assert get_cached_ocr(h, "document_ai") is None
+    assert db.get(OcrCacheEntry, (h, "vision_api")).hits == 1
+
+
+def test_expired_entry_is_a_miss_and_dropped(db, monkeypatch):
+    h = new_hash()
+    put_cached_ocr(h, "vision_api", {"raw_text": "total 10"})
+    monkeypatch.setattr(ocr_cache, "OCR_CACHE_TTL_SECONDS", -1)
+    assert get_cached_ocr(h, "vision_api") is None  # from memory
+    ocr_cache._memory.clear()
+    assert get_cached_ocr(h, "vision_api") is None  # from the database
+    assert db.get(OcrCacheEntry, (h, "vision_api")) is None
+
+
+def test_purge_drops_only_expired_rows(db):
+    old, fresh = new_hash(), new_hash()
+    put_cached_ocr(fresh, "vision_api", {"raw_text": "b"})
+    stale_at = datetime.utcnow() - timedelta(seconds=ocr_cache.OCR_CACHE_TTL_SECONDS + 60)
+    db.add(OcrCacheEntry(content_hash=old, engine="vision_api", result="{}", hits=0, created_at=stale_at.isoformat()))
+    db.commit()
+    assert purge_expired_ocr_cache() >= 1
+    db.expire_all()
+    assert db.get(OcrCacheEntry, (old, "vision_api")) is None
+    assert db.get(OcrCacheEntry, (fresh, "vision_api")) is not None
+
+
+def test_cached_node_skips_the_engine_on_a_hit():
+    calls = []
+
+    @cached_ocr_node("vision_api")
+    def node(s):
+        calls.append(s["content_hash"])
+        s["raw_text"] = "Dr. Cohen 350.00"
+        return s
+
+    h = new_hash()
+    assert node(state(h))["metadata"]["cache"] == "miss"
+    second = node(state(h))
+    assert second["metadata"]["cache"] == "hit"
+    assert second["raw_text"] == "Dr. Cohen 350.00"
+    assert calls == [h]
+
+
+def test_blank_read_is_not_cached():
+    calls = []
+
+    @cached_ocr_node("vision_api")
+    def node(s):
+        calls.append(1)
+        s["raw_text"] = ""
+        return s
+
+    h = new_hash()
+    node(state(h))
+    node(state(h))
+    assert len(calls) == 2
+    assert get_cached_ocr(h, "vision_api") is None
+
+
+def test_state_without_hash_is_never_cached():
+    calls = []
+
+    @cached_ocr_node("vision_api")
+    def node(s):
+        calls.append(1)
+        s["raw_text"] = "text"
+        return s
+
+    node(state(None))
+    node(state(None))
+    assert len(calls) == 2
@@ -0,0 +1,104 @@
+import asyncio
+import json
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+import pytest
+
+from metrics import ocr_graph_runs
+from models import OcrCheckpoint
+from ocr_checkpoint import ainvoke_ocr_graph, astream_ocr_graph, invoke_ocr_graph, ocr_thread_id, purge_expired_checkpoints
+
+
+@pytest.fixture
+def graph(app):
+    import startup
+    return startup.ocr_graph.get()
+
+
+@pytest.fixture
+def vision_text(fakes):
+    text = fakes.ocr.text
+    yield lambda value: setattr(fakes.ocr, "text", value)
+    fakes.ocr.text = text
+    fakes.ocr.faults.error_rate = 0
+
+
+def state(fakes):
+    return {"file_url": f"{fakes.cloudinary.url}/assets/tests/{uuid4().hex}.jpg", "file_type": "image",
+            "content_hash": None, "raw_text": None, "structured_data": None, "metadata": {}, "ocr_mode": None}
+
+
+def runs():
+    return {outcome: ocr_graph_runs._values.get((outcome,), 0) for outcome in ("fresh", "resumed", "replayed")}
+
+
+def vision_calls(fakes):
+    return fakes.ocr.stats()["calls"].get("POST vision:annotate", 0)
+
+
+def test_finished_run_is_replayed_without_calling_the_engine(graph, fakes):
+    s = state(fakes)
+    first = invoke_ocr_graph(graph, dict(s))
+    calls, before = vision_calls(fakes), runs()
+    again = invoke_ocr_graph(graph, dict(s))
+    assert again == first
+    assert vision_calls(fakes) == calls
+    assert runs()["replayed"] == before["replayed"] + 1
+
+
+def test_failed_run_resumes(graph, fakes, vision_text):
+    s = state(fakes)
+    fakes.ocr.faults.error_rate = 1.0
+    with pytest.raises(Exception):
+        invoke_ocr_graph(graph, dict(s))
+    fakes.ocr.faults.error_rate = 0
+    before = runs()
+    result = invoke_ocr_graph(graph, dict(s))
+    assert result["raw_text"]
+    assert runs()["resumed"] == before["resumed"] + 1
+
+
+def test_blank_read_runs_again(graph, fakes, vision_text):
+    s = state(fakes)
+    vision_text("")
+    assert invoke_ocr_graph(graph, dict(s))["raw_text"] == ""
+    vision_text("now readable")
+    before = runs()
+    assert invoke_ocr_graph(graph, dict(s))["raw_text"] == "now readable"
+    assert runs()["fresh"] == before["fresh"] + 1
+
+
+def test_async_and_streamed_runs_replay_the_same_thread(graph, fakes):
+    s = state(fakes)
+    first = invoke_ocr_graph(graph, dict(s))
+    calls = vision_calls(fakes)
+
+    async def both():
+        result = await ainvoke_ocr_graph(graph, dict(s))
+        lines = [json.loads(line) async for line in astream_ocr_graph(graph, dict(s))]
+        return result, lines
+
+    result, lines = asyncio.run(both())
+    assert result == first
+    assert lines == [{"type": "result", "result": first}]
+    assert vision_calls(fakes) == calls
+
+
+def test_thread_is_keyed_by_content_hash_over_url(fakes):
+    a, b = state(fakes), state(fakes)
+    assert ocr_thread_id(a) != ocr_thread_id(b)
+    a["content_hash"] = b["content_hash"] = "ab" * 32
+    assert ocr_thread_id(a) == ocr_thread_id(b)
+    assert ocr_thread_id(a) != ocr_thread_id({**a, "ocr_mode": "best"})
+
+
+def test_purge_drops_expired_threads(db, graph, fakes):
+    s = state(fakes)
+    invoke_ocr_graph(graph, dict(s))
+    thread_id = ocr_thread_id(s)
+    old = (datetime.utcnow() - timedelta(days=30)).isoformat()
+    db.query(OcrCheckpoint).filter(OcrCheckpoint.thread_id == thread_id).update({"created_at": old})
+    db.commit()
+    assert purge_expired_checkpoints() >= 1
+    assert db.query(OcrCheckpoint).filter(OcrCheckpoint.thread_id == thread_id).count() == 0
@@ -0,0 +1,100 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import ocr_worker
+from models import OcrJob
+from ocr_worker import DONE, FAILED, QUEUED, RUNNING
+
+
+@pytest.fixture
+def job(db, make_user):
+    # older queued jobs from other tests would be claimed first
+    db.query(OcrJob).filter(OcrJob.status == QUEUED).update({"status": FAILED})
+    db.commit()
+    user = make_user()
+    job_id = ocr_worker.enqueue_ocr_job(db, "https://res.cloudinary.com/a.jpg", "image", user_id=user.user_id)
+    return job_id, user.user_id
+
+
+def expire_lease(db, job_id):
+    past = (datetime.utcnow() - timedelta(seconds=1)).isoformat()
+    db.query(OcrJob).filter(OcrJob.job_id == job_id).update({"lease_until": past})
+    db.commit()
+
+
+def status(db, job_id):
+    db.expire_all()
+    return db.get(OcrJob, job_id)
+
+
+def test_claim_takes_a_lease(db, job):
+    job_id, _ = job
+    claimed = ocr_worker._claim_next_job(db)
+    assert claimed.job_id == job_id
+    assert claimed.status == RUNNING and claimed.attempts == 1
+    assert claimed.lease_until > datetime.utcnow().isoformat()
+    assert ocr_worker.requeue_expired_jobs(db) == 0
+
+
+def test_expired_lease_is_requeued(db, job):
+    job_id, _ = job
+    ocr_worker._claim_next_job(db)
+    expire_lease(db, job_id)
+    assert ocr_worker.requeue_expired_jobs(db) == 1
+    assert status(db, job_id).status == QUEUED
+    assert status(db, job_id).lease_until is None
+
+
+def test_expired_lease_out_of_attempts_fails(db, job, monkeypatch):
+    job_id, _ = job
+    monkeypatch.setattr(ocr_worker, "MAX_ATTEMPTS", 1)
+    ocr_worker._claim_next_job(db)
+    expire_lease(db, job_id)
+    assert ocr_worker.requeue_expired_jobs(db) == 0
+    assert status(db, job_id).status == FAILED
+    assert status(db, job_id).error == "worker lost"
+
+
+def test_stale_outcome_does_not_overwrite_a_new_claim(db, job, monkeypatch):
+    job_id, _ = job
+    first = ocr_worker._claim_next_job(db)
+
+    def slow_run(graph, state):
+        # the lease runs out mid-run and another worker claims the job
+        expire_lease(db, job_id)
+        ocr_worker.requeue_expired_jobs(db)
+        assert ocr_worker._claim_next_job(db).attempts == 2
+        return {"raw_text": "late"}
+
+    monkeypatch.setattr(ocr_worker, "invoke_ocr_graph", slow_run)
+    ocr_worker._run_job(db, first)
+    row = status(db, job_id)
+    assert (row.status, row.attempts, row.result) == (RUNNING, 2, None)
+
+    monkeypatch.setattr(ocr_worker, "invoke_ocr_graph", lambda graph, state: {"raw_text": "mine"})
+    ocr_worker._run_job(db, row)
+    row = status(db, job_id)
+    assert row.status == DONE and '"mine"' in row.result
+
+
+def test_failed_run_is_requeued_until_out_of_attempts(db, job, monkeypatch):
+    job_id, _ = job
+
+    def boom(graph, state):
+        raise RuntimeError("vision down")
+
+    monkeypatch.setattr(ocr_worker, "invoke_ocr_graph", boom)
+    monkeypatch.setattr(ocr_worker, "MAX_ATTEMPTS", 2)
+    ocr_worker._run_job(db, ocr_worker._claim_next_job(db))
+    assert status(db, job_id).status == QUEUED
+    ocr_worker._run_job(db, ocr_worker._claim_next_job(db))
+    row = status(db, job_id)
+    assert (row.status, row.error) == (FAILED, "vision down")
+
+
+def test_job_status_is_only_visible_to_its_owner(db, job, make_user):
+    job_id, owner = job
+    assert ocr_worker.get_ocr_job(db, job_id, owner).job_id == job_id
+    assert ocr_worker.get_ocr_job(db, job_id, make_user().user_id) is None
+    assert ocr_worker.get_ocr_job(db, job_id, None) is None
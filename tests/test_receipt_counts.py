@@ -0,0 +1,57 @@
+from datetime import date
+
+import receipt_counts
+from models import Receipt
+from receipt_counts import adjust_receipt_count, cached_receipt_count, get_receipt_count
+
+
+def add_receipt(db, user, n):
+    db.add(Receipt(public_id=f"uploads/{user.user_id}-{n}", user_id=user.user_id, name=f"r{n}", date=date(2024, 1, 1)))
+    adjust_receipt_count(db, user.user_id, 1)
+    db.commit()
+
+
+def test_count_is_cached_only_after_commit(db, make_user):
+    user = make_user()
+    db.add(Receipt(public_id=f"uploads/{user.user_id}-0", user_id=user.user_id, name="r0"))
+    adjust_receipt_count(db, user.user_id, 1)
+    assert cached_receipt_count(user.user_id) is None
+    db.commit()
+    assert cached_receipt_count(user.user_id) == 1
+
+
+def test_rolled_back_count_is_not_cached(db, make_user):
+    user = make_user()
+    db.add(Receipt(public_id=f"uploads/{user.user_id}-0", user_id=user.user_id, name="r0"))
+    adjust_receipt_count(db, user.user_id, 1)
+    db.rollback()
+    assert cached_receipt_count(user.user_id) is None
+    assert get_receipt_count(db, user.user_id) == 0
+
+
+def test_cached_count_expires_after_ttl(db, make_user, monkeypatch):
+    user = make_user()
+    add_receipt(db, user, 0)
+    assert cached_receipt_count(user.user_id) == 1
+
+    # another process adds a receipt; this one keeps its value until the TTL runs out
+    db.query(receipt_counts.ReceiptCount).filter_by(user_id=user.user_id).update({"count": 5})
+    db.commit()
+    assert get_receipt_count(db, user.user_id) == 1
+
+    monkeypatch.setattr(receipt_counts, "RECEIPT_COUNT_TTL_SECONDS", -1)
+    assert cached_receipt_count(user.user_id) is None
+    assert get_receipt_count(db, user.user_id) == 5
+
+
+def test_first_adjust_creates_the_counter_from_existing_rows(db, make_user):
+    user = make_user()
+    for n in range(3):
+        db.add(Receipt(public_id=f"uploads/{user.user_id}-{n}", user_id=user.user_id, name=f"r{n}"))
+    db.commit()
+    assert get_receipt_count(db, user.user_id) == 3
+
+    db.add(Receipt(public_id=f"uploads/{user.user_id}-3", user_id=user.user_id, name="r3"))
+    adjust_receipt_count(db, user.user_id, 1)
+    db.commit()
+    assert get_receipt_count(db, user.user_id) == 4
@@ -0,0 +1,71 @@
+from uuid import uuid4
+
+from models import Receipt, User
+from receipt_counts import adjust_receipt_count, get_receipt_count
+
+
+def add_receipts(db, username, n):
+    user = db.query(User).filter_by(username=username).one()
+    ids = [f"uploads/{uuid4().hex}" for _ in range(n)]
+    for pid in ids:
+        db.add(Receipt(public_id=pid, user_id=user.user_id, name=pid))
+    adjust_receipt_count(db, user.user_id, n)
+    db.commit()
+    return user.user_id, ids
+
+
+def cloudinary_calls(fakes, route):
+    return fakes.cloudinary.stats()["calls"].get(route, 0)
+
+
+def test_update_several_receipts(client, login, db, fakes):
+    _, ids = add_receipts(db, login(), 2)
+    before = cloudinary_calls(fakes, "POST image/context")
+    resp = client.post("/update", data={"public_id": ids + ids[:1], "insurance_company": "Maccabi"})
+    assert resp.status_code == 200
+    # one context call for the whole list, duplicates dropped
+    assert cloudinary_calls(fakes, "POST image/context") == before + 1
+    db.expire_all()
+    assert {db.get(Receipt, pid).insurance_company for pid in ids} == {"Maccabi"}
+
+
+def test_update_refuses_a_list_with_someone_elses_receipt(client, login, db):
+    _, theirs = add_receipts(db, login(), 1)
+    _, ours = add_receipts(db, login(), 1)
+    resp = client.post("/update", data={"public_id": ours + theirs, "insurance_company": "Maccabi"})
+    assert resp.status_code == 403
+    db.expire_all()
+    assert db.get(Receipt, ours[0]).insurance_company is None
+
+
+def test_delete_one_receipt_uses_destroy(client, login, db, fakes):
+    user_id, ids = add_receipts(db, login(), 2)
+    destroyed = cloudinary_calls(fakes, "POST image/destroy")
+    bulk = cloudinary_calls(fakes, "DELETE resources/image/upload")
+    resp = client.post("/delete", data={"public_id": ids[:1]})
+    assert resp.status_code == 200
+    assert cloudinary_calls(fakes, "POST image/destroy") == destroyed + 1
+    assert cloudinary_calls(fakes, "DELETE resources/image/upload") == bulk
+    db.expire_all()
+    assert db.get(Receipt, ids[0]) is None
+    assert get_receipt_count(db, user_id) == 1
+
+
+def test_delete_several_receipts_in_one_call(client, login, db, fakes):
+    user_id, ids = add_receipts(db, login(), 3)
+    bulk = cloudinary_calls(fakes, "DELETE resources/image/upload")
+    resp = client.post("/delete", data={"public_id": ids + ids[:1]})
+    assert resp.status_code == 200
+    assert cloudinary_calls(fakes, "DELETE resources/image/upload") == bulk + 1
+    db.expire_all()
+    assert all(db.get(Receipt, pid) is None for pid in ids)
+    assert get_receipt_count(db, user_id) == 0
+
+
+def test_delete_refuses_a_list_with_an_unknown_id(client, login, db, fakes):
+    user_id, ids = add_receipts(db, login(), 1)
+    resp = client.post("/delete", data={"public_id": ids + ["uploads/missing"]})
+    assert resp.status_code == 403
+    db.expire_all()
+    assert db.get(Receipt, ids[0]) is not None
+    assert get_receipt_count(db, user_id) == 1
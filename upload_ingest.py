@@ -0,0 +1,103 @@
+import hashlib
+import os
+from dataclasses import dataclass
+
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(15 * 1024 * 1024)))
+# multipart framing and the other form fields on top of the file itself
+MAX_UPLOAD_OVERHEAD = 64 * 1024
+READ_CHUNK_BYTES = 1024 * 1024
+# Cloudinary requires chunks of at least 5MB for chunked uploads
+CLOUDINARY_CHUNK_BYTES = max(int(os.getenv("CLOUDINARY_CHUNK_BYTES", str(6 * 1024 * 1024))), 5 * 1024 * 1024)
+
+
+def _too_large_message(max_bytes: int = MAX_UPLOAD_BYTES) -> str:
+    return f"File is larger than {max_bytes // (1024 * 1024)} MB"
+
+
+class UploadTooLarge(HTTPException):
+    # an HTTPException so FastAPI's body parsing lets it through as a 413
+    def __init__(self, detail: str = None):
+        super().__init__(status_code=413, detail=detail or _too_large_message())
+
+
+@dataclass
+class IngestResult:
+    content_hash: str
+    size: int
+
+
+def ingest(fileobj, max_bytes: int = MAX_UPLOAD_BYTES) -> IngestResult:
+    """Hash and size-check an uploaded file in one chunked pass.
+
+    Only one chunk is held in memory at a time; the file is rewound so
+    the next stage can stream it again.
+    """
+    h = hashlib.sha256()
+    size = 0
+    for chunk in iter(lambda: fileobj.read(READ_CHUNK_BYTES), b''):
+        size += len(chunk)
+        if size > max_bytes:
+            raise UploadTooLarge(_too_large_message(max_bytes))
+        h.update(chunk)
+    fileobj.seek(0)
+    return IngestResult(content_hash=h.hexdigest(), size=size)
+
+
+class UploadSizeLimitMiddleware:
+    """Reject oversized request bodies on the given paths before they are parsed.
+
+    Requests with a Content-Length over the limit are refused outright;
+    chunked requests are counted as they stream in.
+    """
+
+    def __init__(self, app, paths=("/upload",), max_bytes: int = MAX_UPLOAD_BYTES + MAX_UPLOAD_OVERHEAD):
+        self.app = app
+        self.paths = set(paths)
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            return await self.app(scope, receive, send)
+
+        for name, value in scope.get("headers", []):
+            if name != b"content-length":
+                continue
+            try:
+                length = int(value)
+            except ValueError:
+                response = JSONResponse({"error": "Invalid Content-Length header"}, status_code=400)
+                return await response(scope, receive, send)
+            if length > self.max_bytes:
+                return await self._reject(scope, receive, send)
+
+        received = 0
+        started = False
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise UploadTooLarge()
+            return message
+
+        async def tracking_send(message):
+            nonlocal started
+            if message["type"] == "http.response.start":
+                started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracking_send)
+        except UploadTooLarge:
+            if started:
+                raise
+            await self._reject(scope, receive, send)
+
+    async def _reject(self, scope, receive, send):
+        response = JSONResponse({"error": _too_large_message()}, status_code=413)
+        await response(scope, receive, send)
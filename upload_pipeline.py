@@ -0,0 +1,63 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import upload_stage_duration, upload_stage_wait
+
+logger = logging.getLogger('kabala')
+
+# Max blocking calls of each stage running at once in this worker
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "8"))
+OCR_CONCURRENCY = int(os.getenv("OCR_CONCURRENCY", "4"))
+DB_CONCURRENCY = int(os.getenv("UPLOAD_DB_CONCURRENCY", "4"))
+# image decoding/re-encoding is CPU bound and mostly holds the GIL
+PREP_CONCURRENCY = int(os.getenv("PREP_CONCURRENCY", "2"))
+
+_limits = {
+    "cloudinary_upload": asyncio.Semaphore(UPLOAD_CONCURRENCY),
+    "ocr": asyncio.Semaphore(OCR_CONCURRENCY),
+    "db_insert": asyncio.Semaphore(DB_CONCURRENCY),
+    "prep": asyncio.Semaphore(PREP_CONCURRENCY),
+}
+# short DB writes share the DB slots
+_limits["ocr_enqueue"] = _limits["db_insert"]
+_limits["ocr_cache"] = _limits["db_insert"]
+_limits["receipt_count"] = _limits["db_insert"]
+_limits["ingest"] = _limits["cloudinary_upload"]
+
+# One thread per permitted in-flight call, kept apart from starlette's threadpool
+_executor = ThreadPoolExecutor(
+    max_workers=UPLOAD_CONCURRENCY + OCR_CONCURRENCY + DB_CONCURRENCY + PREP_CONCURRENCY,
+    thread_name_prefix="upload-pipeline",
+)
+
+
+async def run_stage(stage: str, timings: dict, fn, *args, **kwargs):
+    """Run a blocking call for a pipeline stage without blocking the event loop.
+
+    Records the time spent waiting for a slot and running the call in
+    timings as "<stage>_wait_ms" and "<stage>_ms".
+    """
+    queued = time.perf_counter()
+    async with _limits[stage]:
+        started = time.perf_counter()
+        timings[f"{stage}_wait_ms"] = round((started - queued) * 1000, 1)
+        upload_stage_wait.observe(started - queued, stage)
+        try:
+            loop = asyncio.get_running_loop()
+            # copy the context so the stage's log lines keep the request id
+            ctx = contextvars.copy_context()
+            return await loop.run_in_executor(_executor, functools.partial(ctx.run, fn, *args, **kwargs))
+        finally:
+            elapsed = time.perf_counter() - started
+            timings[f"{stage}_ms"] = round(elapsed * 1000, 1)
+            upload_stage_duration.observe(elapsed, stage)
+
+
+def log_timings(public_id: str, timings: dict):
+    parts = ", ".join(f"{k}={v}" for k, v in timings.items())
+    logger.info(f"Upload timings for public_id={public_id}: {parts}")
@@ -0,0 +1,234 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+import anyio
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from starlette.requests import cookie_parser
+
+from database import SessionLocal
+from models import User
+
+logger = logging.getLogger('kabala')
+
+SESSION_COOKIE = "session"
+SESSION_MAX_AGE = int(os.getenv("SESSION_MAX_AGE", str(30 * 24 * 3600)))
+USER_CACHE_ITEMS = int(os.getenv("USER_CACHE_ITEMS", "1024"))
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "300"))
+
+# Cookie signing with itsdangerous
+SECRET_KEY = os.environ.get('SECRET_KEY')
+if not SECRET_KEY:
+    # Generate a default key (use env var in production!)
+    import secrets
+    SECRET_KEY = secrets.token_urlsafe(32)
+    logger.warning('SECRET_KEY not set in environment. Using generated key (not persistent).')
+
+serializer = URLSafeTimedSerializer(SECRET_KEY, salt='cookie-signer')
+session_serializer = URLSafeTimedSerializer(SECRET_KEY, salt='session')
+
+_INVALIDATE_KEY = "user_cache_invalidate"
+
+
+@dataclass(frozen=True)
+class SessionUser:
+    """The profile fields handlers read, detached from any DB session."""
+    user_id: int
+    username: str
+    email: Optional[str]
+    phone: Optional[str]
+    family_member_names: tuple
+    insurance_company_names: tuple
+
+    @property
+    def family_members(self) -> str:
+        return ', '.join(self.family_member_names)
+
+    @property
+    def insurance_companies(self) -> str:
+        return ', '.join(self.insurance_company_names)
+
+    @classmethod
+    def from_user(cls, user: User) -> "SessionUser":
+        return cls(
+            user_id=user.user_id,
+            username=user.username,
+            email=user.email,
+            phone=user.phone,
+            family_member_names=tuple(user.family_member_names),
+            insurance_company_names=tuple(user.insurance_company_names),
+        )
+
+
+def sign_cookie_value(value: str) -> str:
+    """Sign a cookie value for security."""
+    return serializer.dumps(value)
+
+
+def verify_cookie_value(signed_value: str, max_age: int = None) -> Optional[str]:
+    """Verify and unsign a cookie value. Returns None if invalid."""
+    try:
+        return serializer.loads(signed_value, max_age=max_age)
+    except (BadSignature, SignatureExpired):
+        return None
+
+
+def make_session_token(user_id: int, username: str) -> str:
+    return session_serializer.dumps([user_id, username])
+
+
+def read_session_token(token: str) -> Optional[tuple[int, str]]:
+    """Return (user_id, username) from a session token, or None if invalid or expired."""
+    try:
+        user_id, username = session_serializer.loads(token, max_age=SESSION_MAX_AGE)
+        return int(user_id), username
+    except (BadSignature, SignatureExpired, ValueError, TypeError):
+        return None
+
+
+def set_session_cookie(resp, user_id: int, username: str, secure: bool = True):
+    resp.set_cookie(SESSION_COOKIE, make_session_token(user_id, username),
+                    max_age=SESSION_MAX_AGE, httponly=True, secure=secure, samesite='lax')
+    # drop the per-field cookies older sessions were issued
+    resp.delete_cookie('user_id')
+    resp.delete_cookie('username')
+
+
+def clear_session_cookie(resp):
+    resp.delete_cookie(SESSION_COOKIE)
+    resp.delete_cookie('user_id')
+    resp.delete_cookie('username')
+
+
+# user_id -> (loaded_at, SessionUser); most recently used last
+_cache: "OrderedDict[int, tuple[float, SessionUser]]" = OrderedDict()
+_lock = threading.Lock()
+
+
+def cached_user(user_id: int) -> Optional[SessionUser]:
+    with _lock:
+        hit = _cache.get(user_id)
+        if hit is None:
+            return None
+        if time.monotonic() - hit[0] > USER_CACHE_TTL_SECONDS:
+            del _cache[user_id]
+            return None
+        _cache.move_to_end(user_id)
+        return hit[1]
+
+
+def _remember(user: SessionUser):
+    with _lock:
+        _cache[user.user_id] = (time.monotonic(), user)
+        _cache.move_to_end(user.user_id)
+        while len(_cache) > USER_CACHE_ITEMS:
+            _cache.popitem(last=False)
+
+
+def forget_user(user_id: int) -> None:
+    with _lock:
+        _cache.pop(user_id, None)
+
+
+def invalidate_user(db, user_id: Optional[int]) -> None:
+    """Drop the cached profile now and again once db's transaction commits.
+
+    The second drop covers a request that reloads the old row between the
+    change and the commit.
+    """
+    if user_id is None:
+        return
+    forget_user(user_id)
+    db.info.setdefault(_INVALIDATE_KEY, set()).add(user_id)
+
+
+@event.listens_for(Session, "after_commit")
+def _forget_committed(session):
+    for user_id in session.info.pop(_INVALIDATE_KEY, ()):
+        forget_user(user_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_invalidations(session):
+    session.info.pop(_INVALIDATE_KEY, None)
+
+
+def load_user(user_id: int, username: str) -> Optional[SessionUser]:
+    """Resolve a session's user from the cache, or the DB on a miss."""
+    user = cached_user(user_id)
+    if user is None:
+        db = SessionLocal()
+        try:
+            row = db.get(User, user_id)
+            if row is None:
+                return None
+            user = SessionUser.from_user(row)
+        finally:
+            db.close()
+        _remember(user)
+    # a token for a user_id that now belongs to someone else is not valid
+    return user if user.username == username else None
+
+
+def _session_identity(cookies: dict) -> Optional[tuple[int, str]]:
+    token = cookies.get(SESSION_COOKIE)
+    if token:
+        return read_session_token(token)
+    # sessions issued before the single token: two separately signed cookies
+    user_id_signed, username_signed = cookies.get('user_id'), cookies.get('username')
+    if user_id_signed and username_signed:
+        user_id = verify_cookie_value(user_id_signed)
+        username = verify_cookie_value(username_signed)
+        if user_id and username:
+            try:
+                return int(user_id), username
+            except ValueError:
+                return None
+    return None
+
+
+def _parse_cookies(scope) -> dict:
+    # the parser request.cookies uses: a malformed cookie doesn't hide the ones after it
+    for name, value in scope.get("headers", ()):
+        if name == b"cookie":
+            return cookie_parser(value.decode("latin-1"))
+    return {}
+
+
+class SessionUserMiddleware:
+    """Resolve the logged-in user once per request into request.state.user.
+
+    Verifies the session cookie and looks the user up through the in-process
+    cache; request.state.user is None for anonymous or stale sessions.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        user = None
+        identity = _session_identity(_parse_cookies(scope))
+        if identity is not None:
+            user_id, username = identity
+            user = cached_user(user_id)
+            if user is None or user.username != username:
+                try:
+                    user = await anyio.to_thread.run_sync(load_user, user_id, username)
+                except Exception:
+                    logger.error(f'Loading session user {user_id} failed', exc_info=True)
+                    user = None
+        scope.setdefault("state", {})["user"] = user
+        await self.app(scope, receive, send)
+
+
+def current_user(request) -> Optional[SessionUser]:
+    return getattr(request.state, "user", None)